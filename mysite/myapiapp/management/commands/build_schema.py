@@ -0,0 +1,23 @@
+from django.core.management import BaseCommand, CommandError
+
+from myapiapp.schema import build_schema, code_fingerprint, read_schema, schema_root
+
+
+class Command(BaseCommand):
+    """
+    Writes the OpenAPI schema served at api/schema, run it on deploy
+    so that no request has to generate it
+    """
+    help = "Generate the OpenAPI schema artifact"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only fail if the artifact is missing or stale")
+
+    def handle(self, *args, check=False, **options):
+        if check:
+            if read_schema(code_fingerprint()) is None:
+                raise CommandError(f"The schema in {schema_root()} does not match the code")
+            self.stdout.write(self.style.SUCCESS("The schema is up to date"))
+            return
+        fingerprint = build_schema()
+        self.stdout.write(self.style.SUCCESS(f"Wrote the schema for {fingerprint} to {schema_root()}"))
@@ -0,0 +1,167 @@
+"""
+Готовая схема OpenAPI.
+
+Схема строится один раз (командой build_schema при деплое или при первом
+запросе) и лежит в SCHEMA_ROOT в YAML и JSON вместе с отпечатком кода,
+из которого собрана. Пока код не изменился, схема читается из файлов
+и отдаётся готовыми байтами с ETag, без обхода представлений.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+
+import django
+import drf_spectacular
+import rest_framework
+from django.conf import settings
+from django.utils import translation
+from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+from drf_spectacular.settings import spectacular_settings
+
+SCHEMA_FORMATS = {
+    "yaml": OpenApiYamlRenderer,
+    "json": OpenApiJsonRenderer,
+}
+FINGERPRINT_FILE = "openapi.fingerprint"
+# files that can change the generated schema
+CODE_SUFFIXES = (".py", ".mo")
+SKIPPED_DIRS = {"__pycache__", "migrations", "tests"}
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class EncodedSchema:
+    """
+    Схема в одном формате: тело, сжатое тело и ETag
+    """
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+    @classmethod
+    def from_body(cls, body: bytes) -> "EncodedSchema":
+        return cls(body, gzip.compress(body, mtime=0), '"%s"' % hashlib.sha256(body).hexdigest()[:32])
+
+
+@dataclass
+class SchemaArtifact:
+    fingerprint: str
+    formats: Dict[str, EncodedSchema]
+
+
+def schema_root() -> Path:
+    return Path(getattr(settings, "SCHEMA_ROOT", settings.BASE_DIR / "schema"))
+
+
+def data_dirs() -> set:
+    """
+    Каталоги данных внутри проекта, в них нет кода
+    """
+    dirs = {settings.MEDIA_ROOT, schema_root()}
+    dirs.update(Path(database["NAME"]).parent for database in settings.DATABASES.values())
+    dirs.update(
+        cache["LOCATION"] for cache in settings.CACHES.values()
+        if cache["BACKEND"].endswith("FileBasedCache") and cache.get("LOCATION")
+    )
+    return {Path(path).resolve() for path in dirs}
+
+
+@lru_cache(maxsize=None)
+def code_fingerprint() -> str:
+    """
+    Отпечаток кода проекта, переводов, версий библиотек и настроек схемы.
+    Считается один раз на процесс: код работающего процесса не меняется
+    """
+    digest = hashlib.sha256()
+    for part in (django.__version__, rest_framework.VERSION, drf_spectacular.__version__,
+                 repr(settings.SPECTACULAR_SETTINGS), repr(settings.REST_FRAMEWORK), settings.LANGUAGE_CODE):
+        digest.update(part.encode())
+    skipped = data_dirs()
+    base_dir = Path(settings.BASE_DIR).resolve()
+    for root, dirs, files in os.walk(base_dir):
+        dirs[:] = sorted(
+            name for name in dirs
+            if not name.startswith(".") and name not in SKIPPED_DIRS and (Path(root) / name).resolve() not in skipped
+        )
+        for name in sorted(files):
+            if name.endswith(CODE_SUFFIXES) and not name.startswith("test"):
+                path = Path(root) / name
+                digest.update(str(path.relative_to(base_dir)).encode())
+                digest.update(path.read_bytes())
+    return digest.hexdigest()[:32]
+
+
+def generate_schema() -> Dict[str, bytes]:
+    """
+    Схема всего API, как у SpectacularAPIView и команды spectacular,
+    на языке проекта по умолчанию
+    """
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    with translation.override(settings.LANGUAGE_CODE):
+        data = generator.get_schema(request=None, public=True)
+    return {fmt: renderer().render(data, renderer_context={}) for fmt, renderer in SCHEMA_FORMATS.items()}
+
+
+def write_schema(bodies: Dict[str, bytes], fingerprint: str) -> None:
+    root = schema_root()
+    root.mkdir(parents=True, exist_ok=True)
+    files = {f"openapi.{fmt}": body for fmt, body in bodies.items()}
+    # the fingerprint goes last, a reader never pairs it with older bodies
+    files[FINGERPRINT_FILE] = fingerprint.encode()
+    for name, content in files.items():
+        temporary = root / f".{name}.{os.getpid()}"
+        temporary.write_bytes(content)
+        os.replace(temporary, root / name)
+
+
+def read_schema(fingerprint: str) -> Optional[Dict[str, bytes]]:
+    root = schema_root()
+    try:
+        if (root / FINGERPRINT_FILE).read_bytes().decode() != fingerprint:
+            return None
+        return {fmt: (root / f"openapi.{fmt}").read_bytes() for fmt in SCHEMA_FORMATS}
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def build_schema() -> str:
+    """
+    Собирает схему заново и записывает её в SCHEMA_ROOT, возвращает отпечаток
+    """
+    fingerprint = code_fingerprint()
+    write_schema(generate_schema(), fingerprint)
+    return fingerprint
+
+
+_artifact: Optional[SchemaArtifact] = None
+_lock = threading.Lock()
+
+
+def load_schema() -> SchemaArtifact:
+    """
+    Схема для текущего кода: из памяти процесса, из файлов или собранная заново
+    """
+    global _artifact
+    fingerprint = code_fingerprint()
+    artifact = _artifact
+    if artifact is not None and artifact.fingerprint == fingerprint:
+        return artifact
+    with _lock:
+        if _artifact is None or _artifact.fingerprint != fingerprint:
+            bodies = read_schema(fingerprint)
+            if bodies is None:
+                bodies = generate_schema()
+                try:
+                    write_schema(bodies, fingerprint)
+                except OSError as exc:
+                    # a read-only deploy still serves the schema from memory
+                    log.warning("Cannot write the OpenAPI schema to %s: %s", schema_root(), exc)
+            _artifact = SchemaArtifact(fingerprint, {fmt: EncodedSchema.from_body(body) for fmt, body in bodies.items()})
+        return _artifact
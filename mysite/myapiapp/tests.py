@@ -1,3 +1,60 @@
-from django.test import TestCase
+import json
+import tempfile
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from myapiapp import schema
+
+
+@override_settings(SCHEMA_ROOT=tempfile.mkdtemp())
+class CachedSchemaViewTestCase(TestCase):
+    def setUp(self) -> None:
+        schema._artifact = None
+        self.addCleanup(setattr, schema, "_artifact", None)
+
+    def test_schema_is_generated_once(self):
+        url = reverse("schema")
+        with mock.patch.object(schema, "generate_schema", wraps=schema.generate_schema) as generate:
+            response = self.client.get(url)
+            again = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            as_json = self.client.get(url, {"format": "json"})
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("application/vnd.oai.openapi"))
+        self.assertEqual(again.status_code, 304)
+        paths = json.loads(as_json.content)["paths"]
+        # the artifact is built outside a request, under LANGUAGE_CODE: its prefix must resolve
+        documented = next(path for path in paths if path.endswith("/shop/api/products/"))
+        self.assertEqual(self.client.get(documented).status_code, 200)
+        self.assertIn("/en/shop/api/products/", paths)
+        self.assertNotEqual(as_json["ETag"], response["ETag"])
+        self.assertEqual(self.client.get(reverse("swagger")).status_code, 200)
+
+        # a new process reads the artifact instead of generating it
+        schema._artifact = None
+        with mock.patch.object(schema, "generate_schema") as generate:
+            self.assertEqual(self.client.get(url).content, response.content)
+        generate.assert_not_called()
+
+    @override_settings(SCHEMA_ROOT=tempfile.mkdtemp())
+    def test_gzip_follows_q_values(self):
+        url = reverse("schema")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0, identity")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_command_and_code_changes(self):
+        out = StringIO()
+        call_command("build_schema", stdout=out)
+        call_command("build_schema", "--check", stdout=out)
+        self.assertIn("up to date", out.getvalue())
+        with mock.patch.object(schema, "code_fingerprint", return_value="changed"):
+            self.assertIsNone(schema.read_schema(schema.code_fingerprint()))
+            with mock.patch.object(schema, "generate_schema", wraps=schema.generate_schema) as generate:
+                self.client.get(reverse("schema"))
+            generate.assert_called_once()
@@ -1,11 +1,18 @@
 from django.contrib.auth.models import Group
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.utils import extend_schema
+from drf_spectacular.views import SCHEMA_KWARGS, SpectacularAPIView
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework.generics import GenericAPIView, ListCreateAPIView
 from rest_framework.mixins import ListModelMixin, CreateModelMixin
+from shopapp.exports import accepts_gzip
 
+from .schema import load_schema
 from .serializers import GroupSerializer
 
 
@@ -20,3 +27,31 @@ class GroupsListView(ListCreateAPIView):
 
     def get(self, request: Request) -> Response:
         return self.list(request)
+
+
+class CachedSchemaView(SpectacularAPIView):
+    """
+    Схема OpenAPI из готового артефакта (см. myapiapp.schema): YAML или JSON
+    по Accept и ?format=, с ETag и gzip. Запросы с ?lang= и ?version=
+    строятся на лету, как у SpectacularAPIView
+    """
+    @extend_schema(**SCHEMA_KWARGS)
+    def get(self, request, *args, **kwargs):
+        if request.GET.get("lang") or request.GET.get("version"):
+            return super().get(request, *args, **kwargs)
+        renderer = request.accepted_renderer
+        encoded = load_schema().formats[renderer.format]
+        use_gzip = accepts_gzip(request)
+        etag = encoded.etag[:-1] + '-gzip"' if use_gzip else encoded.etag
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content_type = renderer.media_type
+            if renderer.charset:
+                content_type += f"; charset={renderer.charset}"
+            response = HttpResponse(encoded.gzipped if use_gzip else encoded.body, content_type=content_type)
+            if use_gzip:
+                response["Content-Encoding"] = "gzip"
+            response["Content-Disposition"] = f'inline; filename="{spectacular_settings.TITLE or "schema"}.{renderer.format}"'
+        response["ETag"] = etag
+        patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+        return response
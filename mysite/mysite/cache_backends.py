@@ -0,0 +1,378 @@
+"""
+Кэш проекта в два уровня.
+
+SQLiteCache — общий для всех процессов хоста кэш в одном файле SQLite
+(WAL, одна строка на ключ). TieredCache ставит перед ним LRU в памяти
+каждого процесса, ограниченный по числу записей и байтам и знающий срок
+жизни записей. Согласованность между воркерами держат поколения: любая
+запись в общий кэш двигает счётчик слота ключа в разделяемом через mmap
+файле, а локальная запись годна, пока поколение её слота не изменилось.
+Проверка поколения — чтение из памяти без системных вызовов.
+
+Все процессы, пишущие в LOCATION, должны использовать TieredCache,
+иначе их записи не двигают поколения.
+"""
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# SQLite builds before 3.32 allow 999 parameters per statement
+BATCH_SIZE = 500
+GENERATION_SLOTS = 4096
+ENTRY_OVERHEAD = 200
+
+_slot = struct.Struct("q")
+
+
+def _batches(items: list) -> Iterable[list]:
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+
+class SQLiteCache(BaseCache):
+    """
+    Кэш в файле SQLite, общий для процессов одного хоста
+    """
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._location = str(location)
+        self._connections = threading.local()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # a forked worker must not reuse the parent's connection
+        if getattr(self._connections, "pid", None) != os.getpid():
+            Path(self._location).parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self._location, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL) WITHOUT ROWID"
+            )
+            self._connections.connection = connection
+            self._connections.pid = os.getpid()
+        return self._connections.connection
+
+    @contextmanager
+    def _write(self):
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _fetch(self, keys: List[str]) -> Dict[str, Tuple[bytes, Optional[float]]]:
+        """
+        Живые записи по ключам: значение в pickle и момент истечения
+        """
+        rows = {}
+        now = time.time()
+        for batch in _batches(keys):
+            rows.update(
+                (key, (value, expires))
+                for key, value, expires in self._connection.execute(
+                    "SELECT key, value, expires FROM cache WHERE key IN (%s) AND (expires IS NULL OR expires > ?)"
+                    % ", ".join("?" * len(batch)),
+                    [*batch, now],
+                )
+            )
+        return rows
+
+    def _lookup(self, keys: List[str]) -> Dict[str, bytes]:
+        return {key: value for key, (value, _) in self._fetch(keys).items()}
+
+    def _changed(self, keys: Optional[Iterable[str]]) -> None:
+        """
+        Вызывается после записи по ключам keys, None — после очистки
+        """
+
+    def _cull(self, connection: sqlite3.Connection) -> None:
+        count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count <= self._max_entries:
+            return
+        connection.execute("DELETE FROM cache WHERE expires <= ?", [time.time()])
+        count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count <= self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            connection.execute("DELETE FROM cache")
+            return
+        # the entries closest to expiry go first, those without a timeout last
+        connection.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)",
+            [count // self._cull_frequency],
+        )
+
+    def _pack(self, value, timeout) -> Tuple[bytes, Optional[float]]:
+        return pickle.dumps(value, self.pickle_protocol), self.get_backend_timeout(timeout)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        value = self._lookup([key]).get(key)
+        return default if value is None else pickle.loads(value)
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        return {keys[key]: pickle.loads(value) for key, value in self._lookup(list(keys)).items()}
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return key in self._lookup([key])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        rows = [(self.make_and_validate_key(key, version=version), *self._pack(value, timeout)) for key, value in data.items()]
+        with self._write() as connection:
+            connection.executemany("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", rows)
+            self._cull(connection)
+        self._changed(row[0] for row in rows)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._write() as connection:
+            # an expired row is replaced as if it did not exist
+            added = connection.execute(
+                "INSERT INTO cache (key, value, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+                "WHERE cache.expires <= ?",
+                [key, *self._pack(value, timeout), time.time()],
+            ).rowcount == 1
+            if added:
+                self._cull(connection)
+        if added:
+            self._changed([key])
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        touched = self._connection.execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            [self.get_backend_timeout(timeout), key, time.time()],
+        ).rowcount == 1
+        if touched:
+            self._changed([key])
+        return touched
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._write() as connection:
+            row = connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)", [key, time.time()]
+            ).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            connection.execute(
+                "UPDATE cache SET value = ? WHERE key = ?", [pickle.dumps(value, self.pickle_protocol), key]
+            )
+        self._changed([key])
+        return value
+
+    def delete(self, key, version=None):
+        return self.delete_many([key], version=version) > 0
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        deleted = 0
+        with self._write() as connection:
+            for batch in _batches(keys):
+                deleted += connection.execute(
+                    "DELETE FROM cache WHERE key IN (%s)" % ", ".join("?" * len(batch)), batch
+                ).rowcount
+        self._changed(keys)
+        return deleted
+
+    def clear(self):
+        self._connection.execute("DELETE FROM cache")
+        self._changed(None)
+
+
+class Generations:
+    """
+    Счётчики поколений слотов ключей в файле, отображённом в память
+    всех процессов
+    """
+    def __init__(self, path: str):
+        size = GENERATION_SLOTS * _slot.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def offset(key: str) -> int:
+        return zlib.crc32(key.encode()) % GENERATION_SLOTS * _slot.size
+
+    def __getitem__(self, key: str) -> int:
+        return _slot.unpack_from(self._map, self.offset(key))[0]
+
+    def bump(self, keys: Iterable[str]) -> None:
+        for offset in {self.offset(key) for key in keys}:
+            # any new value will do, the clock keeps it from repeating an old one
+            current = _slot.unpack_from(self._map, offset)[0]
+            _slot.pack_into(self._map, offset, max(time.time_ns(), current + 1))
+
+    def bump_all(self) -> None:
+        current = max(struct.unpack_from(f"{GENERATION_SLOTS}q", self._map))
+        self._map[:] = struct.pack(f"{GENERATION_SLOTS}q", *[max(time.time_ns(), current + 1)] * GENERATION_SLOTS)
+
+
+class LocalTier:
+    """
+    LRU одного процесса: ключ -> (значение в pickle или None, если ключа
+    нет в общем кэше, момент истечения, поколение слота при чтении)
+    """
+    def __init__(self, generations: Generations, max_entries: int, max_bytes: int):
+        self.generations = generations
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.size = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(key: str, value: Optional[bytes]) -> int:
+        return len(key) + len(value or b"") + ENTRY_OVERHEAD
+
+    def get(self, key: str, generation: int, now: float) -> Optional[tuple]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires, entry_generation = entry
+            if entry_generation != generation or (expires is not None and expires <= now):
+                self.stats["stale"] += 1
+                self._discard(key)
+                return None
+            self.entries.move_to_end(key)
+            self.stats["local_hits" if value is not None else "misses"] += 1
+            return entry
+
+    def put(self, key: str, value: Optional[bytes], expires: Optional[float], generation: int) -> None:
+        size = self.entry_size(key, value)
+        with self.lock:
+            self.stats["shared_hits" if value is not None else "misses"] += 1
+            self._discard(key)
+            # a single huge value would flush the whole tier
+            if size > self.max_bytes // 8:
+                return
+            self.entries[key] = (value, expires, generation)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                old_key, (old_value, _, _) = self.entries.popitem(last=False)
+                self.size -= self.entry_size(old_key, old_value)
+                self.stats["evictions"] += 1
+
+    def discard(self, keys: Optional[Iterable[str]]) -> None:
+        with self.lock:
+            if keys is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for key in keys:
+                self._discard(key)
+
+    def _discard(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= self.entry_size(key, entry[0])
+
+
+_tiers: Dict[Tuple[str, int], LocalTier] = {}
+_tiers_lock = threading.Lock()
+
+
+class TieredCache(SQLiteCache):
+    """
+    SQLiteCache с LRU в памяти процесса.
+
+    OPTIONS: LOCAL_MAX_ENTRIES и LOCAL_MAX_BYTES ограничивают LRU,
+    MAX_ENTRIES и CULL_FREQUENCY — общий кэш
+    """
+    def __init__(self, location, params):
+        super().__init__(location, params)
+        options = params.get("OPTIONS", {})
+        self._local_max_entries = int(options.get("LOCAL_MAX_ENTRIES", 1000))
+        self._local_max_bytes = int(options.get("LOCAL_MAX_BYTES", 32 * 1024 * 1024))
+
+    @property
+    def _tier(self) -> LocalTier:
+        # one tier per process, shared by the per-thread cache instances
+        key = (self._location, os.getpid())
+        tier = _tiers.get(key)
+        if tier is None:
+            with _tiers_lock:
+                tier = _tiers.get(key)
+                if tier is None:
+                    Path(self._location).parent.mkdir(parents=True, exist_ok=True)
+                    generations = Generations(f"{self._location}-generations")
+                    tier = _tiers[key] = LocalTier(generations, self._local_max_entries, self._local_max_bytes)
+        return tier
+
+    def _lookup(self, keys: List[str]) -> Dict[str, bytes]:
+        tier = self._tier
+        now = time.time()
+        found = {}
+        missed = {}
+        for key in keys:
+            # the generation is read before the shared tier, a write in between leaves the entry stale
+            generation = tier.generations[key]
+            entry = tier.get(key, generation, now)
+            if entry is None:
+                missed[key] = generation
+            elif entry[0] is not None:
+                found[key] = entry[0]
+        if missed:
+            rows = self._fetch(list(missed))
+            for key, generation in missed.items():
+                value, expires = rows.get(key, (None, None))
+                tier.put(key, value, expires, generation)
+                if value is not None:
+                    found[key] = value
+        return found
+
+    def _changed(self, keys: Optional[Iterable[str]]) -> None:
+        tier = self._tier
+        if keys is None:
+            tier.generations.bump_all()
+            tier.discard(None)
+            return
+        keys = list(keys)
+        tier.generations.bump(keys)
+        tier.discard(keys)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Счётчики этого процесса: local_hits, shared_hits, misses,
+        stale (записи, устаревшие по поколению или сроку) и evictions
+        """
+        tier = self._tier
+        with tier.lock:
+            stats = dict(tier.stats)
+            stats.update(entries=len(tier.entries), bytes=tier.size)
+        return stats
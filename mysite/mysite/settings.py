@@ -127,16 +127,24 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': DATABASE_DIR / 'db.sqlite3',
+        # import workers (manage.py runjobs) write concurrently with web workers
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
 CACHES = {
     "default": {
         # "BACKEND": "django.core.cache.dummy.DummyCache",
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        # "LOCATION": "/var/tmp/django_cache",
-        "LOCATION": "C:/django_cache",
-
+        # an in-process LRU in front of a SQLite file shared by the workers of the host
+        "BACKEND": "mysite.cache_backends.TieredCache",
+        "LOCATION": DATABASE_DIR / "cache.sqlite3",
+        "OPTIONS": {
+            "MAX_ENTRIES": 10000,
+            "LOCAL_MAX_ENTRIES": 1000,
+            "LOCAL_MAX_BYTES": 32 * 1024 * 1024,
+        },
     }
 }
 
@@ -163,7 +171,7 @@ AUTH_PASSWORD_VALIDATORS = [
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
-LANGUAGE_CODE = 'en-us'
+LANGUAGE_CODE = 'en'
 
 TIME_ZONE = 'UTC'
 
@@ -285,12 +293,17 @@ REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS": 'drf_spectacular.openapi.AutoSchema',
 }
 
+# QueryBudgetMixin raises instead of logging when an action runs over budget
+QUERY_BUDGET_RAISE = False
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'My Site Project API',
     'DESCRIPTION': 'My site with shop app and custom auth',
     'VERSION': '1.0.0',
     'SERVE_INCLUDE_SCHEMA': False,
 }
+# prebuilt OpenAPI schema, see myapiapp.schema and the build_schema command
+SCHEMA_ROOT = BASE_DIR / "schema"
 
 if DEBUG:
     import mimetypes
@@ -21,14 +21,15 @@ from django.conf.urls.i18n import i18n_patterns
 from django.contrib.sitemaps.views import sitemap
 
 from .sitemaps import sitemaps
-from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from drf_spectacular.views import SpectacularRedocView, SpectacularSwaggerView
+from myapiapp.views import CachedSchemaView
 
 urlpatterns = [
     path('req/', include('requestdataapp.urls')),
     path('accounts/', include('myauth.urls')),
     path('blog/', include('blogapp.urls')),
     path('api/', include('myapiapp.urls')),
-    path('api/schema', SpectacularAPIView.as_view(), name='schema'),
+    path('api/schema', CachedSchemaView.as_view(), name='schema'),
     path('api/schema/swagger', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger'),
     path('api/schema/redoc', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
 
@@ -1,13 +1,15 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
 from django.db.models import QuerySet
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.urls import path
-from django.shortcuts import render, redirect
+from django.utils import timezone
+from django.shortcuts import render, get_object_or_404
 
-from .common import save_csv_products, save_csv_orders
-from .models import Product, Order, ProductImage
-from .admin_mixins import ExportAsCSVMixin
-from .forms import CSVImportForm
+from .models import Product, Order, ProductImage, ImportJob
+from .admin_mixins import ExportAsCSVMixin, ImportCSVMixin
+from .caching import bump_generation
+from .search import admin_search, search_enabled
 
 
 class OrderInLine(admin.TabularInline):
@@ -20,17 +22,20 @@ class ProductInLine(admin.StackedInline):
 
 @admin.action(description="Archive products")
 def mark_archived(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet):
-    queryset.update(archived=True)
+    queryset.update(archived=True, updated_at=timezone.now())
+    bump_generation(Product)
 
 
 @admin.action(description="Unarchive products")
 def mark_unarchived(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet):
-    queryset.update(archived=False)
+    queryset.update(archived=False, updated_at=timezone.now())
+    bump_generation(Product)
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
+class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin, ImportCSVMixin):
     change_list_template = "shopapp/products_changelist.html"
+    import_job_kind = ImportJob.KIND_PRODUCTS
 
     actions = [
         mark_archived,
@@ -44,6 +49,18 @@ class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
     # list_display = "pk", "name", "description", "price", "discount"
     list_display = "pk", "name", "description_short", "price", "discount", "archived", "created_at", "created_by"
     list_display_links = "pk", "name"
+    export_fields = (
+        "pk",
+        "name",
+        "description",
+        "price",
+        "discount",
+        "created_at",
+        "created_by_id",
+        "created_by__username",
+        "archived",
+        "preview",
+    )
     ordering = "-name", "pk",
     search_fields = "name", "description", "price"
     fieldsets = [
@@ -64,38 +81,23 @@ class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
         })
     ]
 
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet, search_term: str):
+        # name and description through the full-text index instead of LIKE '%term%'
+        if search_term and search_enabled():
+            return admin_search(queryset, search_term), False
+        return super().get_search_results(request, queryset, search_term)
+
     def description_short(self, obj: Product) -> str:
         if len(obj.description) < 48:
             return obj.description
         return obj.description[:48] + "..."
 
-    def import_csv(self, request: HttpRequest) -> HttpResponse:
-        if request.method == "GET":
-            form = CSVImportForm()
-            context = {
-                "form": form,
-            }
-            return render(request, "admin/csv_form.html", context)
-        form = CSVImportForm(request.POST, request.FILES)
-        if not form.is_valid():
-            context = {
-                "form": form,
-            }
-            return render(request, "admin/csv_form.html", context, status=400)
-        save_csv_products(
-            file=form.files["csv_file"].file,
-            encoding=request.encoding,
-        )
-
-        self.message_user(request, "Data from CSV was imported")
-        return redirect("..")
-
     def get_urls(self):
         urls = super().get_urls()
         new_urls = [
             path(
                 "import-products-csv/",
-                self.import_csv,
+                self.admin_site.admin_view(self.import_csv),
                 name="import_products_csv"
             ),
         ]
@@ -110,8 +112,9 @@ class ProductInline(admin.StackedInline):
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(admin.ModelAdmin, ImportCSVMixin):
     change_list_template = "shopapp/orders_changelist.html"
+    import_job_kind = ImportJob.KIND_ORDERS
 
     inlines = [
         ProductInline,
@@ -125,34 +128,60 @@ class OrderAdmin(admin.ModelAdmin):
     def user_verbose(self, obj: Order) -> str:
         return obj.user.first_name or obj.user.username
 
-    def import_csv(self, request: HttpRequest) -> HttpResponse:
-        if request.method == "GET":
-            form = CSVImportForm()
-            context = {
-                "form": form,
-            }
-            return render(request, "admin/csv_form.html", context)
-        form = CSVImportForm(request.POST, request.FILES)
-        if not form.is_valid():
-            context = {
-                "form": form,
-            }
-            return render(request, "admin/csv_form.html", context, status=400)
-        save_csv_orders(
-            file=form.files["csv_file"].file,
-            encoding=request.encoding,
-        )
-
-        self.message_user(request, "Data from CSV was imported")
-        return redirect("..")
+    def has_import_permission(self, request: HttpRequest) -> bool:
+        # the orders import only creates rows
+        return self.has_add_permission(request)
 
     def get_urls(self):
         urls = super().get_urls()
         new_urls = [
             path(
                 "import-orders-csv/",
-                self.import_csv,
+                self.admin_site.admin_view(self.import_csv),
                 name="import_orders_csv"
             ),
         ]
         return new_urls + urls
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = "pk", "kind", "status", "rows_done", "rows_rejected", "created_by", "created_at", "finished_at"
+    list_filter = "kind", "status"
+    readonly_fields = [field.name for field in ImportJob._meta.fields]
+
+    def has_add_permission(self, request: HttpRequest) -> bool:
+        return False
+
+    def progress_view(self, request: HttpRequest, pk: int) -> HttpResponse:
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        job = get_object_or_404(ImportJob, pk=pk)
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "job": job,
+        }
+        return render(request, "admin/import_job_progress.html", context)
+
+    def status_view(self, request: HttpRequest, pk: int) -> JsonResponse:
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        job = get_object_or_404(ImportJob, pk=pk)
+        return JsonResponse(job.as_dict())
+
+    def get_urls(self):
+        urls = super().get_urls()
+        new_urls = [
+            path(
+                "<int:pk>/progress/",
+                self.admin_site.admin_view(self.progress_view),
+                name="shopapp_importjob_progress",
+            ),
+            path(
+                "<int:pk>/status/",
+                self.admin_site.admin_view(self.status_view),
+                name="shopapp_importjob_status",
+            ),
+        ]
+        return new_urls + urls
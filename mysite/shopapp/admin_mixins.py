@@ -1,25 +1,75 @@
-import csv
+from typing import List, Optional, Sequence
 
+from django.core.exceptions import PermissionDenied
 from django.db.models import QuerySet
 from django.db.models.options import Options
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect
+
+from .exports import stream_queryset_export
+from .forms import CSVImportForm
+from .jobs import enqueue_import
 
 
 class ExportAsCSVMixin:
-    def export_csv(self, request: HttpRequest, queryset:QuerySet):
+    """
+    Admin action streaming the selected objects as CSV from one values_list query.
+    Foreign keys are exported as raw *_id values; export_fields may add
+    pre-joined columns such as "created_by__username"
+    """
+    export_fields: Optional[Sequence[str]] = None
+
+    def get_export_fields(self) -> List[str]:
+        if self.export_fields is not None:
+            return list(self.export_fields)
+        meta: Options = self.model._meta
+        return [field.attname for field in meta.concrete_fields]
+
+    def export_csv(self, request: HttpRequest, queryset: QuerySet) -> StreamingHttpResponse:
         meta: Options = self.model._meta
-        field_names = [field.name for field in meta.fields]
+        return stream_queryset_export(
+            request,
+            queryset,
+            self.get_export_fields(),
+            fmt="csv",
+            filename=f"{meta}-export",
+        )
 
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = f"attachment; filename={meta}-export.csv"
+    export_csv.short_description = "Export as CSV"
 
-        csv_writer = csv.writer(response)
 
-        csv_writer.writerow(field_names)
+class ImportCSVMixin:
+    """
+    Admin view for CSV import: the file is queued as an ImportJob
+    and the user is sent to the job progress page
+    """
+    import_job_kind: str
 
-        for obj in queryset:
-            csv_writer.writerow([getattr(obj, field) for field in field_names])
+    def has_import_permission(self, request: HttpRequest) -> bool:
+        # imports both create and update rows
+        return self.has_add_permission(request) and self.has_change_permission(request)
 
-        return response
+    def import_csv(self, request: HttpRequest) -> HttpResponse:
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        if request.method == "GET":
+            form = CSVImportForm()
+            context = {
+                "form": form,
+            }
+            return render(request, "admin/csv_form.html", context)
+        form = CSVImportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            context = {
+                "form": form,
+            }
+            return render(request, "admin/csv_form.html", context, status=400)
+        job = enqueue_import(
+            kind=self.import_job_kind,
+            uploaded_file=form.files["csv_file"],
+            encoding=request.encoding,
+            user=request.user,
+        )
 
-    export_csv.short_description = "Export as CSV"
\ No newline at end of file
+        self.message_user(request, f"CSV import was queued as job #{job.pk}")
+        return redirect("admin:shopapp_importjob_progress", job.pk)
@@ -0,0 +1,316 @@
+"""
+Примеси для наборов представлений API магазина.
+
+Queryset строится по полям, которые прочитает сериализатор (с учётом
+?fields= и ?omit=), а число запросов к базе на каждое действие ограничено
+бюджетом. Списки объектов пишутся пакетно через {prefix}/bulk/.
+"""
+import logging
+from typing import Dict, Iterable, Optional, Sequence, Type
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Model, Prefetch, QuerySet
+from django.http import Http404
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import Field
+from rest_framework.permissions import BasePermission
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.response import Response
+
+from .caching import bump_generation, response_cache_key
+from .fast_serializers import ReadPlan, read_plan
+
+log = logging.getLogger(__name__)
+
+READ_ACTIONS = ("list", "retrieve")
+
+
+def serializer_queryset(queryset: QuerySet, fields: Iterable[Field]) -> QuerySet:
+    """
+    Загружает только колонки, которые читают поля сериализатора,
+    а связи многие-ко-многим подтягивает одним запросом на страницу
+    """
+    meta = queryset.model._meta
+    only = {meta.pk.name}
+    prefetch = []
+    select = []
+    for field in fields:
+        if field.write_only:
+            continue
+        if field.source == "pk":
+            continue
+        try:
+            model_field = meta.get_field(field.source)
+        except FieldDoesNotExist:
+            # properties, methods and "a.b" sources may read any column
+            only = None
+            continue
+        if model_field.many_to_many or model_field.one_to_many:
+            if isinstance(field, ManyRelatedField) and isinstance(field.child_relation, PrimaryKeyRelatedField):
+                related = model_field.related_model.objects.only(model_field.related_model._meta.pk.name)
+                prefetch.append(Prefetch(field.source, queryset=related))
+            else:
+                prefetch.append(field.source)
+            continue
+        if model_field.is_relation and not isinstance(field, PrimaryKeyRelatedField):
+            select.append(field.source)
+            only = None
+            continue
+        if only is not None:
+            only.add(model_field.name)
+    if only is not None:
+        queryset = queryset.only(*only)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+class SerializerQuerysetMixin:
+    """
+    Для list и retrieve сужает queryset до полей сериализатора.
+    Изменяющие действия получают полные объекты, иначе save() не запишет
+    отложенные поля вроде updated_at
+    """
+    def get_queryset_fields(self) -> Iterable[Field]:
+        return self.get_serializer().fields.values()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if getattr(self, "action", None) in READ_ACTIONS:
+            queryset = serializer_queryset(queryset, self.get_queryset_fields())
+        return queryset
+
+
+class SparseFieldsetMixin:
+    """
+    Параметры ?fields=pk,name и ?omit=description для list и retrieve:
+    лишние поля убираются из сериализатора, а значит и из запроса
+    """
+    fields_query_param = "fields"
+    omit_query_param = "omit"
+
+    def get_requested_fields(self, param: str) -> Optional[list]:
+        value = self.request.query_params.get(param)
+        if not value:
+            return None
+        return [name.strip() for name in value.split(",") if name.strip()]
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if getattr(self, "action", None) in READ_ACTIONS:
+            self.prune_fields(getattr(serializer, "child", serializer).fields)
+        return serializer
+
+    def prune_fields(self, fields) -> None:
+        keep = self.get_requested_fields(self.fields_query_param)
+        omit = self.get_requested_fields(self.omit_query_param) or []
+        for param, names in ((self.fields_query_param, keep or []), (self.omit_query_param, omit)):
+            unknown = [name for name in names if name not in fields]
+            if unknown:
+                raise ValidationError({param: f"Unknown fields: {', '.join(unknown)}"})
+        for name in list(fields.keys()):
+            if (keep is not None and name not in keep) or name in omit:
+                fields.pop(name)
+
+
+class FastReadMixin:
+    """
+    С fast_read = True list и retrieve читают строки через values_list
+    и заранее построенные преобразователи полей, без экземпляров моделей.
+    Если сериализатор нельзя так прочитать, работает обычный путь.
+    retrieve с проверками прав на объект тоже идёт обычным путём:
+    им нужен экземпляр модели, а не строка
+    """
+    fast_read = False
+
+    def get_read_plan(self) -> Optional[ReadPlan]:
+        if not self.fast_read:
+            return None
+        serializer = self.get_serializer()
+        return read_plan(self.get_queryset().model, serializer)
+
+    def checks_object_permissions(self) -> bool:
+        return any(
+            type(permission).has_object_permission is not BasePermission.has_object_permission
+            for permission in self.get_permissions()
+        )
+
+    def list(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        queryset = plan.prepare(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(plan.serialize(page, request))
+        return Response(plan.serialize(queryset, request))
+
+    def retrieve(self, request, *args, **kwargs):
+        plan = None if self.checks_object_permissions() else self.get_read_plan()
+        if plan is None:
+            return super().retrieve(request, *args, **kwargs)
+        queryset = plan.prepare(self.filter_queryset(self.get_queryset()))
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        rows = list(queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})[:1])
+        if not rows:
+            raise Http404(f"No {plan.model._meta.object_name} matches the given query.")
+        return Response(plan.serialize(rows, request)[0])
+
+
+class ResponseCacheMixin:
+    """
+    Кэширует данные ответов действий cache_actions. Ключ строится из схемы,
+    хоста и пути (в данных абсолютные ссылки), формата, пользователя,
+    отсортированных параметров запроса и поколений cache_models, поэтому
+    запись в эти модели сразу видна клиентам
+    """
+    cache_actions: Sequence[str] = ("list",)
+    cache_timeout = 60 * 60 * 6
+    cache_models: Sequence[Type[Model]] = ()
+
+    def get_cache_models(self) -> Sequence[Type[Model]]:
+        return self.cache_models or (self.queryset.model,)
+
+    def get_response_cache_key(self, request) -> str:
+        params = sorted(
+            (name, value)
+            for name, values in request.query_params.lists()
+            for value in values
+            if value != ""
+        )
+        user = request.user.pk if request.user.is_authenticated else None
+        parts = [
+            request.scheme, request.get_host(), request.path, self.action, request.accepted_media_type, user, params,
+        ]
+        return response_cache_key("api_response", parts, self.get_cache_models())
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if self.action not in self.cache_actions:
+            return handler(request, *args, **kwargs)
+        cache_key = self.get_response_cache_key(request)
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(cache_key, response.data, self.cache_timeout)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMixin:
+    """
+    Ограничивает число запросов действия: query_budget = {"list": 3}.
+    Запросы считаются после аутентификации и проверки прав. Превышение
+    пишется в лог, а при QUERY_BUDGET_RAISE = True (в тестах) вызывает
+    QueryBudgetExceeded
+    """
+    query_budget: Dict[str, int] = {}
+
+    def get_query_budget(self) -> Optional[int]:
+        return self.query_budget.get(getattr(self, "action", None))
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.get_query_budget() is not None:
+            self.query_counter = QueryCounter()
+            self.query_wrapper = connection.execute_wrapper(self.query_counter)
+            self.query_wrapper.__enter__()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.remove_query_counter():
+            self.check_query_budget(request, self.query_counter.count)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # an exception DRF does not handle skips finalize_response
+            self.remove_query_counter()
+
+    def remove_query_counter(self) -> bool:
+        wrapper = getattr(self, "query_wrapper", None)
+        if wrapper is None:
+            return False
+        self.query_wrapper = None
+        wrapper.__exit__(None, None, None)
+        return True
+
+    def check_query_budget(self, request, count: int) -> None:
+        budget = self.get_query_budget()
+        if count <= budget:
+            return
+        message = (
+            f"{type(self).__name__}.{self.action} ran {count} queries, "
+            f"budget is {budget} ({request.get_full_path()})"
+        )
+        if getattr(settings, "QUERY_BUDGET_RAISE", False):
+            raise QueryBudgetExceeded(message)
+        log.warning(message)
+
+
+class BulkWriteMixin:
+    """
+    POST, PUT и PATCH на {prefix}/bulk/ со списком объектов. Список
+    проверяется сериализатором с many=True и пишется одной транзакцией
+    через bulk_create или bulk_update (list_serializer_class сериализатора
+    должен их поддерживать, см. BulkListSerializer). Для PUT и PATCH
+    у каждого элемента есть pk. Ответ - список записанных объектов в порядке
+    запроса, при ошибках - 400 со списком ошибок по элементам
+    """
+    bulk_max_items = 10000
+
+    @action(detail=False, methods=["post", "put", "patch"], url_path="bulk")
+    def bulk(self, request, *args, **kwargs):
+        options = {"many": True, "allow_empty": False, "max_length": self.bulk_max_items}
+        if request.method == "POST":
+            serializer = self.get_serializer(data=request.data, **options)
+        else:
+            serializer = self.get_serializer(
+                self.filter_queryset(self.get_queryset()),
+                data=request.data,
+                partial=request.method == "PATCH",
+                **options,
+            )
+        serializer.is_valid(raise_exception=True)
+        self.perform_bulk_save(serializer)
+        code = status.HTTP_201_CREATED if request.method == "POST" else status.HTTP_200_OK
+        return Response(serializer.data, status=code)
+
+    def perform_bulk_save(self, serializer) -> None:
+        # bulk writes send no model signals
+        with transaction.atomic():
+            serializer.save()
+            self.after_bulk_save(serializer)
+            bump_generation(serializer.child.Meta.model)
+
+    def after_bulk_save(self, serializer) -> None:
+        """
+        Зависимые данные (индексы, сводки) в той же транзакции
+        """
@@ -0,0 +1,148 @@
+"""
+Кэш ответов, который сбрасывается при записи.
+
+Значения в кэше помечаются тегами, у каждого тега есть счётчик версий.
+Тег модели ("product:*") двигается при любой её записи (сигналы,
+queryset.update, пакетный импорт), узкие теги вроде "order:user:<id>" —
+при записи только своих объектов. Значение, собранное при других версиях
+тегов, недостижимо, поэтому его можно хранить часами, а сброс стоит одну
+запись счётчика, сколько бы ключей ни было помечено тегом.
+
+get_or_compute защищает дорогие значения от лавины пересчётов: значение
+пересчитывает один процесс (блокировка на ключ в кэше), остальные тем
+временем получают прежнее, а незадолго до истечения пересчёт запускается
+заранее с вероятностью, растущей к сроку (XFetch).
+"""
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, List, Optional, Type
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Model
+
+
+def model_tag(model: Type[Model]) -> str:
+    return f"{model._meta.model_name}:*"
+
+
+def user_orders_tag(user_id: int) -> str:
+    return f"order:user:{user_id}"
+
+
+def tag_key(tag: str) -> str:
+    return f"tag:{tag}"
+
+
+def tag_versions(tags: Iterable[str]) -> List[int]:
+    """
+    Текущие версии тегов одним обращением к кэшу
+    """
+    keys = [tag_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # a lost counter restarts from the clock, never from a value already used
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_tags(*tags: str) -> None:
+    """
+    Делает недействительными значения, помеченные тегами tags.
+    Внутри транзакции счётчики двигаются ещё раз после её фиксации:
+    значение, собранное до фиксации, могло попасть в кэш с новой версией
+    """
+    def bump():
+        # the clock gives a fresh value without a read-modify-write race
+        cache.set_many({tag_key(tag): time.time_ns() for tag in tags}, None)
+    bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def model_generations(models: Iterable[Type[Model]]) -> List[int]:
+    return tag_versions(model_tag(model) for model in models)
+
+
+def bump_generation(*models: Type[Model]) -> None:
+    bump_tags(*(model_tag(model) for model in models))
+
+
+def response_cache_key(prefix: str, parts: list, models: Iterable[Type[Model]]) -> str:
+    raw = json.dumps([parts, model_generations(models)], sort_keys=True, default=str)
+    return f"{prefix}:{hashlib.sha256(raw.encode()).hexdigest()[:40]}"
+
+
+LOCK_POLL_INTERVAL = 0.05
+
+
+@dataclass
+class Computed:
+    """
+    Значение в кэше вместе со временем его вычисления, мягким сроком
+    и версиями тегов, при которых оно собрано
+    """
+    value: Any
+    delta: float
+    expires: float
+    versions: List[int] = field(default_factory=list)
+
+    def needs_refresh(self, beta: float) -> bool:
+        # XFetch: the slower the computation, the earlier some request refreshes it
+        return time.time() - self.delta * beta * math.log(1 - random.random()) >= self.expires
+
+
+def get_or_compute(
+    key: str,
+    compute: Callable[[], Any],
+    timeout: int,
+    stale_timeout: Optional[int] = None,
+    lock_timeout: int = 30,
+    beta: float = 1.0,
+    tags: Iterable[str] = (),
+) -> Any:
+    """
+    Значение из кэша или compute(), который в один момент выполняется
+    для ключа только в одном процессе.
+
+    Значение свежо timeout секунд и ещё stale_timeout (по умолчанию столько
+    же) отдаётся, пока его пересчитывает тот, кто взял блокировку. Без
+    значения в кэше остальные ждут его не дольше lock_timeout. Значение,
+    собранное до сброса любого из тегов tags, не отдаётся
+    """
+    if stale_timeout is None:
+        stale_timeout = timeout
+    lock_key = f"{key}:lock"
+    tags = list(tags)
+    while True:
+        # read before computing: a write during the computation leaves the value stale
+        versions = tag_versions(tags)
+        entry = cache.get(key)
+        # entries written before the envelope are treated as missing
+        if not isinstance(entry, Computed) or entry.versions != versions:
+            entry = None
+        if entry is not None and not entry.needs_refresh(beta):
+            return entry.value
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, lock_timeout):
+            break
+        if entry is not None:
+            return entry.value
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    try:
+        started = time.monotonic()
+        value = compute()
+        delta = time.monotonic() - started
+        cache.set(key, Computed(value, delta, time.time() + timeout, versions), timeout + stale_timeout)
+        return value
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
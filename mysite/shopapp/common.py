@@ -1,61 +1,538 @@
-from csv import DictReader
-from io import TextIOWrapper
+import time
+from csv import DictReader, reader as csv_reader
+from dataclasses import dataclass, field
+from io import StringIO, TextIOWrapper
+from random import random
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, TypeVar
 
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import BooleanField, Field, Model
+from django.utils import timezone
+
+from shopapp.caching import bump_generation, bump_tags, model_tag, user_orders_tag
+from shopapp.rollups import order_day, refresh_product_rollups, refresh_rollups
+from shopapp.search import index_products, index_products_after
 from shopapp.models import Product, Order
 from django.contrib.auth.models import User
 
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+# SQLite fails immediately when two writers upgrade their locks at once
+LOCKED_RETRIES = 8
+LOCKED_BACKOFF = 0.05
+SCAN_BLOCK_SIZE = 1024 * 1024
+ProgressCallback = Callable[["ImportResult"], None]
+T = TypeVar("T")
+BOOLEAN_VALUES = {
+    "true": "1",
+    "yes": "1",
+    "false": "0",
+    "no": "0",
+}
+
+
+@dataclass
+class ImportResult:
+    """
+    Итог импорта: сколько строк вставлено, обновлено и отклонено
+    """
+    inserted: int = 0
+    updated: int = 0
+    rejected: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+
+    @property
+    def processed(self) -> int:
+        return self.inserted + self.updated + self.rejected
+
+    def reject(self, line: int, message: str, count: int = 1) -> None:
+        self.rejected += count
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "rejected": self.rejected,
+            "errors": [
+                {"line": line, "message": message}
+                for line, message in self.errors
+            ],
+        }
+
+
+def import_fields(model: Type[Model], header: Iterable[str]) -> Dict[str, Field]:
+    """
+    Сопоставляет колонки CSV с полями модели, неизвестные колонки - ошибка
+    """
+    fields = {}
+    unknown = []
+    for column in header:
+        try:
+            model_field = model._meta.get_field(column)
+        except FieldDoesNotExist:
+            model_field = None
+        if model_field is None or not model_field.concrete or model_field.primary_key:
+            unknown.append(column)
+            continue
+        fields[column] = model_field
+    if unknown:
+        raise ValueError(f"Unknown {model._meta.model_name} columns: {', '.join(unknown)}")
+    return fields
+
+
+def coerce_row(row: dict, fields: Dict[str, Field]) -> dict:
+    """
+    Приводит строковые значения CSV к типам полей модели.
+    Пустые значения пропускаются, чтобы сработал default поля
+    """
+    values = {}
+    for column, model_field in fields.items():
+        raw = row.get(column)
+        # a blank cell leaves the field alone: its default on insert, the stored value on update
+        if raw is None or raw == "":
+            continue
+        if isinstance(model_field, BooleanField):
+            raw = BOOLEAN_VALUES.get(raw.strip().lower(), raw)
+        if model_field.is_relation:
+            values[model_field.attname] = model_field.target_field.clean(raw, None)
+        else:
+            values[model_field.attname] = model_field.clean(raw, None)
+    return values
+
+
+def iter_batches(rows: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def atomic_retry(func: Callable[[], T]) -> T:
+    """
+    Выполняет func в транзакции. Если база SQLite занята другим
+    процессом импорта, транзакция повторяется с нарастающей паузой
+    """
+    for attempt in range(LOCKED_RETRIES):
+        try:
+            with transaction.atomic():
+                return func()
+        except OperationalError as exc:
+            # inside an outer transaction a retry can't help
+            if "locked" not in str(exc) or attempt == LOCKED_RETRIES - 1 or connection.in_atomic_block:
+                raise
+            time.sleep(LOCKED_BACKOFF * 2 ** attempt * (1 + random()))
 
-def save_csv_products(file, encoding):
+
+def upsert_products(rows: List[Tuple[int, dict]], key: Optional[str]) -> Tuple[int, int]:
+    """
+    Вставляет и обновляет товары пачки, возвращает (вставлено, обновлено)
+    """
+    existing = {}
+    if key is not None:
+        keys = {values[key] for _, values in rows if key in values}
+        columns = {column for _, values in rows for column in values}
+        queryset = (
+            Product.objects
+            .filter(**{f"{key}__in": keys})
+            .only(*columns)
+            .order_by("pk")
+        )
+        for product in queryset:
+            existing.setdefault(getattr(product, key), product)
+
+    to_create = []
+    to_update = {}
+    update_fields = set()
+    updated = 0
+    for _, values in rows:
+        product = existing.get(values.get(key)) if key is not None else None
+        if product is None:
+            product = Product(**values)
+            to_create.append(product)
+            if key is not None and key in values:
+                existing[values[key]] = product
+            continue
+        for column, value in values.items():
+            setattr(product, column, value)
+        update_fields.update(values)
+        updated += 1
+        if product.pk is not None:
+            to_update[product.pk] = product
+
+    Product.objects.bulk_create(to_create)
+    update_fields.discard(key)
+    if to_update and update_fields:
+        # bulk_update bypasses auto_now
+        now = timezone.now()
+        for product in to_update.values():
+            product.updated_at = now
+        update_fields.add("updated_at")
+        Product.objects.bulk_update(list(to_update.values()), fields=sorted(update_fields))
+        if "price" in update_fields:
+            refresh_product_rollups(to_update)
+    index_products([product.pk for product in to_create] + list(to_update))
+    return len(to_create), updated
+
+
+def write_products_batch(rows: List[Tuple[int, dict]], key: Optional[str], result: ImportResult) -> None:
+    """
+    Записывает пачку уже приведённых строк в одной транзакции.
+    Если key задан, существующие товары с тем же значением key обновляются
+    """
+    first_line = rows[0][0]
+    try:
+        inserted, updated = atomic_retry(lambda: upsert_products(rows, key))
+    except DatabaseError as exc:
+        result.reject(first_line, f"Batch from line {first_line} failed: {exc}", count=len(rows))
+        return
+    bump_generation(Product)
+    result.inserted += inserted
+    result.updated += updated
+
+
+def save_csv_products(
+    file,
+    encoding,
+    key: Optional[str] = "name",
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[ProgressCallback] = None,
+) -> ImportResult:
+    """
+    Потоково загружает товары из CSV пачками по batch_size строк.
+    Каждая пачка пишется в своей транзакции, строки с ошибками отклоняются.
+    progress вызывается после каждой пачки с текущим итогом
+    """
     csv_file = TextIOWrapper(
         file,
         encoding=encoding,
     )
     reader = DictReader(csv_file)
+    fields = import_fields(Product, reader.fieldnames or [])
+    if key is not None and key not in fields:
+        raise ValueError(f"Key column {key!r} is missing in CSV")
+    result = ImportResult()
 
-    products = [
-        Product(**row)
-        for row in reader
-    ]
-    Product.objects.bulk_create(products)
-    return products
+    def coerced_rows():
+        # line 1 is the header
+        for line, row in enumerate(reader, start=2):
+            try:
+                yield line, coerce_row(row, fields)
+            except ValidationError as exc:
+                result.reject(line, "; ".join(exc.messages))
+
+    for batch in iter_batches(coerced_rows(), batch_size):
+        write_products_batch(batch, key, result)
+        if progress is not None:
+            progress(result)
+    return result
+
+
+def write_orders_batch(rows: List[Tuple[int, dict]], fields: Dict[str, Field], result: ImportResult) -> None:
+    """
+    Записывает пачку заказов: пользователи и товары пачки ищутся
+    одним запросом каждые, заказы и связи с товарами создаются через bulk_create
+    """
+    usernames = {row.get("user") for _, row in rows}
+    product_names = {name for _, row in rows for name in row.get("products") or () if name}
+    users = dict(
+        User.objects
+        .filter(username__in=usernames)
+        .values_list("username", "pk")
+    )
+    products = dict(
+        Product.objects
+        .filter(name__in=product_names)
+        .order_by("-pk")
+        .values_list("name", "pk")
+    )
 
+    orders = []
+    for line, row in rows:
+        user_id = users.get(row.get("user"))
+        if user_id is None:
+            result.reject(line, f"Unknown user {row.get('user')!r}")
+            continue
+        names = [name for name in row.get("products") or () if name]
+        missing = [name for name in names if name not in products]
+        if missing:
+            result.reject(line, f"Unknown products: {', '.join(missing)}")
+            continue
+        try:
+            values = coerce_row(row, fields)
+        except ValidationError as exc:
+            result.reject(line, "; ".join(exc.messages))
+            continue
+        values["user_id"] = user_id
+        orders.append((values, dict.fromkeys(products[name] for name in names)))
 
-def save_csv_orders(file, encoding):
+    if not orders:
+        return
+    try:
+        atomic_retry(lambda: create_orders(orders))
+    except DatabaseError as exc:
+        first_line = rows[0][0]
+        result.reject(first_line, f"Batch from line {first_line} failed: {exc}", count=len(orders))
+        return
+    bump_tags(model_tag(Order), *{user_orders_tag(values["user_id"]) for values, _ in orders})
+    result.inserted += len(orders)
+
+
+def create_orders(orders: List[Tuple[dict, Iterable[int]]]) -> None:
+    """
+    Создаёт заказы и их связи с товарами двумя bulk_create
+    """
+    OrderProduct = Order.products.through
+    created = Order.objects.bulk_create([Order(**values) for values, _ in orders])
+    OrderProduct.objects.bulk_create([
+        OrderProduct(order_id=order.pk, product_id=product_id)
+        for order, (_, product_ids) in zip(created, orders)
+        for product_id in product_ids
+    ])
+    refresh_rollups({order_day(order) for order in created})
+
+
+def save_csv_orders(
+    file,
+    encoding,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[ProgressCallback] = None,
+) -> ImportResult:
+    """
+    Загружает заказы из CSV: колонка user содержит username,
+    все колонки после заголовка - названия товаров заказа.
+    Число запросов постоянно для каждой пачки и не зависит от числа строк
+    """
     csv_file = TextIOWrapper(
         file,
         encoding=encoding,
     )
     reader = DictReader(csv_file, restkey="products")
-    proceeded = list()
+    header = reader.fieldnames or []
+    if "user" not in header:
+        raise ValueError("Column 'user' is missing in CSV")
+    fields = import_fields(Order, [column for column in header if column != "user"])
+    result = ImportResult()
+    # line 1 is the header
+    for batch in iter_batches(enumerate(reader, start=2), batch_size):
+        write_orders_batch(batch, fields, result)
+        if progress is not None:
+            progress(result)
+    return result
+
+
+def split_csv_file(path: str, chunk_bytes: int) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """
+    Делит CSV файл на диапазоны байтов примерно по chunk_bytes.
+    Границы ставятся только на переводах строк вне кавычек, так что
+    каждый диапазон содержит целые записи. Возвращает (заголовок, диапазоны)
+    """
+    with open(path, "rb") as file:
+        # quoted header cells with line breaks are not supported
+        header = next(reader_from_bytes(file.readline(), None))
+        start = position = file.tell()
+        target = start + chunk_bytes
+        ranges = []
+        in_quotes = False
+        while True:
+            block = file.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            offset = 0
+            while offset < len(block):
+                if position + offset < target:
+                    skip_to = min(target - position, len(block))
+                    in_quotes ^= block.count(b'"', offset, skip_to) % 2 == 1
+                    offset = skip_to
+                    continue
+                newline = block.find(b"\n", offset)
+                if newline == -1:
+                    in_quotes ^= block.count(b'"', offset) % 2 == 1
+                    break
+                in_quotes ^= block.count(b'"', offset, newline) % 2 == 1
+                offset = newline + 1
+                if not in_quotes:
+                    ranges.append((start, position + offset))
+                    start = position + offset
+                    target = start + chunk_bytes
+            position += len(block)
+        if start < position:
+            ranges.append((start, position))
+    return header, ranges
+
+
+def reader_from_bytes(data: bytes, encoding: Optional[str], fieldnames: Optional[List[str]] = None):
+    text = data.decode(encoding or "utf-8-sig")
+    if fieldnames is None:
+        return csv_reader(StringIO(text, newline=""))
+    return DictReader(StringIO(text, newline=""), fieldnames=fieldnames)
+
+
+def product_insert_fields() -> List[Field]:
+    return [model_field for model_field in Product._meta.concrete_fields if not model_field.primary_key]
+
+
+def prepared_defaults(fields: List[Field], now) -> list:
+    """
+    Значения для INSERT по умолчанию: default поля, для auto_now - now
+    """
+    return [
+        model_field.get_db_prep_save(
+            now if getattr(model_field, "auto_now", False) else model_field.get_default(),
+            connection,
+        )
+        for model_field in fields
+    ]
+
+
+class PreparedRow(NamedTuple):
+    # values for INSERT over all fields and the indexes of those filled from the CSV
+    values: tuple
+    present: FrozenSet[int]
+
+
+def prepare_product_row(values: dict, fields: List[Field], defaults: list) -> PreparedRow:
+    """
+    Готовит значения для INSERT по всем полям fields,
+    пропущенные колонки берутся из defaults
+    """
+    row = list(defaults)
+    present = set()
+    for index, model_field in enumerate(fields):
+        if model_field.attname in values:
+            row[index] = model_field.get_db_prep_save(values[model_field.attname], connection)
+            present.add(index)
+    return PreparedRow(tuple(row), frozenset(present))
+
+
+def parse_products_chunk(
+    path: str, start: int, end: int, header: List[str], encoding: Optional[str],
+) -> Tuple[list, list, int]:
+    """
+    Читает, проверяет и готовит к записи строки одного диапазона файла.
+    Выполняется в дочерних процессах, чтобы писатель только исполнял SQL.
+    Возвращает (список (строка файла от начала диапазона, значения для INSERT),
+    ошибки, число строк файла в диапазоне): записи с переводами строк
+    в кавычках занимают несколько строк файла
+    """
+    fields = import_fields(Product, header)
+    insert_fields = product_insert_fields()
+    defaults = prepared_defaults(insert_fields, timezone.now())
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    rows = []
+    errors = []
+    reader = reader_from_bytes(data, encoding, header)
+    line = 0
     for row in reader:
-        proceeded_row = dict()
-        for key, value in row.items():
-            if key == "user":
-                user = User.objects.get(username=value)
-                proceeded_row[key] = user
-            elif key != "products":
-                proceeded_row[key] = value
-        if len(proceeded_row) != 0:
-            proceeded.append(proceeded_row)
-
-    orders = [Order(**row) for row in proceeded]
-
-    csv_file.seek(0)
-    for index, row in enumerate(reader):
-        for key, value in row.items():
-            if key == "products":
-                products = list()
-                for product_name in value:
-                    products.append(Product.objects.get(name=product_name))
-                proceeded[index-1][key] = products
-
-    orders_old_pks = [order.pk for order in orders]
-    for order in orders:
-        order.save()
-    new_orders = [order for order in orders if order.pk not in orders_old_pks]
-    print(new_orders)
-
-    for index, order in enumerate(new_orders):
-        order.products.set(proceeded[index]["products"])
-
-    return orders
+        try:
+            rows.append((line, prepare_product_row(coerce_row(row, fields), insert_fields, defaults)))
+        except ValidationError as exc:
+            errors.append((line, "; ".join(exc.messages)))
+        line = reader.line_num
+    return rows, errors, reader.line_num
+
+
+def upsert_prepared_products(rows: List[Tuple[int, PreparedRow]], key: Optional[str], columns: Iterable[str]) -> Tuple[int, int]:
+    """
+    Пишет строки parse_products_chunk через executemany.
+    Для товаров с существующим key обновляются только колонки columns;
+    пустые ячейки оставляют прежние значения, как в save_csv_products.
+    Возвращает (вставлено, обновлено)
+    """
+    fields = product_insert_fields()
+    attnames = [model_field.attname for model_field in fields]
+    key_index = attnames.index(Product._meta.get_field(key).attname) if key is not None else None
+    update_indexes = [
+        index for index, model_field in enumerate(fields)
+        if index != key_index and (model_field.attname in columns or model_field.name in columns
+                                   or getattr(model_field, "auto_now", False))
+    ]
+    quote = connection.ops.quote_name
+    table = quote(Product._meta.db_table)
+
+    existing = {}
+    if key_index is not None:
+        key_field = fields[key_index]
+        keys = {row.values[key_index] for _, row in rows}
+        queryset = (
+            Product.objects
+            .filter(**{f"{key_field.attname}__in": keys})
+            .order_by("pk")
+            .values_list(key_field.attname, "pk")
+        )
+        for value, pk in queryset:
+            existing.setdefault(key_field.get_db_prep_save(value, connection), pk)
+
+    new = {}
+    # rows with the same filled columns share one UPDATE statement
+    updates = {}
+    for index, row in rows:
+        pk = existing.get(row.values[key_index]) if key_index is not None else None
+        if pk is None:
+            new[row.values[key_index] if key_index is not None else index] = row.values
+            continue
+        if any(i in row.present for i in update_indexes):
+            set_indexes = tuple(i for i in update_indexes if i in row.present or getattr(fields[i], "auto_now", False))
+            updates.setdefault(set_indexes, []).append(tuple(row.values[i] for i in set_indexes) + (pk,))
+
+    with connection.cursor() as cursor:
+        # rows inserted below get ids above the current maximum
+        cursor.execute("SELECT COALESCE(MAX(%s), 0) FROM %s" % (quote(Product._meta.pk.column), table))
+        last_pk = cursor.fetchone()[0]
+        if new:
+            cursor.executemany(
+                "INSERT INTO %s (%s) VALUES (%s)" % (
+                    table,
+                    ", ".join(quote(field.column) for field in fields),
+                    ", ".join(["%s"] * len(fields)),
+                ),
+                list(new.values()),
+            )
+        for set_indexes, params in updates.items():
+            cursor.executemany(
+                "UPDATE %s SET %s WHERE %s = %%s" % (
+                    table,
+                    ", ".join("%s = %%s" % quote(fields[i].column) for i in set_indexes),
+                    quote(Product._meta.pk.column),
+                ),
+                params,
+            )
+    if new:
+        index_products_after(last_pk)
+    if updates:
+        index_products(update[-1] for params in updates.values() for update in params)
+        repriced = [
+            update[-1]
+            for set_indexes, params in updates.items()
+            if any(fields[index].name == "price" for index in set_indexes)
+            for update in params
+        ]
+        if repriced:
+            refresh_product_rollups(repriced)
+    # later duplicates of a new key replace the earlier row
+    return len(new), len(rows) - len(new)
+
+
+def write_prepared_products_batch(
+    rows: List[Tuple[int, PreparedRow]],
+    key: Optional[str],
+    columns: Iterable[str],
+    result: ImportResult,
+) -> None:
+    first_line = rows[0][0]
+    try:
+        inserted, updated = atomic_retry(lambda: upsert_prepared_products(rows, key, columns))
+    except DatabaseError as exc:
+        result.reject(first_line, f"Batch from line {first_line} failed: {exc}", count=len(rows))
+        return
+    bump_generation(Product)
+    result.inserted += inserted
+    result.updated += updated
@@ -0,0 +1,52 @@
+"""
+Валидаторы для условных GET-запросов (ETag, Last-Modified и 304).
+
+Версия берётся из updated_at одним запросом по индексу, без сериализации
+и рендеринга шаблонов. Для списка в ETag входит и число строк: удаление
+товара не меняет MAX(updated_at), поэтому Last-Modified у списка нет.
+Функции подходят для django.views.decorators.http.condition.
+"""
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+from django.db.models import Count, Max
+from django.http import HttpRequest
+
+from .models import Product
+
+
+def make_etag(request: HttpRequest, version: datetime, *extra) -> str:
+    """
+    ETag зависит от версии строки и от представления: пути с параметрами
+    (язык, ?fields=) и запрошенного формата
+    """
+    raw = "|".join((
+        version.isoformat(), *map(str, extra), request.get_full_path(), request.META.get("HTTP_ACCEPT", ""),
+    ))
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def product_version(request: HttpRequest, pk) -> Optional[datetime]:
+    # condition() asks for the ETag and Last-Modified separately, one query serves both
+    versions = request.__dict__.setdefault("_product_versions", {})
+    if pk not in versions:
+        versions[pk] = Product.objects.filter(pk=pk).values_list("updated_at", flat=True).first()
+    return versions[pk]
+
+
+def product_etag(request: HttpRequest, pk, *args, **kwargs) -> Optional[str]:
+    version = product_version(request, pk)
+    return make_etag(request, version) if version is not None else None
+
+
+def product_last_modified(request: HttpRequest, pk, *args, **kwargs) -> Optional[datetime]:
+    return product_version(request, pk)
+
+
+def products_etag(request: HttpRequest, *args, **kwargs) -> Optional[str]:
+    # hard deletes leave MAX(updated_at) alone, the row count catches them
+    version = Product.objects.aggregate(version=Max("updated_at"), count=Count("pk"))
+    if version["version"] is None:
+        return None
+    return make_etag(request, version["version"], version["count"])
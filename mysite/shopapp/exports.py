@@ -0,0 +1,425 @@
+"""
+Потоковая выгрузка данных магазина.
+
+Строки читаются из курсора базы данных порциями и сразу отдаются клиенту,
+без создания экземпляров моделей и промежуточных списков.
+Формат (CSV, NDJSON или JSON) выбирается по параметру format или заголовку
+Accept, при Accept-Encoding: gzip поток сжимается на лету.
+"""
+import csv
+import gzip
+import hashlib
+import json
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, QuerySet
+from django.http import HttpRequest, HttpResponse, HttpResponseBase, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+
+from .models import Order
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """
+    Псевдо-буфер для csv.writer: вместо записи возвращает строку
+    """
+    def write(self, value: str) -> str:
+        return value
+
+
+def iter_csv(header: Sequence[str], rows: Iterable[Sequence]) -> Iterator[str]:
+    """
+    Отдаёт CSV порциями примерно по EXPORT_CHUNK_SIZE строк
+    """
+    writer = csv.writer(Echo())
+    chunk = [writer.writerow(header)]
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def iter_ndjson(fields: Sequence[str], rows: Iterable[Sequence]) -> Iterator[str]:
+    """
+    Отдаёт по JSON-объекту на строку, порциями по EXPORT_CHUNK_SIZE строк
+    """
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    chunk = []
+    for row in rows:
+        chunk.append(encoder.encode(dict(zip(fields, row))))
+        chunk.append("\n")
+        if len(chunk) >= 2 * EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def iter_gzip(chunks: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+    # wbits=31 writes the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+EXPORT_MEDIA_TYPES = {
+    **{content_type: fmt for fmt, content_type in EXPORT_FORMATS.items()},
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+def negotiate_format(request: HttpRequest, default: str = "json") -> str:
+    """
+    Формат выгрузки из параметра format, иначе из заголовка Accept.
+    ValueError, если параметр format указывает неизвестный формат
+    """
+    fmt = request.GET.get("format")
+    if fmt:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {fmt!r}, expected one of {', '.join(EXPORT_FORMATS)}")
+        return fmt
+
+    def quality(media_type) -> float:
+        try:
+            return float(media_type.params.get("q", 1))
+        except ValueError:
+            return 0
+
+    for media_type in sorted(request.accepted_types, key=quality, reverse=True):
+        fmt = EXPORT_MEDIA_TYPES.get(f"{media_type.main_type}/{media_type.sub_type}")
+        if fmt is not None and quality(media_type) > 0:
+            return fmt
+    return default
+
+
+def accepts_gzip(request: HttpRequest) -> bool:
+    """
+    Принимает ли клиент gzip по Accept-Encoding с учётом q: "gzip;q=0"
+    запрещает сжатие, "*" разрешает, если gzip не назван явно
+    """
+    qualities = {}
+    for coding in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = coding.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def export_chunks(
+    fmt: str,
+    key: str,
+    fields: Sequence[str],
+    rows: Iterable[Sequence],
+    page_size: Optional[int] = None,
+    extra: Optional[dict] = None,
+) -> Iterator[str]:
+    """
+    Части выгрузки строк rows с колонками fields в формате fmt.
+    Курсор next и extra попадают в тело только в формате JSON
+    """
+    if fmt == "csv":
+        return iter_csv(fields, rows)
+    if fmt == "ndjson":
+        return iter_ndjson(fields, rows)
+    return iter_json_list(key, fields, rows, page_size, extra)
+
+
+def export_response(
+    request: HttpRequest,
+    chunks: Iterable[str],
+    fmt: str,
+    filename: Optional[str] = None,
+    extra: Optional[dict] = None,
+    streaming: bool = True,
+) -> HttpResponseBase:
+    """
+    Оборачивает части выгрузки в ответ: сжимает их, если клиент принимает gzip,
+    а значения extra дублирует в заголовках X-Export-*, чтобы они были
+    доступны и для CSV и NDJSON
+    """
+    use_gzip = accepts_gzip(request)
+    content_type = EXPORT_FORMATS[fmt]
+    if streaming:
+        response = StreamingHttpResponse(iter_gzip(chunks) if use_gzip else chunks, content_type=content_type)
+    else:
+        body = "".join(chunks).encode()
+        response = HttpResponse(gzip.compress(body) if use_gzip else body, content_type=content_type)
+    if use_gzip:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+    if filename:
+        response["Content-Disposition"] = f"attachment; filename={filename}.{fmt}"
+    for name, value in (extra or {}).items():
+        response[f"X-Export-{name.title()}"] = json.dumps(value) if isinstance(value, bool) else str(value)
+    return response
+
+
+def stream_queryset_export(
+    request: HttpRequest,
+    queryset: QuerySet,
+    fields: Sequence[str],
+    fmt: str,
+    key: str = "items",
+    filename: Optional[str] = None,
+    extra: Optional[dict] = None,
+) -> StreamingHttpResponse:
+    """
+    Выгружает поля fields из queryset через серверный курсор
+    """
+    rows = queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    chunks = export_chunks(fmt, key, fields, rows, extra=extra)
+    return export_response(request, chunks, fmt, filename=filename, extra=extra)
+
+
+ORDER_EXPORT_BATCH_SIZE = 500
+ORDER_EXPORT_PAGE_SIZE = 1000
+ORDER_EXPORT_MAX_PAGE_SIZE = 10000
+
+
+def encode_cursor(position: dict) -> str:
+    raw = json.dumps(position, cls=DjangoJSONEncoder, separators=(",", ":"))
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Разбирает непрозрачный курсор, ValueError если он испорчен
+    """
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(raw)
+    except (ValueError, TypeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+PRODUCT_EXPORT_COLUMNS = ("pk", "name", "price", "archived")
+ORDER_EXPORT_COLUMNS = ("pk", "delivery_address", "promocode", "user_id")
+
+
+# order rows carry the products list after ORDER_EXPORT_COLUMNS
+ORDER_EXPORT_FIELDS = ("pk", "delivery_address", "promocode", "user", "products")
+
+
+def products_data(rows: Iterable[tuple]) -> List[dict]:
+    return [dict(zip(PRODUCT_EXPORT_COLUMNS, row)) for row in rows]
+
+
+def orders_rows(rows: Sequence[tuple]) -> List[tuple]:
+    """
+    Дополняет строки ORDER_EXPORT_COLUMNS списком товаров заказа.
+    Товары всех заказов берутся одним запросом по промежуточной таблице
+    """
+    products = defaultdict(list)
+    links = (
+        Order.products.through.objects
+        .filter(order_id__in=[row[0] for row in rows])
+        # same order as order.products.all() (Product.Meta.ordering)
+        .order_by("order_id", "product__name", "product__price")
+        .values_list("order_id", "product_id")
+    )
+    for order_id, product_id in links:
+        products[order_id].append(product_id)
+    return [row + (products[row[0]],) for row in rows]
+
+
+def iter_orders_rows(queryset: QuerySet, limit: Optional[int] = None) -> Iterator[tuple]:
+    """
+    Отдаёт заказы в порядке pk пачками: на пачку один запрос по заказам
+    и один по промежуточной таблице Order.products
+    """
+    queryset = queryset.order_by("pk")
+    last_pk = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = ORDER_EXPORT_BATCH_SIZE if remaining is None else min(ORDER_EXPORT_BATCH_SIZE, remaining)
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page.values_list(*ORDER_EXPORT_COLUMNS)[:size])
+        if not rows:
+            return
+        yield from orders_rows(rows)
+        last_pk = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < size:
+            return
+
+
+def iter_json_list(
+    key: str,
+    fields: Sequence[str],
+    rows: Iterable[Sequence],
+    page_size: Optional[int] = None,
+    extra: Optional[dict] = None,
+) -> Iterator[str]:
+    """
+    Отдаёт {"<key>": [...]} по частям, строка rows становится объектом
+    с ключами fields (первым должен быть pk). Если задан page_size, в конце
+    добавляется курсор "next" для следующей страницы (null, если её нет).
+    Ключи extra дописываются после списка
+    """
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    yield '{"%s":[' % key
+    count = 0
+    last_pk = None
+    chunk = []
+    for row in rows:
+        if count:
+            chunk.append(",")
+        chunk.append(encoder.encode(dict(zip(fields, row))))
+        count += 1
+        last_pk = row[0]
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]")
+    if page_size is not None:
+        next_cursor = encode_cursor({"pk": last_pk}) if count == page_size else None
+        chunk.append(',"next":' + encoder.encode(next_cursor))
+    for extra_key, value in (extra or {}).items():
+        chunk.append(",%s:%s" % (encoder.encode(extra_key), encoder.encode(value)))
+    chunk.append("}")
+    yield "".join(chunk)
+
+
+def parse_page_params(request: HttpRequest) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Возвращает (размер страницы, pk после которого начинать) из параметров
+    cursor и limit. Без них выгрузка не разбивается на страницы
+    """
+    if "cursor" not in request.GET and "limit" not in request.GET:
+        return None, None
+    try:
+        page_size = int(request.GET.get("limit") or ORDER_EXPORT_PAGE_SIZE)
+        cursor = request.GET.get("cursor")
+        after_pk = int(decode_cursor(cursor)["pk"]) if cursor else None
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError("Invalid cursor or limit") from exc
+    return max(1, min(page_size, ORDER_EXPORT_MAX_PAGE_SIZE)), after_pk
+
+
+@dataclass(frozen=True)
+class EncodedBody:
+    """
+    Готовое тело ответа для кэша: исходное, сжатое gzip и его ETag
+    """
+    body: bytes
+    gzipped: bytes
+    etag: str
+    content_type: str
+
+    @property
+    def gzip_etag(self) -> str:
+        return self.etag[:-1] + '-gzip"'
+
+
+def encode_body(data, content_type: str = "application/json") -> EncodedBody:
+    """
+    Кодирует данные в JSON один раз, ETag считается по содержимому
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder).encode()
+    return EncodedBody(
+        body=body,
+        gzipped=gzip.compress(body, mtime=0),
+        etag='"%s"' % hashlib.sha256(body).hexdigest()[:32],
+        content_type=content_type,
+    )
+
+
+def encoded_response(request: HttpRequest, encoded: EncodedBody) -> HttpResponse:
+    """
+    Отдаёт закэшированные байты как есть: 304 если у клиента та же версия,
+    сжатое тело если клиент принимает gzip
+    """
+    use_gzip = accepts_gzip(request)
+    etag = encoded.gzip_etag if use_gzip else encoded.etag
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(encoded.gzipped if use_gzip else encoded.body, content_type=encoded.content_type)
+        if use_gzip:
+            response["Content-Encoding"] = "gzip"
+    response["ETag"] = etag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+# rows committed within this lag may carry an older updated_at than rows
+# already exported, so watermarks never move past now() - lag
+WATERMARK_LAG = timedelta(seconds=2)
+DELTA_PAGE_SIZE = 1000
+
+
+def watermark_token(updated_at: datetime, pk: int = 0) -> str:
+    return encode_cursor({"ts": updated_at.isoformat(), "pk": pk})
+
+
+def initial_watermark() -> str:
+    """
+    Токен для полной выгрузки: следующая выгрузка изменений повторит
+    строки последних секунд вместо того, чтобы рискнуть их пропустить
+    """
+    return watermark_token(timezone.now() - WATERMARK_LAG)
+
+
+def parse_watermark(token: str) -> Tuple[datetime, int]:
+    position = decode_cursor(token)
+    try:
+        updated_at = parse_datetime(position["ts"])
+        pk = int(position["pk"])
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError("Invalid since token") from exc
+    if updated_at is None:
+        raise ValueError("Invalid since token")
+    return updated_at, pk
+
+
+def changed_since(queryset: QuerySet, token: str, columns: Sequence[str]) -> Tuple[list, str, bool]:
+    """
+    Строки, созданные или изменённые после токена, по индексу (updated_at, id).
+    columns должны начинаться с "pk".
+    Возвращает (строки columns, новый токен, есть ли ещё изменения)
+    """
+    updated_at, pk = parse_watermark(token)
+    rows = list(
+        queryset
+        .filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=pk))
+        .filter(updated_at__lte=timezone.now() - WATERMARK_LAG)
+        .order_by("updated_at", "pk")
+        .values_list("updated_at", *columns)[:DELTA_PAGE_SIZE + 1]
+    )
+    more = len(rows) > DELTA_PAGE_SIZE
+    rows = rows[:DELTA_PAGE_SIZE]
+    if rows:
+        token = watermark_token(rows[-1][0], rows[-1][1])
+    return [row[1:] for row in rows], token, more
@@ -0,0 +1,207 @@
+"""
+Быстрое чтение для list и retrieve.
+
+Строки берутся через values_list(named=True) без создания моделей, а поля
+сериализатора заранее превращаются в список (колонка, преобразователь).
+Результат совпадает с ModelSerializer.to_representation байт в байт.
+"""
+import decimal
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model, QuerySet
+from rest_framework import fields as drf_fields
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.settings import ISO_8601, api_settings
+
+# DB values of these fields already equal their representation
+IDENTITY_FIELDS = (
+    drf_fields.BooleanField,
+    drf_fields.CharField,
+    drf_fields.IntegerField,
+    drf_fields.ReadOnlyField,
+)
+
+KIND_VALUE = "value"
+KIND_FILE = "file"
+KIND_DATETIME = "datetime"
+KIND_MANY = "many"
+
+
+class PlanField(NamedTuple):
+    name: str
+    column: str
+    kind: str
+    convert: Optional[Callable]
+    model_field: object
+
+
+class ReadPlan:
+    """
+    Колонки запроса и преобразователи для одного набора полей сериализатора
+    """
+    def __init__(self, model, plan_fields: List[PlanField]):
+        self.model = model
+        self.fields = plan_fields
+        self.pk_column = model._meta.pk.attname
+        columns = [self.pk_column]
+        for field in plan_fields:
+            if field.kind != KIND_MANY and field.column not in columns:
+                columns.append(field.column)
+        self.columns = columns
+
+    def prepare(self, queryset: QuerySet) -> QuerySet:
+        # annotations such as the search rank stay selectable for ordering
+        return queryset.prefetch_related(None).values_list(*self.columns, *queryset.query.annotations, named=True)
+
+    def serialize(self, rows: Sequence[tuple], request=None) -> List[dict]:
+        rows = list(rows)
+        index = {column: position for position, column in enumerate(rows[0]._fields)} if rows else {}
+        steps = []
+        for field in self.fields:
+            if field.kind == KIND_MANY:
+                related = many_related_pks(field.model_field, [row[index[self.pk_column]] for row in rows])
+                steps.append((field.name, index.get(self.pk_column), related.__getitem__))
+            elif field.kind == KIND_FILE:
+                steps.append((field.name, index.get(field.column), file_converter(field, request)))
+            elif field.kind == KIND_DATETIME:
+                steps.append((field.name, index.get(field.column), datetime_converter(field.convert)))
+            else:
+                steps.append((field.name, index.get(field.column), field.convert))
+
+        data = []
+        for row in rows:
+            item = {}
+            for name, position, convert in steps:
+                value = row[position]
+                item[name] = value if convert is None or value is None else convert(value)
+            data.append(item)
+        return data
+
+
+def many_related_pks(model_field, pks: List) -> Dict[object, list]:
+    """
+    pk связанных объектов для каждого pk из pks одним запросом, в порядке
+    Meta.ordering связанной модели, как у prefetch_related
+    """
+    related = defaultdict(list)
+    if not pks:
+        return related
+    through = model_field.remote_field.through
+    source = model_field.m2m_field_name()
+    target = model_field.m2m_reverse_field_name()
+    ordering = [
+        ("-" if term.startswith("-") else "") + f"{target}__{term.lstrip('-')}"
+        for term in model_field.related_model._meta.ordering
+    ]
+    links = (
+        through.objects
+        .filter(**{f"{source}_id__in": pks})
+        .order_by(f"{source}_id", *ordering)
+        .values_list(f"{source}_id", f"{target}_id")
+    )
+    for pk, related_pk in links:
+        related[pk].append(related_pk)
+    return related
+
+
+def file_converter(field: PlanField, request) -> Callable:
+    storage = field.model_field.storage
+    use_url = getattr(field.convert, "use_url", api_settings.UPLOADED_FILES_USE_URL)
+
+    def convert(name):
+        if not name:
+            return None
+        if not use_url:
+            return name
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+    return convert
+
+
+def decimal_converter(field: drf_fields.DecimalField) -> Callable:
+    """
+    DecimalField.to_representation с точностью и контекстом, посчитанными один раз
+    """
+    coerce_to_string = getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+    # normalize_output appeared in DRF 3.15
+    normalize_output = getattr(field, "normalize_output", False)
+    if not coerce_to_string or field.localize or normalize_output or field.decimal_places is None:
+        return field.to_representation
+    exponent = decimal.Decimal(".1") ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        return f"{value.quantize(exponent, rounding=rounding, context=context):f}"
+    return convert
+
+
+def datetime_converter(field: drf_fields.DateTimeField) -> Callable:
+    """
+    DateTimeField.to_representation в ISO 8601 с часовым поясом запроса,
+    определённым один раз на весь ответ
+    """
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    field_timezone = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+    if output_format is None or output_format.lower() != ISO_8601 or field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if not isinstance(value, datetime) or value.utcoffset() is None:
+            return field.to_representation(value)
+        text = value.astimezone(field_timezone).isoformat()
+        return text[:-6] + "Z" if text.endswith("+00:00") else text
+    return convert
+
+
+def plan_field(model, name: str, field: drf_fields.Field) -> Optional[PlanField]:
+    meta = model._meta
+    try:
+        model_field = meta.pk if field.source == "pk" else meta.get_field(field.source)
+    except FieldDoesNotExist:
+        return None
+    if isinstance(field, ManyRelatedField):
+        child = field.child_relation
+        if model_field.many_to_many and isinstance(child, PrimaryKeyRelatedField) and child.pk_field is None:
+            return PlanField(name, model_field.name, KIND_MANY, None, model_field)
+        return None
+    if isinstance(field, PrimaryKeyRelatedField):
+        if model_field.many_to_one and field.pk_field is None:
+            return PlanField(name, model_field.attname, KIND_VALUE, None, model_field)
+        return None
+    if model_field.is_relation or isinstance(field, serializers.BaseSerializer):
+        return None
+    if isinstance(field, drf_fields.FileField):
+        # the DRF field only carries use_url here
+        return PlanField(name, model_field.attname, KIND_FILE, field, model_field)
+    if type(field) in IDENTITY_FIELDS:
+        return PlanField(name, model_field.attname, KIND_VALUE, None, model_field)
+    if type(field) is drf_fields.DecimalField:
+        return PlanField(name, model_field.attname, KIND_VALUE, decimal_converter(field), model_field)
+    if type(field) is drf_fields.DateTimeField:
+        return PlanField(name, model_field.attname, KIND_DATETIME, field, model_field)
+    return PlanField(name, model_field.attname, KIND_VALUE, field.to_representation, model_field)
+
+
+_plans: Dict[Tuple[type, Tuple[str, ...]], Optional[ReadPlan]] = {}
+
+
+def read_plan(model: Model, serializer: serializers.Serializer) -> Optional[ReadPlan]:
+    """
+    План для полей сериализатора, кэшируется по классу и набору полей.
+    None, если какое-то поле нельзя прочитать из одной колонки
+    """
+    fields = [(name, field) for name, field in serializer.fields.items() if not field.write_only]
+    key = (type(serializer), tuple(name for name, _ in fields))
+    if key not in _plans:
+        plan_fields = [plan_field(model, name, field) for name, field in fields]
+        _plans[key] = None if None in plan_fields else ReadPlan(model, plan_fields)
+    return _plans[key]
@@ -0,0 +1,360 @@
+"""
+Подбор индексов по журналу SQL-запросов Django.
+
+Журнал в формате django.db.backends ("(0.003) SELECT ...; args=...;
+alias=default") разбирается на запросы, запросы нормализуются (литералы
+заменяются на ?, списки IN сворачиваются) и группируются по отпечатку.
+Для самых дорогих групп строится EXPLAIN QUERY PLAN на текущей схеме,
+из WHERE и ORDER BY выводится составной или частичный индекс, и он
+проверяется пробным CREATE INDEX в откатываемой транзакции.
+"""
+import hashlib
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.apps import apps
+from django.db import DatabaseError, connection, models, transaction
+
+ENTRY_RE = re.compile(
+    r"\((?P<time>\d+(?:\.\d+)?)\) "
+    r"(?P<sql>(?:SELECT|INSERT|UPDATE|DELETE|WITH|SAVEPOINT|RELEASE|BEGIN|COMMIT|ROLLBACK|PRAGMA|CREATE|ALTER|DROP)\b.*)$"
+)
+TOKEN_RE = re.compile(r"""("(?:[^"]|"")*")|('(?:[^']|'')*')|(\b\d+(?:\.\d+)?\b)|(\s*,\s*)|(\s+)""")
+IN_LIST_RE = re.compile(r"IN \(\?(?:, \?)*\)")
+PLAN_RE = re.compile(
+    r"^(?P<op>SCAN|SEARCH) (?P<table>\S+)(?: AS \S+)?"
+    r"(?: USING (?:(?:COVERING )?INDEX (?P<index>\S+)|INTEGER PRIMARY KEY|ROWID \w+))?"
+)
+COLUMN = r'"(?P<table>[^"]+)"\."(?P<column>[^"]+)"'
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+# plan costs: a full scan of a filtered or sorted table, a sort, rows read only to be filtered
+COST_FULL_SCAN = 4
+COST_TEMP_SORT = 2
+COST_RESIDUAL_FILTER = 1
+
+
+@dataclass
+class QueryGroup:
+    """
+    Запросы с одним отпечатком: число, суммарное и худшее время и пример
+    """
+    fingerprint: str
+    statement: str
+    sample: str
+    count: int = 0
+    total: float = 0.0
+    worst: float = 0.0
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, duration: float, sql: str) -> None:
+        self.count += 1
+        self.total += duration
+        if duration >= self.worst:
+            self.worst = duration
+            self.sample = sql
+
+
+@dataclass
+class Predicates:
+    """
+    Условия запроса по одной таблице: столбцы равенства, диапазона,
+    порядка сортировки и условия для частичного индекса
+    """
+    table: str
+    equal: List[str] = field(default_factory=list)
+    ranges: List[str] = field(default_factory=list)
+    ordering: List[Tuple[str, bool]] = field(default_factory=list)
+    condition: Dict[str, object] = field(default_factory=dict)
+
+
+@dataclass
+class Advice:
+    group: QueryGroup
+    plan: List[str]
+    cost: int
+    model: Optional[type] = None
+    index: Optional[models.Index] = None
+    new_plan: List[str] = field(default_factory=list)
+    new_cost: int = 0
+    error: str = ""
+
+
+def iter_log_entries(lines: Iterable[str]) -> Iterator[Tuple[float, str]]:
+    """
+    (время, SQL) из журнала. Строки, перенесённые терминалом, склеиваются
+    """
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        match = ENTRY_RE.search(line)
+        if match is not None:
+            if current is not None:
+                yield current
+            current = [float(match["time"]), match["sql"]]
+        elif current is not None:
+            current[1] += line
+    if current is not None:
+        yield current
+
+
+def split_args(text: str) -> str:
+    """
+    SQL без хвоста "; args=...; alias=..."
+    """
+    position = text.rfind("; args=")
+    return text[:position] if position != -1 else text
+
+
+def normalize(sql: str) -> str:
+    """
+    Текст запроса без значений: литералы и числа - ?, пробелы - один,
+    списки IN любой длины - IN (...). Запятые приводятся к ", ":
+    перенос строки в журнале съедает пробел после них
+    """
+    def replace(match):
+        identifier, string, number, comma, space = match.groups()
+        if identifier is not None:
+            return identifier
+        if comma is not None:
+            return ", "
+        if space is not None:
+            return " "
+        return "?"
+    return IN_LIST_RE.sub("IN (...)", TOKEN_RE.sub(replace, sql).strip())
+
+
+def fingerprint(statement: str) -> str:
+    return hashlib.sha1(statement.encode()).hexdigest()[:12]
+
+
+def group_queries(entries: Iterable[Tuple[float, str]]) -> List[QueryGroup]:
+    """
+    Группы запросов по отпечатку, самые затратные по суммарному времени первыми
+    """
+    groups: Dict[str, QueryGroup] = {}
+    for duration, text in entries:
+        sql = split_args(text)
+        statement = normalize(sql)
+        key = fingerprint(statement)
+        if key not in groups:
+            groups[key] = QueryGroup(key, statement, sql)
+        groups[key].add(duration, sql)
+    return sorted(groups.values(), key=lambda group: (-group.total, -group.count, group.fingerprint))
+
+
+def explain(sql: str) -> List[str]:
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def strip_subqueries(sql: str) -> str:
+    """
+    Убирает вложенные (SELECT ...), их условия относятся к другим таблицам
+    """
+    while True:
+        start = sql.find("(SELECT ")
+        if start == -1:
+            return sql
+        depth = 0
+        for position in range(start, len(sql)):
+            if sql[position] == "(":
+                depth += 1
+            elif sql[position] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+        sql = sql[:start] + "(?)" + sql[position + 1:]
+
+
+def clause(sql: str, keyword: str, stops: Tuple[str, ...]) -> str:
+    start = sql.find(f" {keyword} ")
+    if start == -1:
+        return ""
+    start += len(keyword) + 2
+    ends = [sql.find(f" {stop} ", start) for stop in stops]
+    ends = [end for end in ends if end != -1]
+    return sql[start:min(ends)] if ends else sql[start:]
+
+
+def table_model(table: str) -> Optional[type]:
+    for model in apps.get_models():
+        if model._meta.db_table == table:
+            return model
+    return None
+
+
+def query_predicates(sql: str) -> Optional[Predicates]:
+    """
+    Условия основной таблицы запроса из WHERE и ORDER BY.
+    Условия с OR и сортировка по другим таблицам не учитываются
+    """
+    sql = strip_subqueries(sql)
+    match = re.search(r' FROM "([^"]+)"', sql)
+    if match is None:
+        match = re.match(r'(?:UPDATE|DELETE FROM) "([^"]+)"', sql)
+    if match is None:
+        return None
+    model = table_model(match.group(1))
+    if model is None:
+        return None
+    predicates = Predicates(match.group(1))
+    fields = {model_field.column: model_field for model_field in model._meta.concrete_fields}
+
+    where = clause(sql, "WHERE", ("GROUP BY", "ORDER BY", "LIMIT"))
+    if where and " OR " not in where:
+        for term in re.split(r" AND ", where.strip("()")):
+            term = term.strip("() ")
+            match = re.fullmatch(r"(?P<negate>NOT )?" + COLUMN + r"(?P<rest>.*)", term)
+            if match is None or match["table"] != predicates.table or match["column"] not in fields:
+                continue
+            column, rest = match["column"], match["rest"].strip()
+            is_boolean = isinstance(fields[column], models.BooleanField)
+            if rest == "" and is_boolean:
+                predicates.condition[column] = not match["negate"]
+            elif rest == "IS NULL":
+                predicates.condition[column] = None
+            elif re.match(r"(=|IN \()", rest) and not match["negate"]:
+                predicates.equal.append(column)
+            elif re.match(r"(>=|<=|>|<|BETWEEN |LIKE |GLOB )", rest) and not match["negate"]:
+                predicates.ranges.append(column)
+
+    order_by = clause(sql, "ORDER BY", ("LIMIT",))
+    for term in filter(None, (term.strip() for term in order_by.split(","))):
+        match = re.fullmatch(COLUMN + r" (?P<direction>ASC|DESC)(?: NULLS (?:FIRST|LAST))?", term)
+        if match is None or match["table"] != predicates.table or match["column"] not in fields:
+            predicates.ordering = []
+            break
+        predicates.ordering.append((match["column"], match["direction"] == "DESC"))
+    return predicates
+
+
+def candidate_index(model, predicates: Predicates) -> Optional[models.Index]:
+    """
+    Равенства, затем сортировка (или первый диапазон); булевы условия
+    и IS NULL уходят в условие частичного индекса
+    """
+    fields = {model_field.column: model_field for model_field in model._meta.concrete_fields}
+    columns = list(dict.fromkeys(predicates.equal))
+    terms = [fields[column].name for column in columns]
+    if predicates.ordering:
+        for column, descending in predicates.ordering:
+            if column in columns or column in predicates.condition:
+                continue
+            columns.append(column)
+            terms.append(("-" if descending else "") + fields[column].name)
+    elif predicates.ranges:
+        terms.append(fields[predicates.ranges[0]].name)
+    if not terms:
+        return None
+    condition = None
+    for column, value in predicates.condition.items():
+        lookup = condition_lookup(fields[column], value)
+        condition = lookup if condition is None else condition & lookup
+    index = models.Index(fields=terms, condition=condition, name="advised")
+    index.set_name_with_model(model)
+    return index
+
+
+def condition_lookup(model_field, value) -> models.Q:
+    if value is None:
+        return models.Q(**{f"{model_field.name}__isnull": True})
+    return models.Q(**{model_field.name: value})
+
+
+def index_columns(table: str) -> Dict[str, Tuple[List[str], bool]]:
+    """
+    Индексы таблицы: имя -> (столбцы, частичный ли)
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        partial = set()
+        if connection.vendor == "sqlite":
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql LIKE %s",
+                [table, "% WHERE %"],
+            )
+            partial = {row[0] for row in cursor.fetchall()}
+    return {
+        name: (constraint["columns"], name in partial)
+        for name, constraint in constraints.items()
+        if constraint["index"] or constraint["unique"]
+    }
+
+
+def plan_cost(plan: List[str], predicates: Optional[Predicates], indexes: Dict[str, Tuple[List[str], bool]]) -> int:
+    """
+    Оценка плана: полный просмотр таблицы с условиями или сортировкой,
+    сортировка во временном B-дереве и строки, которые индекс
+    не отсекает, а фильтр отбрасывает
+    """
+    cost = 0
+    for detail in plan:
+        if "USE TEMP B-TREE" in detail:
+            cost += COST_TEMP_SORT
+            continue
+        match = PLAN_RE.match(detail)
+        if match is None or predicates is None or match["table"] != predicates.table:
+            continue
+        filtered = set(predicates.equal) | set(predicates.ranges) | set(predicates.condition)
+        if match["index"] is None:
+            if match["op"] == "SCAN" and (filtered or predicates.ordering):
+                cost += COST_FULL_SCAN
+            continue
+        columns, partial = indexes.get(match["index"], ([], False))
+        if not partial and filtered - set(columns):
+            cost += COST_RESIDUAL_FILTER
+    return cost
+
+
+def try_index(model, index: models.Index, sql: str) -> List[str]:
+    """
+    План запроса с индексом index, который создаётся и откатывается
+    """
+    # the editor only renders SQL, entering it is not allowed inside a transaction on SQLite
+    create_sql = str(index.create_sql(model, connection.schema_editor()))
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(create_sql)
+        plan = explain(sql)
+        transaction.set_rollback(True)
+    return plan
+
+
+def advise(group: QueryGroup) -> Optional[Advice]:
+    """
+    План запроса группы и индекс, который его улучшает, если такой есть
+    """
+    if not group.statement.startswith(EXPLAINABLE):
+        return None
+    try:
+        plan = explain(group.sample)
+    except DatabaseError as exc:
+        return Advice(group, [], 0, error=str(exc))
+    predicates = query_predicates(group.sample)
+    if predicates is None:
+        return Advice(group, plan, plan_cost(plan, None, {}))
+    indexes = index_columns(predicates.table)
+    advice = Advice(group, plan, plan_cost(plan, predicates, indexes))
+    if advice.cost == 0:
+        return advice
+    model = table_model(predicates.table)
+    index = candidate_index(model, predicates)
+    if index is None:
+        return advice
+    try:
+        new_plan = try_index(model, index, group.sample)
+    except DatabaseError as exc:
+        advice.error = str(exc)
+        return advice
+    indexes[index.name] = ([model._meta.get_field(name.lstrip("-")).column for name in index.fields],
+                           index.condition is not None)
+    new_cost = plan_cost(new_plan, predicates, indexes)
+    if new_cost < advice.cost:
+        advice.model, advice.index, advice.new_plan, advice.new_cost = model, index, new_plan, new_cost
+    return advice
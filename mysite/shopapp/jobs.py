@@ -0,0 +1,153 @@
+"""
+Очередь фоновых задач импорта на таблице ImportJob.
+
+Админка кладёт загруженный файл в очередь, команда runjobs забирает
+задачи и выполняет их в отдельных процессах. Нужны только база данных
+и локальные процессы, без внешнего брокера.
+"""
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+from typing import Optional
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import timezone
+
+from .common import ImportResult, save_csv_orders, save_csv_products
+from .models import ImportJob
+
+log = logging.getLogger(__name__)
+
+IMPORTERS = {
+    ImportJob.KIND_PRODUCTS: save_csv_products,
+    ImportJob.KIND_ORDERS: save_csv_orders,
+}
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_import(kind: str, uploaded_file: UploadedFile, encoding: Optional[str], user: Optional[User]) -> ImportJob:
+    """
+    Сохраняет файл и ставит задачу импорта в очередь
+    """
+    if kind not in IMPORTERS:
+        raise ValueError(f"Unknown import kind {kind!r}")
+    job = ImportJob(
+        kind=kind,
+        encoding=encoding or "",
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    job.file.save(uploaded_file.name, uploaded_file, save=False)
+    job.save()
+    return job
+
+
+def claim_next_job(worker: str) -> Optional[ImportJob]:
+    """
+    Забирает самую старую задачу из очереди.
+    Условный UPDATE гарантирует, что задачу получит только один процесс
+    """
+    while True:
+        pk = (
+            ImportJob.objects
+            .filter(status=ImportJob.STATUS_QUEUED)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+            .first()
+        )
+        if pk is None:
+            return None
+        now = timezone.now()
+        claimed = ImportJob.objects.filter(pk=pk, status=ImportJob.STATUS_QUEUED).update(
+            status=ImportJob.STATUS_RUNNING,
+            worker=worker,
+            started_at=now,
+            heartbeat_at=now,
+        )
+        if claimed:
+            return ImportJob.objects.get(pk=pk)
+
+
+def fail_stale_jobs(stale_after: timedelta) -> int:
+    """
+    Помечает упавшими задачи, чей процесс давно не отчитывался о прогрессе
+    """
+    return ImportJob.objects.filter(
+        status=ImportJob.STATUS_RUNNING,
+        heartbeat_at__lt=timezone.now() - stale_after,
+    ).update(
+        status=ImportJob.STATUS_FAILED,
+        finished_at=timezone.now(),
+        message="Worker stopped reporting progress",
+    )
+
+
+def _progress_values(result: ImportResult) -> dict:
+    return {
+        "rows_done": result.processed,
+        "rows_inserted": result.inserted,
+        "rows_updated": result.updated,
+        "rows_rejected": result.rejected,
+    }
+
+
+def run_job(job: ImportJob) -> ImportJob:
+    """
+    Выполняет задачу, сохраняя прогресс после каждой пачки строк
+    """
+    importer = IMPORTERS[job.kind]
+
+    def progress(result: ImportResult) -> None:
+        ImportJob.objects.filter(pk=job.pk).update(
+            heartbeat_at=timezone.now(),
+            **_progress_values(result),
+        )
+
+    try:
+        with job.file.open("rb"):
+            result = importer(job.file.file, encoding=job.encoding or None, progress=progress)
+    except Exception as exc:
+        log.exception("Import job %s failed", job.pk)
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.STATUS_FAILED,
+            finished_at=timezone.now(),
+            message=str(exc),
+        )
+    else:
+        job.file.storage.delete(job.file.name)
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.STATUS_DONE,
+            finished_at=timezone.now(),
+            file="",
+            errors=[
+                {"line": line, "message": message}
+                for line, message in result.errors
+            ],
+            **_progress_values(result),
+        )
+    job.refresh_from_db()
+    return job
+
+
+def work(once: bool = False, poll_interval: float = 1.0) -> int:
+    """
+    Цикл рабочего процесса. С once=True выходит, когда очередь пуста.
+    Возвращает число выполненных задач
+    """
+    worker = worker_name()
+    done = 0
+    while True:
+        job = claim_next_job(worker)
+        if job is None:
+            if once:
+                return done
+            time.sleep(poll_interval)
+            continue
+        log.info("Worker %s runs import job %s", worker, job.pk)
+        run_job(job)
+        done += 1
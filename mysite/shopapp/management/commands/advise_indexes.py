@@ -0,0 +1,89 @@
+import os
+import sys
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import migrations
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from shopapp.index_advisor import advise, group_queries, iter_log_entries
+
+
+class Command(BaseCommand):
+    """
+    Ranks the statements of a Django SQL debug log by total time, explains
+    them against the current schema and proposes indexes that improve the plan
+    """
+    help = "Propose indexes from a django.db.backends SQL log"
+
+    def add_arguments(self, parser):
+        parser.add_argument("logs", nargs="+", help="Log files, - for stdin")
+        parser.add_argument("--top", type=int, default=10, help="Number of statement groups to analyze")
+        parser.add_argument("--write", action="store_true", help="Write the proposed indexes as migrations")
+
+    def handle(self, *args, logs, top, write, **options):
+        entries = []
+        for path in logs:
+            if path == "-":
+                entries.extend(iter_log_entries(sys.stdin))
+                continue
+            if not os.path.isfile(path):
+                raise CommandError(f"File {path} does not exist")
+            with open(path, encoding="utf-8", errors="replace") as file:
+                entries.extend(iter_log_entries(file))
+        groups = group_queries(entries)
+        self.stdout.write(f"{len(entries)} statements, {len(groups)} distinct")
+
+        proposed = {}
+        for rank, group in enumerate(groups[:top], start=1):
+            self.stdout.write(
+                f"\n#{rank} {group.fingerprint} total {group.total:.3f}s, "
+                f"{group.count} calls, avg {group.average * 1000:.1f}ms, worst {group.worst * 1000:.1f}ms"
+            )
+            self.stdout.write(f"  {group.statement[:300]}")
+            advice = advise(group)
+            if advice is None:
+                continue
+            if advice.error:
+                self.stdout.write(self.style.WARNING(f"  cannot explain: {advice.error}"))
+            if advice.plan:
+                self.stdout.write(f"  plan (cost {advice.cost}): {'; '.join(advice.plan)}")
+            if advice.index is None:
+                continue
+            serialized, _ = MigrationWriter.serialize(advice.index)
+            self.stdout.write(self.style.SUCCESS(f"  add to {advice.model.__name__}.Meta.indexes: {serialized}"))
+            self.stdout.write(f"  new plan (cost {advice.new_cost}): {'; '.join(advice.new_plan)}")
+            key = (advice.model, advice.index.name)
+            proposed.setdefault(key, advice)
+
+        if write and proposed:
+            self.write_migrations(proposed.values())
+
+    def write_migrations(self, advices):
+        """
+        One migration per local app. The indexes must also be added
+        to Meta.indexes, otherwise makemigrations will remove them
+        """
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        by_app = {}
+        for advice in advices:
+            by_app.setdefault(advice.model._meta.app_label, []).append(advice)
+        for app_label, app_advices in by_app.items():
+            app_path = apps.get_app_config(app_label).path
+            if not app_path.startswith(str(settings.BASE_DIR)):
+                self.stdout.write(self.style.WARNING(f"Skipping {app_label}: not a project app"))
+                continue
+            leaves = loader.graph.leaf_nodes(app_label)
+            number = (int(leaves[0][1].split("_")[0]) + 1) if leaves else 1
+            migration = migrations.Migration(f"{number:04d}_advised_indexes", app_label)
+            migration.dependencies = leaves
+            migration.operations = [
+                migrations.AddIndex(model_name=advice.model._meta.model_name, index=advice.index)
+                for advice in app_advices
+            ]
+            writer = MigrationWriter(migration)
+            with open(writer.path, "w", encoding="utf-8") as file:
+                file.write(writer.as_string())
+            self.stdout.write(self.style.SUCCESS(f"Wrote {writer.path}"))
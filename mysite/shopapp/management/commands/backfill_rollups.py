@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from shopapp.rollups import refresh_rollups
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the order revenue rollups from orders, for all days or a date range
+    """
+    help = "Rebuild order revenue rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="First day to rebuild, YYYY-MM-DD")
+        parser.add_argument("--until", help="Last day to rebuild, YYYY-MM-DD")
+
+    def handle(self, *args, since=None, until=None, **options):
+        days = None
+        if since or until:
+            if not (since and until):
+                raise CommandError("--since and --until go together")
+            try:
+                first, last = parse_date(since), parse_date(until)
+            except ValueError:
+                first = last = None
+            if first is None or last is None or first > last:
+                raise CommandError("Expected a date range in YYYY-MM-DD format")
+            days = [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+        with transaction.atomic():
+            count = refresh_rollups(days)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} rollup rows"))
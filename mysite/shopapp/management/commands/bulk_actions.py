@@ -1,7 +1,9 @@
 from django.contrib.auth.models import User
 
 from django.core.management import BaseCommand
+from django.utils import timezone
 
+from shopapp.caching import bump_generation
 from shopapp.models import Product
 
 
@@ -11,7 +13,8 @@ class Command(BaseCommand):
 
         result = Product.objects.filter(
             name__contains="Smartphone"
-        ).update(discount=10)
+        ).update(discount=10, updated_at=timezone.now())
+        bump_generation(Product)
 
         print(result)
 
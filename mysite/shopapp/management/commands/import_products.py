@@ -0,0 +1,97 @@
+import os
+from multiprocessing import get_context
+from timeit import default_timer
+
+import django
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+
+from shopapp.common import (
+    IMPORT_BATCH_SIZE,
+    ImportResult,
+    iter_batches,
+    parse_products_chunk,
+    split_csv_file,
+    write_prepared_products_batch,
+)
+
+
+def _init_worker():
+    # spawned (not forked) workers start without configured apps
+    django.setup()
+
+
+def _parse_range(args):
+    return parse_products_chunk(*args)
+
+
+class Command(BaseCommand):
+    """
+    Imports a large products CSV: a process pool parses and validates
+    byte-range chunks of the file, the main process writes the batches
+    """
+    help = "Import products from a large CSV file using several processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file with a header row")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--chunk-size", type=int, default=8, help="Chunk size in MB")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument("--key", default="name", help="Natural key for upserts, empty to only insert")
+        parser.add_argument("--encoding", default=None, help="Any ASCII compatible encoding, utf-8 by default")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError(f"File {path} does not exist")
+        key = options["key"] or None
+        started = default_timer()
+        header, ranges = split_csv_file(path, options["chunk_size"] * 1024 * 1024)
+        if key is not None and key not in header:
+            raise CommandError(f"Key column {key!r} is missing in CSV")
+        try:
+            tasks = [(path, start, end, header, options["encoding"]) for start, end in ranges]
+            chunks = self.parse_chunks(tasks, options["workers"])
+            result = self.write(chunks, key, header, options["batch_size"], started)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        elapsed = default_timer() - started
+        rate = result.processed / elapsed if elapsed else 0
+        for line, message in result.errors:
+            self.stderr.write(f"Line {line}: {message}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.processed} rows in {elapsed:.1f}s ({rate:.0f} rows/s): "
+            f"{result.inserted} inserted, {result.updated} updated, {result.rejected} rejected"
+        ))
+
+    def parse_chunks(self, tasks, workers):
+        """
+        Yields parsed chunks in file order
+        """
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield _parse_range(task)
+            return
+        # children must not reuse the parent's database connection
+        connections.close_all()
+        with get_context().Pool(min(workers, len(tasks)), initializer=_init_worker) as pool:
+            yield from pool.imap(_parse_range, tasks)
+
+    def write(self, chunks, key, header, batch_size, started) -> ImportResult:
+        result = ImportResult()
+        # line 1 is the header
+        first_line = 2
+        for rows, errors, lines in chunks:
+            for offset, message in errors:
+                result.reject(first_line + offset, message)
+            batches = iter_batches(
+                ((first_line + offset, values) for offset, values in rows),
+                batch_size,
+            )
+            for batch in batches:
+                write_prepared_products_batch(batch, key, header, result)
+            first_line += lines
+            elapsed = default_timer() - started
+            self.stdout.write(f"{result.processed} rows, {result.processed / elapsed:.0f} rows/s")
+        return result
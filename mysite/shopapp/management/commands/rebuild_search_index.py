@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from shopapp.search import rebuild_index
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the FTS5 product search index from the product table
+    """
+    help = "Rebuild the product full-text search index"
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("The full-text index needs SQLite with FTS5")
+        with transaction.atomic():
+            count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products"))
@@ -0,0 +1,56 @@
+from datetime import timedelta
+from multiprocessing import Process
+
+from django.core.management import BaseCommand
+from django.db import connections
+
+from shopapp.jobs import fail_stale_jobs, work
+
+
+def _worker(once: bool, poll_interval: float) -> None:
+    work(once=once, poll_interval=poll_interval)
+
+
+class Command(BaseCommand):
+    """
+    Runs background import jobs from the ImportJob queue
+    """
+    help = "Run background import jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between queue polls")
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=600,
+            help="Mark running jobs without progress for this many seconds as failed",
+        )
+
+    def handle(self, *args, **options):
+        stale = fail_stale_jobs(timedelta(seconds=options["stale_after"]))
+        if stale:
+            self.stdout.write(self.style.WARNING(f"Marked {stale} stale jobs as failed"))
+
+        if options["workers"] <= 1:
+            done = work(once=options["once"], poll_interval=options["poll_interval"])
+            self.stdout.write(self.style.SUCCESS(f"Finished {done} jobs"))
+            return
+
+        # forked processes must not share the parent's database connection
+        connections.close_all()
+        processes = [
+            Process(target=_worker, args=(options["once"], options["poll_interval"]), daemon=True)
+            for _ in range(options["workers"])
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f"Started {len(processes)} workers")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+        self.stdout.write(self.style.SUCCESS("Workers stopped"))
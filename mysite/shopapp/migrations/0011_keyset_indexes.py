@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0010_updated_at_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'user', 'id'], name='shopapp_order_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['name', 'price', 'id'], name='shopapp_product_keyset'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_fts(apps, schema_editor):
+    # FTS5 is SQLite only, other backends keep LIKE search
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS shopapp_product_fts USING fts5("
+        "name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    schema_editor.execute(
+        "INSERT INTO shopapp_product_fts (rowid, name, description) "
+        "SELECT id, name, description FROM shopapp_product"
+    )
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS shopapp_product_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0011_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
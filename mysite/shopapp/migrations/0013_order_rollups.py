@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 20:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('shopapp', '0012_product_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('promocode', models.CharField(blank=True, max_length=20)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('products', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Order rollup',
+                'verbose_name_plural': 'Order rollups',
+                'ordering': ['day', 'user', 'promocode'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orderrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'user', 'promocode'), name='shopapp_orderrollup_bucket'),
+        ),
+    ]
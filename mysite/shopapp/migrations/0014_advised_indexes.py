@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0013_order_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='shopapp_order_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('archived', False)), fields=['name', 'price'], name='shopapp_product_active'),
+        ),
+    ]
@@ -23,6 +23,13 @@ class Product(models.Model):
         ordering = ["name", "price"]
         verbose_name = _("Product")
         verbose_name_plural = _("Products")
+        indexes = [
+            models.Index(fields=["updated_at", "id"], name="shopapp_product_watermark"),
+            # default API ordering with the keyset tiebreaker
+            models.Index(fields=["name", "price", "id"], name="shopapp_product_keyset"),
+            # ProductsListView: WHERE NOT archived ORDER BY name, price (advise_indexes)
+            models.Index(fields=["name", "price"], condition=models.Q(archived=False), name="shopapp_product_active"),
+        ]
 
     name = models.CharField(max_length=100, db_index=True)
     description = models.TextField(null=False, blank=True, db_index=True)
@@ -33,6 +40,8 @@ class Product(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.PROTECT, default=1)
     archived = models.BooleanField(default=False)
     preview = models.ImageField(null=True, blank=True, upload_to="")
+    # bulk paths (queryset.update, bulk_update) must set it explicitly
+    updated_at = models.DateTimeField(auto_now=True)
 
     # @property
     # def description_short(self) -> str:
@@ -65,6 +74,12 @@ class Order(models.Model):
         ordering = ["created_at", "user"]
         verbose_name = _("Order")
         verbose_name_plural = _("Orders")
+        indexes = [
+            models.Index(fields=["updated_at", "id"], name="shopapp_order_watermark"),
+            models.Index(fields=["created_at", "user", "id"], name="shopapp_order_keyset"),
+            # orders of one user in Meta.ordering (advise_indexes)
+            models.Index(fields=["user", "created_at"], name="shopapp_order_user_created"),
+        ]
 
     delivery_address = models.TextField(null=True, blank=True)
     promocode = models.CharField(max_length=20, null=False, blank=True)
@@ -72,3 +87,109 @@ class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.PROTECT)
     products = models.ManyToManyField(Product, related_name="orders")
     reciept = models.FileField(null=True, blank=True, upload_to='orders/reciepts/')
+    # also bumped when the products of the order change
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class OrderRollup(models.Model):
+    """
+    Заказы, товары и выручка за день по пользователю и промокоду.
+    Ведётся модулем shopapp.rollups, вручную не редактируется
+    """
+    class Meta:
+        ordering = ["day", "user", "promocode"]
+        verbose_name = _("Order rollup")
+        verbose_name_plural = _("Order rollups")
+        constraints = [
+            models.UniqueConstraint(fields=["day", "user", "promocode"], name="shopapp_orderrollup_bucket"),
+        ]
+
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    promocode = models.CharField(max_length=20, blank=True)
+    orders = models.PositiveIntegerField(default=0)
+    products = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(default=0, max_digits=14, decimal_places=2)
+
+    def __str__(self) -> str:
+        return f"OrderRollup(day={self.day}, user={self.user_id}, promocode={self.promocode!r})"
+
+
+class ImportJob(models.Model):
+    """
+    Фоновая задача импорта CSV, выполняется командой runjobs
+    """
+    class Meta:
+        ordering = ["-created_at"]
+        verbose_name = _("Import job")
+        verbose_name_plural = _("Import jobs")
+
+    KIND_PRODUCTS = "products"
+    KIND_ORDERS = "orders"
+    KIND_CHOICES = [
+        (KIND_PRODUCTS, _("Products")),
+        (KIND_ORDERS, _("Orders")),
+    ]
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, _("Queued")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+        (STATUS_FAILED, _("Failed")),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    file = models.FileField(upload_to="imports/")
+    encoding = models.CharField(max_length=40, blank=True)
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    rows_inserted = models.PositiveIntegerField(default=0)
+    rows_updated = models.PositiveIntegerField(default=0)
+    rows_rejected = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    message = models.TextField(blank=True)
+
+    def __str__(self) -> str:
+        return f"ImportJob(pk={self.pk}, kind={self.kind!r}, status={self.status!r})"
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Строк в секунду с момента запуска задачи
+        """
+        if not self.started_at:
+            return 0.0
+        until = self.finished_at or self.heartbeat_at or timezone.now()
+        seconds = (until - self.started_at).total_seconds()
+        if seconds <= 0:
+            return 0.0
+        return round(self.rows_done / seconds, 1)
+
+    def as_dict(self) -> dict:
+        return {
+            "pk": self.pk,
+            "kind": self.kind,
+            "status": self.status,
+            "finished": self.finished,
+            "rows_done": self.rows_done,
+            "rows_inserted": self.rows_inserted,
+            "rows_updated": self.rows_updated,
+            "rows_rejected": self.rows_rejected,
+            "throughput": self.throughput,
+            "errors": self.errors,
+            "message": self.message,
+        }
@@ -0,0 +1,245 @@
+"""
+Постраничный вывод API по ключу (keyset).
+
+Страница выбирается условием WHERE по значениям сортировки последней строки,
+а не OFFSET, поэтому далёкие страницы стоят столько же, сколько первая.
+Сортировка берётся из OrderingFilter (или Meta.ordering) и дополняется pk,
+чтобы порядок был однозначным. Старый параметр ?page= продолжает работать.
+"""
+import hashlib
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from django.core.cache import cache
+from django.db.models import F, Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .exports import decode_cursor, encode_cursor
+
+
+class OrderingKey(NamedTuple):
+    attname: str
+    descending: bool
+    nullable: bool
+    name: str
+
+    @property
+    def term(self) -> str:
+        return ("-" if self.descending else "") + self.attname
+
+    def reversed(self) -> "OrderingKey":
+        return self._replace(descending=not self.descending)
+
+    def expression(self):
+        # NULL is the smallest value on every backend, see after()
+        if not self.nullable:
+            return self.term
+        if self.descending:
+            return F(self.attname).desc(nulls_last=True)
+        return F(self.attname).asc(nulls_first=True)
+
+    def equal(self, value) -> Q:
+        if value is None:
+            return Q(**{f"{self.attname}__isnull": True})
+        return Q(**{self.attname: value})
+
+    def after(self, value) -> Q:
+        if self.descending:
+            if value is None:
+                return Q(pk__in=[])
+            return Q(**{f"{self.attname}__lt": value}) | Q(**{f"{self.attname}__isnull": True})
+        if value is None:
+            return Q(**{f"{self.attname}__isnull": False})
+        return Q(**{f"{self.attname}__gt": value})
+
+
+def keyset_ordering(queryset: QuerySet) -> List[OrderingKey]:
+    """
+    Сортировка queryset в виде колонок модели, последняя колонка уникальна
+    """
+    meta = queryset.model._meta
+    terms = queryset.query.order_by or (meta.ordering if queryset.query.default_ordering else [])
+    ordering = []
+    for term in terms:
+        if not isinstance(term, str) or term == "?":
+            raise ValueError(f"Keyset pagination needs plain field ordering, got {term!r}")
+        name = term.lstrip("-")
+        if name in queryset.query.annotations:
+            # e.g. the search rank, assumed to be non-null
+            ordering.append(OrderingKey(name, term.startswith("-"), False, name))
+            continue
+        field = meta.pk if name == "pk" else meta.get_field(name)
+        ordering.append(OrderingKey(field.attname, term.startswith("-"), field.null, field.name))
+        if field.primary_key:
+            return ordering
+    ordering.append(OrderingKey(meta.pk.attname, False, False, meta.pk.name))
+    return ordering
+
+
+def keyset_filter(ordering: List[OrderingKey], values: list) -> Q:
+    """
+    Строки, идущие в порядке ordering строго после строки со значениями values
+    """
+    condition = Q()
+    for index, key in enumerate(ordering):
+        clause = key.after(values[index])
+        for previous, value in zip(ordering[:index], values):
+            clause &= previous.equal(value)
+        condition = clause if index == 0 else condition | clause
+    first, value = ordering[0], values[0]
+    if not first.nullable:
+        # lets the database range-scan the index on the first column
+        lookup = "lte" if first.descending else "gte"
+        condition &= Q(**{f"{first.attname}__{lookup}": value})
+    return condition
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Курсорная пагинация по сортировке OrderingFilter с pk в конце.
+    С ?count=1 в ответ добавляется примерное число строк из кэша
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    count_query_param = "count"
+    count_cache_timeout = 60
+    invalid_cursor_message = "Invalid cursor"
+
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_query_param in request.query_params:
+            self.keyset = False
+            return super().paginate_queryset(queryset, request, view)
+        self.keyset = True
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        try:
+            ordering = keyset_ordering(queryset)
+        except ValueError as exc:
+            raise NotFound(str(exc)) from exc
+        terms = [key.term for key in ordering]
+        values, reverse = self.decode_position(request, terms)
+        if reverse:
+            ordering = [key.reversed() for key in ordering]
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ("1", "true"):
+            self.count = self.get_approximate_count(queryset)
+
+        page = queryset.order_by(*[key.expression() for key in ordering])
+        selected = queryset.query.values_select + tuple(queryset.query.annotation_select)
+        loaded, deferred = queryset.query.deferred_loading
+        if queryset.query.values_select:
+            # values_list(named=True) rows, as read by FastReadMixin
+            missing = [key.attname for key in ordering if key.attname not in selected]
+            if missing:
+                page = page.values_list(*selected, *missing, named=True)
+        elif not deferred:
+            # .only() querysets still need the sort columns for the cursors
+            fields = [key.name for key in ordering if key.name not in queryset.query.annotations]
+            page = page.only(*loaded, *fields)
+        if values is not None:
+            page = page.filter(keyset_filter(ordering, values))
+        rows = list(page[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        # a backward page was reached from a later one, so it always has a next page
+        has_next = has_more if not reverse else values is not None
+        has_previous = has_more if reverse else values is not None
+        self.next_cursor = self.encode_position(rows[-1], terms, False) if rows and has_next else None
+        self.previous_cursor = self.encode_position(rows[0], terms, True) if rows and has_previous else None
+        return rows
+
+    def decode_position(self, request, terms: List[str]):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            position = decode_cursor(cursor)
+        except ValueError as exc:
+            raise NotFound(self.invalid_cursor_message) from exc
+        values = position.get("v")
+        # a cursor from a different ?ordering= does not point anywhere here
+        if position.get("o") != terms or not isinstance(values, list) or len(values) != len(terms):
+            raise NotFound(self.invalid_cursor_message)
+        return values, bool(position.get("r"))
+
+    def encode_position(self, obj, terms: List[str], reverse: bool) -> str:
+        values = [getattr(obj, term.lstrip("-")) for term in terms]
+        # DjangoJSONEncoder keeps milliseconds only, the row would match its own cursor
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+        return encode_cursor({"o": terms, "v": values, "r": reverse})
+
+    def get_approximate_count(self, queryset: QuerySet) -> int:
+        """
+        COUNT(*) по фильтрам запроса, не чаще раза в count_cache_timeout секунд
+        """
+        sql, params = queryset.order_by().query.sql_with_params()
+        cache_key = "keyset_count_" + hashlib.sha256(f"{sql}{params}".encode()).hexdigest()[:32]
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.count()
+            cache.set(cache_key, count, self.count_cache_timeout)
+        return count
+
+    def get_cursor_link(self, cursor: Optional[str]) -> Optional[str]:
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        response = {
+            "next": self.get_cursor_link(self.next_cursor),
+            "previous": self.get_cursor_link(self.previous_cursor),
+            "results": data,
+        }
+        if self.count is not None:
+            response["count"] = self.count
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema["required"] = ["results"]
+        schema["properties"]["count"]["description"] = "Approximate, only with ?count=1 or ?page="
+        return schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Opaque cursor from the next or previous link",
+                "schema": {"type": "string"},
+            },
+            {
+                "name": self.count_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Include an approximate total count",
+                "schema": {"type": "boolean"},
+            },
+        ]
+
+
+class AggregatePagination(PageNumberPagination):
+    """
+    Страницы сгруппированных строк: у них нет pk для курсора
+    """
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
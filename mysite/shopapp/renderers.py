@@ -0,0 +1,41 @@
+"""
+Рендереры DRF для выгрузок.
+
+Выгрузки отдают готовый потоковый ответ, поэтому рендереры нужны только
+для согласования формата: DRF выбирает их по ?format= или заголовку Accept.
+"""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+from .exports import EXPORT_FORMATS
+
+
+class ExportRenderer(BaseRenderer):
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # only error responses get here, e.g. a 404 from the filters
+        if isinstance(data, (bytes, str)):
+            return data
+        return json.dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+class CSVExportRenderer(ExportRenderer):
+    media_type = EXPORT_FORMATS["csv"]
+    format = "csv"
+
+
+class NDJSONExportRenderer(ExportRenderer):
+    media_type = EXPORT_FORMATS["ndjson"]
+    format = "ndjson"
+
+
+class JSONExportRenderer(ExportRenderer):
+    media_type = EXPORT_FORMATS["json"]
+    format = "json"
+
+
+# the first renderer is the default when Accept allows anything
+EXPORT_RENDERERS = [CSVExportRenderer, NDJSONExportRenderer, JSONExportRenderer]
@@ -0,0 +1,129 @@
+"""
+Сводки выручки по заказам: заказы, товары и выручка за день
+по пользователю и промокоду.
+
+Сводки пересчитываются по дням: запись в заказы, их состав или цены
+товаров помечает дни затронутых заказов, и строки OrderRollup за эти дни
+собираются заново из заказов двумя запросами. Выручка заказа, как и
+в команде agg, - сумма текущих цен его товаров.
+"""
+from datetime import date, datetime, time, timedelta
+from functools import reduce
+from operator import or_
+from typing import Iterable, List, Optional, Set, Tuple
+
+from django.db import transaction
+from django.db.models import Count, Q, QuerySet, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Order, OrderRollup
+
+ROLLUP_CHUNK_SIZE = 500
+# day ranges per rebuild statement, SQLite limits the expression depth
+MAX_DAY_RANGES = 32
+
+
+def order_day(order: Order) -> date:
+    if timezone.is_aware(order.created_at):
+        return timezone.localdate(order.created_at)
+    return order.created_at.date()
+
+
+def order_days(queryset: QuerySet) -> Set[date]:
+    return set(queryset.order_by().dates("created_at", "day"))
+
+
+def day_ranges(days: Iterable[date]) -> List[Tuple[date, date]]:
+    """
+    Непрерывные полуоткрытые диапазоны [начало, конец), покрывающие days
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], day + timedelta(days=1))
+        else:
+            ranges.append((day, day + timedelta(days=1)))
+    return ranges
+
+
+def day_start(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def refresh_rollups(days: Optional[Iterable[date]] = None) -> int:
+    """
+    Пересобирает сводки за дни days (None - за всё время) из заказов
+    в одной транзакции. Возвращает число строк сводок за эти дни
+    """
+    # no savepoint inside the callers' transactions, a failure rolls them back anyway
+    with transaction.atomic(savepoint=False):
+        if days is None:
+            return rebuild_rollups(OrderRollup.objects.all(), Order.objects.all())
+        ranges = day_ranges(days)
+        count = 0
+        # separate ranges are rebuilt in batches, never widened over the days between them
+        for index in range(0, len(ranges), MAX_DAY_RANGES):
+            batch = ranges[index:index + MAX_DAY_RANGES]
+            count += rebuild_rollups(
+                OrderRollup.objects.filter(reduce(or_, (Q(day__gte=start, day__lt=end) for start, end in batch))),
+                Order.objects.filter(reduce(or_, (
+                    Q(created_at__gte=day_start(start), created_at__lt=day_start(end))
+                    for start, end in batch
+                ))),
+            )
+        return count
+
+
+def rebuild_rollups(rollups: QuerySet, orders: QuerySet) -> int:
+    # the DELETE comes first, it takes the write lock before the orders are read
+    rollups.delete()
+    rows = (
+        orders
+        .annotate(day=TruncDate("created_at"))
+        .order_by()
+        .values("day", "user_id", "promocode")
+        .annotate(
+            orders_count=Count("pk", distinct=True),
+            products_count=Count("products"),
+            revenue=Sum("products__price"),
+        )
+    )
+    created = OrderRollup.objects.bulk_create([
+        OrderRollup(
+            day=row["day"],
+            user_id=row["user_id"],
+            promocode=row["promocode"],
+            orders=row["orders_count"],
+            products=row["products_count"],
+            revenue=row["revenue"] or 0,
+        )
+        for row in rows
+    ])
+    return len(created)
+
+
+def refresh_order_rollups(pks: Iterable[int]) -> None:
+    """
+    Пересобирает сводки за дни заказов pks
+    """
+    pks = list(pks)
+    days = set()
+    for start in range(0, len(pks), ROLLUP_CHUNK_SIZE):
+        days |= order_days(Order.objects.filter(pk__in=pks[start:start + ROLLUP_CHUNK_SIZE]))
+    refresh_rollups(days)
+
+
+def product_days(pks: Iterable[int]) -> Set[date]:
+    pks = list(pks)
+    days = set()
+    for start in range(0, len(pks), ROLLUP_CHUNK_SIZE):
+        days |= order_days(Order.objects.filter(products__in=pks[start:start + ROLLUP_CHUNK_SIZE]))
+    return days
+
+
+def refresh_product_rollups(pks: Iterable[int]) -> None:
+    """
+    Пересобирает сводки за дни заказов с товарами pks, например после смены цен
+    """
+    refresh_rollups(product_days(pks))
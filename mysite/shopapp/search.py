@@ -0,0 +1,203 @@
+"""
+Полнотекстовый поиск товаров на SQLite FTS5.
+
+Таблица shopapp_product_fts хранит name и description с rowid = id товара.
+Её обновляют сигналы модели и пакетные пути записи, а пересобрать целиком
+можно командой rebuild_search_index. На других базах поиск работает
+как обычный SearchFilter через LIKE.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+from typing import Iterable, Optional
+
+from django.db import connection
+from django.db.models import FloatField, Q, QuerySet
+from django.db.models.expressions import Expression, RawSQL
+from django.db.models.sql.constants import INNER
+from rest_framework.filters import SearchFilter
+
+from .models import Product
+
+FTS_TABLE = "shopapp_product_fts"
+# bm25 weights of the name and description columns
+FTS_WEIGHTS = (10.0, 1.0)
+INDEX_CHUNK_SIZE = 500
+
+_enabled = False
+
+
+def search_enabled() -> bool:
+    global _enabled
+    # only a positive answer is remembered, the table may appear with a later migrate
+    if not _enabled:
+        _enabled = connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names()
+    return _enabled
+
+
+def create_index_sql() -> str:
+    return (
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+
+
+def _copy_rows(cursor, where: str, params: list) -> None:
+    table = connection.ops.quote_name(Product._meta.db_table)
+    cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid {where}", params)
+    cursor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+        f"SELECT id, name, description FROM {table} WHERE id {where}",
+        params,
+    )
+
+
+def index_products(pks: Iterable[int]) -> None:
+    """
+    Переиндексирует товары pks, удалённые товары пропадают из индекса
+    """
+    if not search_enabled():
+        return
+    pks = list(pks)
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), INDEX_CHUNK_SIZE):
+            chunk = pks[start:start + INDEX_CHUNK_SIZE]
+            _copy_rows(cursor, "IN (%s)" % ", ".join(["%s"] * len(chunk)), chunk)
+
+
+def index_products_after(pk: int) -> None:
+    """
+    Индексирует товары с id больше pk, например только что вставленные
+    """
+    if not search_enabled():
+        return
+    with connection.cursor() as cursor:
+        _copy_rows(cursor, "> %s", [pk])
+
+
+def rebuild_index() -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(create_index_sql())
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+            f"SELECT id, name, description FROM {connection.ops.quote_name(Product._meta.db_table)}"
+        )
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f"SELECT COUNT(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def match_expression(text: str) -> Optional[str]:
+    """
+    Все слова запроса как префиксы: 'smart pho' -> '"smart"* "pho"*'.
+    Кавычки не дают пользователю писать операторы FTS5
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def matching_pks(expression: str) -> RawSQL:
+    return RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression])
+
+
+class MatchJoin:
+    """
+    INNER JOIN результата одного запроса MATCH с bm25 каждой строки.
+    Стоит в alias_map запроса рядом с обычными Join
+    """
+    join_type = INNER
+    nullable = False
+    filtered_relation = None
+    table_name = FTS_TABLE
+
+    def __init__(self, expression: str, parent_alias: str, table_alias: str):
+        self.expression = expression
+        self.parent_alias = parent_alias
+        self.table_alias = table_alias
+
+    def as_sql(self, compiler, connection):
+        weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+        alias = compiler.quote_name_unless_alias(self.table_alias)
+        parent = compiler.quote_name_unless_alias(self.parent_alias)
+        pk = connection.ops.quote_name(Product._meta.pk.column)
+        return (
+            f"INNER JOIN (SELECT rowid, bm25({FTS_TABLE}, {weights}) AS rank FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s) {alias} ON ({alias}.rowid = {parent}.{pk})",
+            [self.expression],
+        )
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.expression,
+            change_map.get(self.parent_alias, self.parent_alias),
+            change_map.get(self.table_alias, self.table_alias),
+        )
+
+
+class MatchRank(Expression):
+    """
+    bm25 строки из MatchJoin с псевдонимом alias
+    """
+    output_field = FloatField()
+
+    def __init__(self, alias: str):
+        super().__init__()
+        self.alias = alias
+
+    def as_sql(self, compiler, connection):
+        return f"{compiler.quote_name_unless_alias(self.alias)}.rank", []
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(change_map.get(self.alias, self.alias))
+
+    def get_group_by_cols(self):
+        return [self]
+
+
+def search_products(queryset: QuerySet, text: str, rank: bool = True) -> QuerySet:
+    """
+    Товары queryset, подходящие под text. С rank=True добавляет search_rank
+    (bm25, меньше - лучше) и сортирует по нему
+    """
+    expression = match_expression(text)
+    if expression is None:
+        return queryset
+    if not rank:
+        return queryset.filter(pk__in=matching_pks(expression))
+    # MATCH runs once and is joined, a correlated subquery would repeat it for every row
+    queryset = queryset.all()
+    query = queryset.query
+    alias = f"{FTS_TABLE}_match{len(query.table_map.get(FTS_TABLE, []))}"
+    query.alias_map[alias] = MatchJoin(expression, query.get_initial_alias(), alias)
+    query.alias_refcount[alias] = 1
+    query.table_map.setdefault(FTS_TABLE, []).append(alias)
+    return queryset.annotate(search_rank=MatchRank(alias)).order_by("search_rank", "pk")
+
+
+def admin_search(queryset: QuerySet, text: str) -> QuerySet:
+    """
+    Поиск админки: name и description по индексу, price по точному значению
+    """
+    expression = match_expression(text)
+    matches = Q(pk__in=matching_pks(expression)) if expression is not None else Q(pk__in=[])
+    try:
+        price = Decimal(text.strip())
+    except InvalidOperation:
+        price = None
+    if price is not None and price.is_finite():
+        matches |= Q(price=price)
+    return queryset.filter(matches)
+
+
+class FullTextSearchFilter(SearchFilter):
+    """
+    ?search= по индексу FTS5 с сортировкой по релевантности.
+    Явный ?ordering= применяется после и заменяет сортировку по рангу
+    """
+    def filter_queryset(self, request, queryset, view):
+        if not search_enabled() or queryset.model is not Product:
+            return super().filter_queryset(request, queryset, view)
+        text = request.query_params.get(self.search_param, "")
+        return search_products(queryset, text)
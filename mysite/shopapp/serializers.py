@@ -1,11 +1,122 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils import timezone
 from rest_framework import serializers
 
 from .models import Product, Order
 
 
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    Пакетная запись списка объектов: create через bulk_create, update
+    одним UPDATE через executemany. Для update instance - queryset,
+    из которого объекты берутся по pk элементов одним in_bulk.
+    Связи многие-ко-многим не записываются
+    """
+    def item_pk(self, item):
+        try:
+            return self.child.Meta.model._meta.pk.to_python(item.get("pk"))
+        except (AttributeError, DjangoValidationError):
+            return None
+
+    def has_valid_length(self, data: list) -> bool:
+        min_length = getattr(self, "min_length", None)
+        return (
+            (self.allow_empty or len(data) > 0)
+            and (self.max_length is None or len(data) <= self.max_length)
+            and (min_length is None or len(data) >= min_length)
+        )
+
+    def to_internal_value(self, data):
+        # a list ListSerializer rejects gets its usual errors
+        if self.instance is None or not isinstance(data, list) or not self.has_valid_length(data):
+            return super().to_internal_value(data)
+        if isinstance(self.instance, QuerySet):
+            pks = {self.item_pk(item) for item in data if isinstance(item, dict)}
+            pks.discard(None)
+            self.instance = self.instance.in_bulk(pks)
+        validated = []
+        errors = []
+        for item in data:
+            try:
+                attrs = self.validate_item(item)
+            except serializers.ValidationError as exc:
+                errors.append(exc.detail)
+            else:
+                validated.append(attrs)
+                errors.append({})
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return validated
+
+    def validate_item(self, data):
+        """
+        Проверяет элемент вместе с объектом, который он обновляет
+        """
+        instance = self.instance.get(self.item_pk(data)) if isinstance(data, dict) else None
+        if instance is None and isinstance(data, dict):
+            if data.get("pk") in (None, ""):
+                raise serializers.ValidationError({"pk": ["This field is required."]})
+            raise serializers.ValidationError({"pk": [f'Invalid pk "{data["pk"]}" - object does not exist.']})
+        self.child.instance = instance
+        self.child.initial_data = data
+        attrs = self.child.run_validation(data)
+        attrs["pk"] = instance.pk
+        return attrs
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        return model.objects.bulk_create([model(**attrs) for attrs in validated_data])
+
+    def update(self, instance, validated_data):
+        model = self.child.Meta.model
+        objects = []
+        update_fields = set()
+        for attrs in validated_data:
+            attrs = dict(attrs)
+            obj = instance[attrs.pop("pk")]
+            for name, value in attrs.items():
+                setattr(obj, name, value)
+            update_fields.update(attrs)
+            objects.append(obj)
+        if update_fields:
+            # auto_now is not applied outside save()
+            now = timezone.now()
+            for model_field in model._meta.concrete_fields:
+                if getattr(model_field, "auto_now", False):
+                    for obj in objects:
+                        setattr(obj, model_field.attname, now)
+                    update_fields.add(model_field.name)
+            # an object listed twice is written once with its last values
+            write_rows(model, {obj.pk: obj for obj in objects}.values(), sorted(update_fields))
+        return objects
+
+
+def write_rows(model, objects, field_names) -> None:
+    """
+    UPDATE полей field_names одним executemany вместо bulk_update:
+    у bulk_update на тысячах строк основное время уходит на сборку CASE
+    """
+    fields = [model._meta.get_field(name) for name in field_names]
+    quote = connection.ops.quote_name
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        quote(model._meta.db_table),
+        ", ".join("%s = %%s" % quote(model_field.column) for model_field in fields),
+        quote(model._meta.pk.column),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            tuple(model_field.get_db_prep_save(getattr(obj, model_field.attname), connection) for model_field in fields)
+            + (obj.pk,)
+            for obj in objects
+        ])
+
+
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
+        list_serializer_class = BulkListSerializer
         fields = (
             "pk",
             "name",
@@ -29,4 +140,18 @@ class OrderSerializer(serializers.ModelSerializer):
             "user",
             "products",
             "reciept",
-        )
\ No newline at end of file
+        )
+
+
+class RevenueSerializer(serializers.Serializer):
+    """
+    Строка сводки выручки, в ней есть только поля группировки запроса
+    """
+    day = serializers.DateField(required=False)
+    month = serializers.DateField(required=False)
+    user = serializers.IntegerField(required=False)
+    promocode = serializers.CharField(required=False)
+    orders = serializers.IntegerField(source="orders_count")
+    products = serializers.IntegerField(source="products_count")
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    average_basket = serializers.DecimalField(max_digits=14, decimal_places=2)
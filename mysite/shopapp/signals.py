@@ -0,0 +1,129 @@
+"""
+Обработчики сигналов моделей магазина
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import bump_generation, bump_tags, user_orders_tag
+from .rollups import order_day, product_days, refresh_order_rollups, refresh_rollups
+from .search import index_products
+from .models import Order, Product, ProductImage
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Order)
+def bump_generation_on_save(sender, **kwargs):
+    bump_generation(sender)
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Order)
+def bump_generation_on_delete(sender, **kwargs):
+    # deleting a product silently drops it from orders
+    bump_generation(sender, Order)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def bump_user_orders_tag(sender, instance, **kwargs):
+    # an order moved to another user leaves the old one's exports
+    user_ids = getattr(instance, "_tag_user_ids", set()) | {instance.user_id}
+    bump_tags(*(user_orders_tag(user_id) for user_id in user_ids))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def index_product(sender, instance, **kwargs):
+    index_products([instance.pk])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def touch_product_on_images_change(sender, instance, **kwargs):
+    """
+    Картинки показываются на странице товара, поэтому двигают его версию
+    """
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+    bump_generation(Product)
+
+
+@receiver(m2m_changed, sender=Order.products.through)
+def touch_orders_on_products_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Изменение состава заказа двигает его updated_at для выгрузки изменений
+    """
+    if action == "pre_clear" and reverse:
+        # pk_set is not available for a reverse clear and the links are gone by post_clear
+        instance._cleared_orders = list(Order.objects.filter(products=instance).values_list("pk", "user_id"))
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    bump_generation(Order)
+    if not reverse:
+        orders = [(instance.pk, instance.user_id)]
+    elif pk_set:
+        orders = list(Order.objects.filter(pk__in=pk_set).values_list("pk", "user_id"))
+    else:
+        orders = getattr(instance, "_cleared_orders", [])
+    if orders:
+        Order.objects.filter(pk__in=[pk for pk, _ in orders]).update(updated_at=timezone.now())
+        bump_tags(*{user_orders_tag(user_id) for _, user_id in orders})
+
+
+@receiver(pre_save, sender=Order)
+def remember_order_state(sender, instance, **kwargs):
+    # an order moved to another day or user leaves the old ones
+    old = Order.objects.filter(pk=instance.pk).only("created_at", "user_id").first() if instance.pk else None
+    instance._rollup_days = {order_day(old)} if old else set()
+    instance._tag_user_ids = {old.user_id} if old else set()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def refresh_order_day(sender, instance, **kwargs):
+    refresh_rollups(getattr(instance, "_rollup_days", set()) | {order_day(instance)})
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_price(sender, instance, update_fields=None, **kwargs):
+    # only a new price changes the revenue, other edits skip the rebuild
+    if instance.pk is not None and (update_fields is None or "price" in update_fields):
+        instance._saved_price = Product.objects.filter(pk=instance.pk).values_list("price", flat=True).first()
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_days(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Выручка считается по текущим ценам, поэтому цена пересчитывает дни заказов с товаром
+    """
+    if created or (update_fields is not None and "price" not in update_fields):
+        return
+    saved_price = getattr(instance, "_saved_price", None)
+    if saved_price is not None and saved_price == sender._meta.get_field("price").to_python(instance.price):
+        return
+    refresh_rollups(product_days([instance.pk]))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_days(sender, instance, **kwargs):
+    # the order links are gone by post_delete
+    instance._rollup_days = product_days([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def refresh_deleted_product_days(sender, instance, **kwargs):
+    refresh_rollups(getattr(instance, "_rollup_days", set()))
+
+
+@receiver(m2m_changed, sender=Order.products.through)
+def refresh_rollups_on_products_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        instance._rollup_days = product_days([instance.pk])
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        refresh_rollups({order_day(instance)})
+    elif action == "post_clear":
+        refresh_rollups(getattr(instance, "_rollup_days", set()))
+    elif pk_set:
+        refresh_order_rollups(pk_set)
@@ -1,16 +1,48 @@
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 from string import ascii_letters
 from random import choices
 
+from django.contrib import admin
 from django.contrib.auth.models import User, Permission
-from django.test import TestCase, Client
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone, translation
+from django.utils.http import http_date
+from rest_framework.permissions import BasePermission
+from rest_framework.serializers import ListSerializer
+from mysite.cache_backends import TieredCache
+from shopapp.admin import ProductAdmin, mark_archived
+from shopapp.caching import Computed, get_or_compute, model_tag, tag_versions, user_orders_tag
+from shopapp.api_mixins import QueryBudgetExceeded
+from shopapp.common import save_csv_products, save_csv_orders, split_csv_file
+from shopapp.index_advisor import advise, candidate_index, group_queries, index_columns, iter_log_entries, query_predicates
+from shopapp.jobs import enqueue_import
+from shopapp.search import search_products
 from shopapp.utils import add_two_numbers
 
 from shopapp.models import Product
 
 from mysite import settings
 
-from shopapp.models import Order
+from shopapp.models import Order, OrderRollup, ImportJob
+from shopapp.views import OrderViewSet, ProductViewSet
 
 
 class AddTwoNumbersTestCase(TestCase):
@@ -195,8 +227,1189 @@ class OrderExportViewTestCase(TestCase):
             }
             for order in orders
         ]
-        orders_data = response.json()
+        orders_data = json.loads(b"".join(response.streaming_content))
         self.assertEqual(
             orders_data["orders"],
             expected_data,
         )
+
+    def test_orders_export_query_count(self):
+        user = User.objects.get(pk=1)
+        for index in range(20):
+            order = Order.objects.create(delivery_address=f"Address {index}", user=user)
+            order.products.set([1, 5])
+        # session, user, orders, order products
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("shopapp:orders-export"))
+            orders_data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(orders_data["orders"]), Order.objects.count())
+
+    def test_orders_export_cursor(self):
+        pks = []
+        cursor = ""
+        while cursor is not None:
+            response = self.client.get(reverse("shopapp:orders-export"), {"cursor": cursor, "limit": 1})
+            page = json.loads(b"".join(response.streaming_content))
+            pks.extend(order["pk"] for order in page["orders"])
+            cursor = page["next"]
+        self.assertEqual(pks, list(Order.objects.order_by("pk").values_list("pk", flat=True)))
+
+    def test_orders_export_bad_cursor(self):
+        response = self.client.get(reverse("shopapp:orders-export"), {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_user_orders_export(self):
+        cache.clear()
+        url = reverse("shopapp:user_orders_export", kwargs={"user_id": 1})
+        response = self.client.get(url)
+        streamed = response.json()
+        self.assertEqual(
+            [order["pk"] for order in streamed["orders"]],
+            list(Order.objects.filter(user_id=1).order_by("pk").values_list("pk", flat=True)),
+        )
+        cached = self.client.get(url)
+        self.assertEqual(cached.json(), streamed)
+
+
+class ProductsDownloadCSVTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def test_download_csv_is_streamed(self):
+        response = self.client.get(reverse("shopapp:product-download-csv"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ["name", "description", "price", "discount"])
+        self.assertEqual(
+            [row[0] for row in rows[1:]],
+            list(Product.objects.values_list("name", flat=True)),
+        )
+
+    def test_download_csv_keeps_filters(self):
+        response = self.client.get(
+            reverse("shopapp:product-download-csv"),
+            {"search": "tablet", "ordering": "-price"},
+        )
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([row[0] for row in rows[1:]], ["Tablet", "Tablet2"])
+
+
+class SaveCSVProductsTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def test_upsert_by_name(self):
+        data = (
+            "name,description,price,discount\n"
+            "Tablet,updated tablet,999.90,5\n"
+            "Brand new,,10.5,\n"
+            "Broken,,not-a-price,0\n"
+        )
+        result = save_csv_products(io.BytesIO(data.encode()), encoding="utf-8", batch_size=2)
+        self.assertEqual((result.inserted, result.updated, result.rejected), (1, 1, 1))
+        self.assertEqual(result.errors[0][0], 4)
+        tablet = Product.objects.get(pk=5)
+        self.assertEqual(tablet.description, "updated tablet")
+        self.assertEqual(str(tablet.price), "999.90")
+        self.assertEqual(Product.objects.get(name="Brand new").discount, 0)
+        self.assertFalse(Product.objects.filter(name="Broken").exists())
+
+    def test_failed_batch_keeps_other_batches(self):
+        data = (
+            "name,price\n"
+            "Good one,1\n"
+            "Bad one,1\n"
+        )
+        bulk_create = Product.objects.bulk_create
+
+        def failing_bulk_create(objs, *args, **kwargs):
+            if objs and objs[0].name == "Bad one":
+                raise DatabaseError("boom")
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(Product.objects, "bulk_create", side_effect=failing_bulk_create):
+            result = save_csv_products(io.BytesIO(data.encode()), encoding="utf-8", batch_size=1)
+        self.assertEqual((result.inserted, result.rejected), (1, 1))
+        self.assertTrue(Product.objects.filter(name="Good one").exists())
+        self.assertFalse(Product.objects.filter(name="Bad one").exists())
+
+    def test_unknown_column(self):
+        with self.assertRaises(ValueError):
+            save_csv_products(io.BytesIO(b"name,colour\nx,red\n"), encoding="utf-8")
+
+
+class SaveCSVOrdersTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        self.username = User.objects.get(pk=1).username
+
+    def test_import_orders(self):
+        data = (
+            "delivery_address,promocode,user\n"
+            f'"Vavilova, 132",FREEBAGEL,{self.username},donut,bagel\n'
+            f'"Makarova, 56",FREECHIP,{self.username},Tablet,Tablet2\n'
+            '"Nowhere, 1",,nobody,donut\n'
+            f'"Nowhere, 2",,{self.username},no such product\n'
+        )
+        result = save_csv_orders(io.BytesIO(data.encode()), encoding="utf-8")
+        self.assertEqual((result.inserted, result.rejected), (2, 2))
+        self.assertEqual([line for line, _ in result.errors], [4, 5])
+        order = Order.objects.get(promocode="FREEBAGEL")
+        self.assertEqual(order.delivery_address, "Vavilova, 132")
+        self.assertEqual(
+            sorted(order.products.values_list("name", flat=True)),
+            ["bagel", "donut"],
+        )
+
+    def test_query_count_does_not_grow_with_rows(self):
+        line = f'"Street",,{self.username},donut,bagel,Tablet\n'
+        data = "delivery_address,promocode,user\n" + line * 50
+        # users, products, savepoint, orders, order products,
+        # the day's rollups read, deleted and written, release
+        with self.assertNumQueries(9):
+            result = save_csv_orders(io.BytesIO(data.encode()), encoding="utf-8")
+        self.assertEqual(result.inserted, 50)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportJobTestCase(TestCase):
+    fixtures = [
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        self.admin = User.objects.create_superuser(username='jobadmin', password='12345')
+        self.client.force_login(self.admin)
+
+    def test_admin_import_is_queued_and_run(self):
+        upload = SimpleUploadedFile("products.csv", b"name,price\nQueued product,10\n")
+        response = self.client.post(
+            reverse("admin:import_products_csv"),
+            {"csv_file": upload},
+        )
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, reverse("admin:shopapp_importjob_progress", args=[job.pk]))
+        self.assertEqual(job.status, ImportJob.STATUS_QUEUED)
+        self.assertFalse(Product.objects.filter(name="Queued product").exists())
+
+        call_command("runjobs", "--once", stdout=io.StringIO())
+
+        status = self.client.get(reverse("admin:shopapp_importjob_status", args=[job.pk])).json()
+        self.assertEqual(status["status"], ImportJob.STATUS_DONE)
+        self.assertEqual((status["rows_done"], status["rows_inserted"]), (1, 1))
+        self.assertTrue(Product.objects.filter(name="Queued product").exists())
+
+    def test_anonymous_upload_is_rejected(self):
+        self.client.logout()
+        for name in ("admin:import_products_csv", "admin:import_orders_csv"):
+            upload = SimpleUploadedFile("import.csv", b"name,price\nAnonymous,10\n")
+            response = self.client.post(reverse(name), {"csv_file": upload})
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(reverse("admin:login"), response["Location"])
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_staff_needs_model_permissions(self):
+        staff = User.objects.create_user(username="jobstaff", is_staff=True)
+        self.client.force_login(staff)
+        job = enqueue_import(ImportJob.KIND_ORDERS, SimpleUploadedFile("orders.csv", b""), "utf-8", self.admin)
+        urls = [
+            reverse("admin:import_products_csv"),
+            reverse("admin:import_orders_csv"),
+            reverse("admin:shopapp_importjob_progress", args=[job.pk]),
+            reverse("admin:shopapp_importjob_status", args=[job.pk]),
+        ]
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff.user_permissions.add(*Permission.objects.filter(
+            codename__in=["add_product", "add_order", "view_importjob"],
+        ))
+        staff = User.objects.get(pk=staff.pk)
+        self.client.force_login(staff)
+        statuses = [self.client.get(url).status_code for url in urls]
+        # the products import also updates rows and needs change_product
+        self.assertEqual(statuses, [403, 200, 200, 200])
+        staff.user_permissions.add(Permission.objects.get(codename="change_product"))
+        self.assertEqual(self.client.get(urls[0]).status_code, 200)
+
+    def test_progress_page(self):
+        upload = SimpleUploadedFile("orders.csv", b"delivery_address,promocode,user\n")
+        job = enqueue_import(ImportJob.KIND_ORDERS, upload, "utf-8", self.admin)
+        response = self.client.get(reverse("admin:shopapp_importjob_progress", args=[job.pk]))
+        self.assertContains(response, f"Import job #{job.pk}")
+
+
+class ExportAsCSVMixinTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def test_export_uses_one_query(self):
+        model_admin = ProductAdmin(Product, admin.site)
+        request = RequestFactory().post("/")
+        with self.assertNumQueries(1):
+            response = model_admin.export_csv(request, Product.objects.order_by("pk"))
+            rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertIn("created_by__username", rows[0])
+        self.assertEqual(len(rows) - 1, Product.objects.count())
+        owner = rows[0].index("created_by_id")
+        self.assertEqual(rows[-1][owner], "2")
+
+
+class ProductsExportCacheTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+
+    def test_not_modified(self):
+        url = reverse("shopapp:products-export")
+        response = self.client.get(url)
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_gzip(self):
+        url = reverse("shopapp:products-export")
+        plain = self.client.get(url)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertNotEqual(response["ETag"], plain["ETag"])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        for accept_encoding in ("gzip;q=0, deflate", "br, *;q=0", "*;q=0.5, gzip;q=0"):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertFalse(response.has_header("Content-Encoding"), accept_encoding)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="br;q=1.0, *;q=0.1")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+
+@mock.patch("shopapp.exports.WATERMARK_LAG", timedelta(0))
+class DeltaExportTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='delta', password='12345', is_staff=True))
+
+    def test_products_since(self):
+        since = self.client.get(reverse("shopapp:products-export")).json()["since"]
+        response = self.client.get(reverse("shopapp:products-export"), {"since": since})
+        self.assertEqual(response.json()["products"], [])
+
+        product = Product.objects.get(pk=5)
+        product.price = 1
+        product.save()
+        mark_archived(None, None, Product.objects.filter(pk=6))
+        data = self.client.get(reverse("shopapp:products-export"), {"since": since}).json()
+        self.assertEqual([row["pk"] for row in data["products"]], [5, 6])
+        self.assertTrue(data["products"][1]["archived"])
+        self.assertFalse(data["more"])
+
+        data = self.client.get(reverse("shopapp:products-export"), {"since": data["since"]}).json()
+        self.assertEqual(data["products"], [])
+
+    def test_orders_since_tracks_products_change(self):
+        response = self.client.get(reverse("shopapp:orders-export"))
+        since = json.loads(b"".join(response.streaming_content))["since"]
+        Order.objects.get(pk=2).products.add(1)
+        data = self.client.get(reverse("shopapp:orders-export"), {"since": since}).json()
+        self.assertEqual([row["pk"] for row in data["orders"]], [2])
+        self.assertIn(1, data["orders"][0]["products"])
+
+    def test_bad_since(self):
+        response = self.client.get(reverse("shopapp:products-export"), {"since": "nope"})
+        self.assertEqual(response.status_code, 400)
+
+
+class ImportProductsCommandTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        self.file = tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False)
+        writer = csv.writer(self.file)
+        writer.writerow(["name", "description", "price", "discount"])
+        writer.writerow(["Tablet", "updated\nover two lines, with \"quotes\"", "999.90", "5"])
+        for index in range(30):
+            writer.writerow([f"Imported {index}", "", f"{index}.50", ""])
+        writer.writerow(["Broken", "", "not-a-price", "0"])
+        self.file.close()
+
+    def tearDown(self) -> None:
+        os.unlink(self.file.name)
+
+    def test_split_keeps_quoted_rows_whole(self):
+        header, ranges = split_csv_file(self.file.name, chunk_bytes=20)
+        self.assertEqual(header, ["name", "description", "price", "discount"])
+        with open(self.file.name, "rb") as file:
+            data = file.read()
+        rows = []
+        for start, end in ranges:
+            rows.extend(csv.reader(io.StringIO(data[start:end].decode(), newline="")))
+        self.assertEqual(len(rows), 32)
+        self.assertEqual(rows[0][1], "updated\nover two lines, with \"quotes\"")
+
+    def test_import(self):
+        out = io.StringIO()
+        err = io.StringIO()
+        call_command("import_products", self.file.name, "--workers", "1", "--chunk-size", "1", stdout=out, stderr=err)
+        self.assertIn("1 updated, 1 rejected", out.getvalue())
+        # the quoted description takes two lines of the file
+        self.assertIn("Line 34:", err.getvalue())
+        tablet = Product.objects.get(pk=5)
+        self.assertEqual(str(tablet.price), "999.90")
+        self.assertTrue(tablet.description.startswith("updated\n"))
+        imported = Product.objects.get(name="Imported 3")
+        self.assertEqual((str(imported.price), imported.discount, imported.archived), ("3.50", 0, False))
+
+    def test_import_in_worker_processes(self):
+        with open(self.file.name, "a", newline="") as file:
+            writer = csv.writer(file)
+            for index in range(300):
+                writer.writerow([f"Pooled {index}", f"line one\nline two of {index}", f"{index}.25", ""])
+            writer.writerow(["Broken again", "", "not-a-price", "0"])
+        err = io.StringIO()
+        call_command(
+            "import_products", self.file.name, "--workers", "2", "--chunk-size", "0",
+            stdout=io.StringIO(), stderr=err,
+        )
+        self.assertEqual(Product.objects.filter(name__startswith="Pooled").count(), 300)
+        self.assertEqual(str(Product.objects.get(name="Pooled 299").price), "299.25")
+        self.assertIn("Line 34:", err.getvalue())
+        self.assertIn(f"Line {34 + 2 * 300 + 1}:", err.getvalue())
+
+    def test_blank_cells_keep_values(self):
+        tablet = Product.objects.get(pk=5)
+        Product.objects.filter(pk=5).update(price="12.50", description="Kept")
+        data = f"name,description,price,discount\n{tablet.name},,,3\n".encode()
+        with open(self.file.name, "wb") as file:
+            file.write(data)
+        call_command("import_products", self.file.name, "--workers", "1", stdout=io.StringIO())
+        imported = Product.objects.get(pk=5)
+        Product.objects.filter(pk=5).update(discount=0)
+        save_csv_products(io.BytesIO(data), encoding="utf-8")
+        saved = Product.objects.get(pk=5)
+        for product in (imported, saved):
+            self.assertEqual((str(product.price), product.description, product.discount), ("12.50", "Kept", 3))
+
+
+class ExportFormatsTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='formats', password='12345', is_staff=True))
+
+    def test_products_ndjson_gzip(self):
+        response = self.client.get(
+            reverse("shopapp:products-export"),
+            HTTP_ACCEPT="application/x-ndjson",
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("X-Export-Since", response)
+        lines = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line)["pk"] for line in lines],
+            list(Product.objects.order_by("pk").values_list("pk", flat=True)),
+        )
+
+    def test_orders_csv(self):
+        response = self.client.get(reverse("shopapp:orders-export"), {"format": "csv"})
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ["pk", "delivery_address", "promocode", "user", "products"])
+        self.assertEqual(len(rows) - 1, Order.objects.count())
+
+    def test_download_csv_negotiates(self):
+        response = self.client.get(reverse("shopapp:product-download-csv"), HTTP_ACCEPT="application/json")
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(data["products"]), Product.objects.count())
+        response = self.client.get(reverse("shopapp:product-download-csv"), {"format": "ndjson"})
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=products-export.ndjson")
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse("shopapp:orders-export"), {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+
+class KeysetPaginationTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+
+    def walk(self, url, params):
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            data = response.json()
+            pages.append([row["pk"] for row in data["results"]])
+            if data["next"] is None:
+                return pages, data
+            self.assertLess(len(pages), 100, "the cursor does not advance")
+            response = self.client.get(data["next"])
+
+    def test_pages_follow_ordering(self):
+        url = reverse("shopapp:product-list")
+        pages, last = self.walk(url, {"page_size": 2, "ordering": "-price"})
+        expected = list(Product.objects.order_by("-price", "pk").values_list("pk", flat=True))
+        self.assertEqual(sum(pages, []), expected)
+        self.assertTrue(all(len(page) == 2 for page in pages[:-1]))
+        self.assertNotIn("count", last)
+
+        previous = self.client.get(last["previous"]).json()
+        self.assertEqual([row["pk"] for row in previous["results"]], pages[-2])
+
+    def test_orders_default_ordering(self):
+        pages, _ = self.walk(reverse("shopapp:order-list"), {"page_size": 1})
+        self.assertEqual(
+            sum(pages, []),
+            list(Order.objects.order_by("created_at", "user", "pk").values_list("pk", flat=True)),
+        )
+
+    def test_sub_millisecond_timestamps(self):
+        start = timezone.now()
+        pks = list(Order.objects.order_by("pk").values_list("pk", flat=True))
+        for index, pk in enumerate(pks):
+            Order.objects.filter(pk=pk).update(created_at=start + timedelta(microseconds=index * 10), user_id=1)
+        pages, _ = self.walk(reverse("shopapp:order-list"), {"page_size": 1})
+        self.assertEqual(sum(pages, []), pks)
+
+    def test_nullable_ordering(self):
+        Order.objects.filter(pk=Order.objects.order_by("pk").values_list("pk", flat=True)[1]).update(delivery_address=None)
+        rows = list(Order.objects.values_list("delivery_address", "pk"))
+        by_address = [pk for _, pk in sorted(rows, key=lambda row: (row[0] is not None, row[0] or "", row[1]))]
+        pages, _ = self.walk(reverse("shopapp:order-list"), {"page_size": 1, "ordering": "delivery_address"})
+        self.assertEqual(sum(pages, []), by_address)
+        pages, _ = self.walk(reverse("shopapp:order-list"), {"page_size": 1, "ordering": "-delivery_address"})
+        self.assertEqual(sum(pages, []), by_address[::-1])
+
+    def test_count_and_bad_cursor(self):
+        url = reverse("shopapp:product-list")
+        data = self.client.get(url, {"count": 1}).json()
+        self.assertEqual(data["count"], Product.objects.count())
+        response = self.client.get(url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_number_still_works(self):
+        data = self.client.get(reverse("shopapp:product-list"), {"page": 1}).json()
+        self.assertEqual(data["count"], Product.objects.count())
+
+
+@override_settings(QUERY_BUDGET_RAISE=True)
+class QueryBudgetTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        user = User.objects.get(pk=1)
+        self.orders = Order.objects.bulk_create(
+            Order(user=user, delivery_address=f"street {index}") for index in range(100)
+        )
+        products = list(Product.objects.all())
+        Order.products.through.objects.bulk_create(
+            Order.products.through(order_id=order.pk, product_id=product.pk)
+            for order in self.orders
+            for product in products[:3]
+        )
+
+    def test_endpoints_within_budget(self):
+        urls = [
+            (reverse("shopapp:order-list"), {"page_size": 100}),
+            (reverse("shopapp:order-list"), {"page": 2, "search": "street"}),
+            (reverse("shopapp:order-detail", kwargs={"pk": self.orders[0].pk}), {}),
+            (reverse("shopapp:product-list"), {"page": 1}),
+            (reverse("shopapp:product-detail", kwargs={"pk": 5}), {}),
+        ]
+        for url, params in urls:
+            with self.subTest(url=url, params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+
+    def test_orders_list_queries_do_not_grow(self):
+        with self.assertNumQueries(2):
+            data = self.client.get(reverse("shopapp:order-list"), {"page_size": 100}).json()
+        self.assertEqual(len(data["results"]), 100)
+        self.assertEqual(len(data["results"][-1]["products"]), 3)
+
+    def test_counter_removed_after_errors(self):
+        wrappers = list(connection.execute_wrappers)
+        with mock.patch.object(OrderViewSet, "list", side_effect=RuntimeError):
+            for _ in range(3):
+                with self.assertRaises(RuntimeError):
+                    self.client.get(reverse("shopapp:order-list"))
+        self.assertEqual(connection.execute_wrappers, wrappers)
+
+    def test_over_budget_raises(self):
+        with mock.patch.dict(OrderViewSet.query_budget, {"list": 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse("shopapp:order-list"))
+
+
+class SparseFieldsetTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+
+    def test_fields_are_pushed_down(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(reverse("shopapp:product-list"), {"fields": "pk,name,price", "page_size": 3}).json()
+        self.assertEqual(list(data["results"][0]), ["pk", "name", "price"])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("description", queries[0]["sql"])
+        next_page = self.client.get(data["next"]).json()
+        self.assertEqual(list(next_page["results"][0]), ["pk", "name", "price"])
+
+    def test_omit(self):
+        data = self.client.get(reverse("shopapp:order-detail", kwargs={"pk": 1}), {"omit": "products,reciept"}).json()
+        self.assertEqual(list(data), ["pk", "delivery_address", "promocode", "created_at", "user"])
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse("shopapp:product-list"), {"fields": "pk,secret"})
+        self.assertEqual(response.status_code, 400)
+
+
+class FastReadTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        Product.objects.filter(pk=5).update(preview="products/tablet.png")
+        Order.objects.filter(pk=1).update(delivery_address=None)
+
+    def get_both(self, url, params=None):
+        cache.clear()
+        fast = self.client.get(url, params)
+        cache.clear()
+        with mock.patch.object(ProductViewSet, "fast_read", False), mock.patch.object(OrderViewSet, "fast_read", False):
+            slow = self.client.get(url, params)
+        self.assertEqual(fast.status_code, slow.status_code)
+        return fast.content, slow.content
+
+    def test_output_matches_serializer(self):
+        requests = [
+            (reverse("shopapp:product-list"), {"page_size": 100}),
+            (reverse("shopapp:product-list"), {"page": 1, "ordering": "-price"}),
+            (reverse("shopapp:product-list"), {"fields": "pk,preview", "page_size": 2}),
+            (reverse("shopapp:product-detail", kwargs={"pk": 5}), None),
+            (reverse("shopapp:product-detail", kwargs={"pk": 999}), None),
+            (reverse("shopapp:order-list"), None),
+            (reverse("shopapp:order-detail", kwargs={"pk": 1}), {"omit": "reciept"}),
+        ]
+        for url, params in requests:
+            with self.subTest(url=url, params=params):
+                fast, slow = self.get_both(url, params)
+                self.assertEqual(fast, slow)
+
+    def test_object_permissions_get_the_instance(self):
+        class IsOwner(BasePermission):
+            def has_object_permission(self, request, view, obj):
+                return obj.created_by_id == request.user.pk
+
+        url = reverse("shopapp:product-detail", kwargs={"pk": 5})
+        owner = User.objects.get(pk=Product.objects.get(pk=5).created_by_id)
+        with mock.patch.object(ProductViewSet, "permission_classes", [IsOwner]):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.client.force_login(owner)
+            self.assertEqual(self.client.get(url).json()["pk"], 5)
+
+
+class ResponseCacheTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.url = reverse("shopapp:product-list")
+
+    def names(self, params=None):
+        return [row["name"] for row in self.client.get(self.url, params or {"page_size": 100}).json()["results"]]
+
+    def test_cache_hit_runs_no_queries(self):
+        self.names()
+        with self.assertNumQueries(0):
+            self.names()
+        # same parameters in another order share the entry
+        self.names({"page_size": 100, "ordering": "price"})
+        with self.assertNumQueries(0):
+            self.client.get(self.url + "?ordering=price&page_size=100&fields=")
+
+    def test_links_follow_the_host(self):
+        params = {"page_size": 1}
+        self.client.get(self.url, params)
+        response = self.client.get(self.url, params, HTTP_HOST="127.0.0.1", secure=True)
+        self.assertTrue(response.json()["next"].startswith("https://127.0.0.1/"))
+
+    def test_writes_are_visible_immediately(self):
+        self.assertNotIn("Cached", self.names())
+        Product.objects.create(name="Cached", price=1, created_by_id=1)
+        self.assertIn("Cached", self.names())
+
+        archived = {row["pk"]: row["archived"] for row in self.client.get(self.url, {"page_size": 100}).json()["results"]}
+        self.assertFalse(archived[5])
+        mark_archived(None, None, Product.objects.filter(pk=5))
+        archived = {row["pk"]: row["archived"] for row in self.client.get(self.url, {"page_size": 100}).json()["results"]}
+        self.assertTrue(archived[5])
+
+
+class ConditionalGetTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def assertNotModified(self, url, response, queries=1):
+        with self.assertNumQueries(queries):
+            again = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 304)
+        if url == reverse("shopapp:products-feed"):
+            # a delete cannot move a timestamp, the feed is validated by its ETag only
+            self.assertFalse(response.has_header("Last-Modified"))
+            return
+        again = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(again.status_code, 304)
+
+    def test_api_and_page(self):
+        for url in (
+            reverse("shopapp:product-detail", kwargs={"pk": 5}),
+            reverse("shopapp:product_details", kwargs={"pk": 5}),
+            reverse("shopapp:products-feed"),
+        ):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotModified(url, response)
+
+    def test_change_invalidates(self):
+        url = reverse("shopapp:product-detail", kwargs={"pk": 5})
+        response = self.client.get(url)
+        fields_etag = self.client.get(url, {"fields": "pk"})["ETag"]
+        self.assertNotEqual(fields_etag, response["ETag"])
+        product = Product.objects.get(pk=5)
+        product.price = 1
+        product.save()
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json()["price"], "1.00")
+
+    def test_delete_invalidates_feed(self):
+        url = reverse("shopapp:products-feed")
+        response = self.client.get(url)
+        oldest = Product.objects.order_by("updated_at").first()
+        Product.objects.filter(pk=oldest.pk).delete()
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 200)
+        since = http_date(Product.objects.aggregate(version=Max("updated_at"))["version"].timestamp())
+        again = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(again.status_code, 200)
+
+
+class FullTextSearchTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.url = reverse("shopapp:product-list")
+
+    def search(self, text, **params):
+        response = self.client.get(self.url, {"search": text, **params})
+        return [row["name"] for row in response.json()["results"]]
+
+    def test_ranked_prefix_search(self):
+        Product.objects.create(name="Phone case", description="fits any smartphone", created_by_id=1)
+        Product.objects.create(name="Cable", description="charges a phone", created_by_id=1)
+        with CaptureQueriesContext(connection) as queries:
+            names = self.search("phon", count=1)
+        # the index is queried once per statement, not once per matching row
+        self.assertTrue(all(query["sql"].count("MATCH") <= 1 for query in queries.captured_queries))
+        self.assertEqual(names[0], "Phone case")
+        ranked = search_products(Product.objects.all(), "phon")
+        self.assertEqual(Product.objects.filter(pk__in=ranked.values("pk")).count(), ranked.count())
+        self.assertIn("Cable", names)
+        self.assertEqual(self.search("phon", ordering="name"), sorted(names))
+
+    def test_index_follows_writes(self):
+        product = Product.objects.create(name="Zeppelin", created_by_id=1)
+        self.assertEqual(self.search("zeppelin"), ["Zeppelin"])
+        product.name = "Blimp"
+        product.save()
+        self.assertEqual(self.search("zeppelin"), [])
+        save_csv_products(io.BytesIO(b"name,description\nBlimp,big zeppelin\nAirship,zeppelin too\n"), encoding="utf-8")
+        self.assertEqual(sorted(self.search("zeppelin")), ["Airship", "Blimp"])
+        product.delete()
+        self.assertEqual(self.search("zeppelin"), ["Airship"])
+
+    def test_keyset_pages_by_rank(self):
+        for index in range(5):
+            Product.objects.create(name=f"Gadget {index}", description="gadget " * index, created_by_id=1)
+        first = self.client.get(self.url, {"search": "gadget", "page_size": 2}).json()
+        pages = [row["pk"] for row in first["results"]]
+        response = first
+        while response["next"]:
+            response = self.client.get(response["next"]).json()
+            pages += [row["pk"] for row in response["results"]]
+        self.assertEqual(len(pages), 5)
+        self.assertEqual(len(set(pages)), 5)
+
+    def test_rebuild_command(self):
+        out = io.StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn(f"Indexed {Product.objects.count()} products", out.getvalue())
+
+
+class BulkWriteTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.url = reverse("shopapp:product-bulk")
+
+    def send(self, method, payload):
+        return getattr(self.client, method)(self.url, json.dumps(payload), content_type="application/json")
+
+    def test_create(self):
+        payload = [{"name": f"Bulk {index}", "price": "1.50", "created_by": 1} for index in range(30)]
+        with self.assertNumQueries(5):
+            response = self.send("post", payload)
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual([row["name"] for row in data], [item["name"] for item in payload])
+        self.assertTrue(all(row["pk"] for row in data))
+        self.assertEqual(Product.objects.filter(name__startswith="Bulk ").count(), 30)
+
+    def test_partial_update(self):
+        product = Product.objects.get(pk=5)
+        listed = self.client.get(reverse("shopapp:product-list"), {"page_size": 100}).json()
+        pks = [row["pk"] for row in listed["results"]]
+        payload = [{"pk": pk, "price": "9.99", "discount": 5} for pk in pks]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.send("patch", payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 10)
+        self.assertEqual([row["pk"] for row in response.json()], pks)
+        product.refresh_from_db()
+        self.assertEqual((str(product.price), product.discount), ("9.99", 5))
+        self.assertGreater(product.updated_at, Product.objects.get(pk=5).created_at)
+        # the response cache saw the write
+        listed = self.client.get(reverse("shopapp:product-list"), {"page_size": 100}).json()
+        self.assertEqual({row["price"] for row in listed["results"]}, {"9.99"})
+
+    def test_update_without_child_validation_hook(self):
+        # DRF 3.14, which the project pins, has no ListSerializer.run_child_validation
+        with mock.patch.object(ListSerializer, "run_child_validation", side_effect=AssertionError, create=True):
+            response = self.send("patch", [{"pk": 5, "discount": 7}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["pk"], 5)
+        self.assertEqual(Product.objects.get(pk=5).discount, 7)
+
+    def test_errors_are_per_item_and_nothing_is_written(self):
+        before = Product.objects.get(pk=5).price
+        response = self.send("patch", [{"pk": 5, "price": "1.00"}, {"pk": 999999}, {"price": "x"}])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertIn("pk", errors[1])
+        self.assertIn("pk", errors[2])
+        self.assertEqual(Product.objects.get(pk=5).price, before)
+
+        response = self.send("put", [{"pk": 5, "price": "1.00"}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.send("post", []).status_code, 400)
+
+
+class OrderRollupTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='rollup', password='12345', is_staff=True)
+        self.client.force_login(self.user)
+        self.phone, self.case = Product.objects.order_by("pk")[:2]
+        self.day = timezone.now().replace(year=2026, month=3, day=1, hour=12)
+
+    def live_totals(self):
+        rows = (
+            Order.objects
+            .annotate(day=TruncDate("created_at"))
+            .order_by()
+            .values("day", "user_id", "promocode")
+            .annotate(count=Count("pk", distinct=True), items=Count("products"), revenue=Sum("products__price"))
+        )
+        return {
+            (row["day"], row["user_id"], row["promocode"]): (row["count"], row["items"], row["revenue"] or 0)
+            for row in rows
+        }
+
+    def rollups(self):
+        return {
+            (row.day, row.user_id, row.promocode): (row.orders, row.products, row.revenue)
+            for row in OrderRollup.objects.all()
+        }
+
+    def test_rollups_follow_writes(self):
+        order = Order.objects.create(user=self.user, promocode="SALE", created_at=self.day)
+        order.products.add(self.phone, self.case)
+        other = Order.objects.create(user=self.user, created_at=self.day + timedelta(days=1))
+        self.phone.orders.add(other)
+        self.assertEqual(self.rollups(), self.live_totals())
+
+        self.phone.price += 10
+        self.phone.save()
+        self.assertEqual(self.rollups(), self.live_totals())
+
+        order.created_at = self.day - timedelta(days=3)
+        order.save()
+        order.products.remove(self.case)
+        self.assertEqual(self.rollups(), self.live_totals())
+
+        self.phone.orders.clear()
+        other.delete()
+        self.assertEqual(self.rollups(), self.live_totals())
+
+        save_csv_orders(
+            io.BytesIO(f"user,promocode\nrollup,CSV,{self.phone.name},{self.case.name}\n".encode()),
+            encoding="utf-8",
+        )
+        self.client.patch(
+            reverse("shopapp:product-bulk"),
+            json.dumps([{"pk": self.case.pk, "price": "1.00"}]),
+            content_type="application/json",
+        )
+        self.assertEqual(self.rollups(), self.live_totals())
+
+        OrderRollup.objects.all().delete()
+        out = io.StringIO()
+        call_command("backfill_rollups", stdout=out)
+        self.assertIn(f"Wrote {len(self.live_totals())} rollup rows", out.getvalue())
+        self.assertEqual(self.rollups(), self.live_totals())
+
+    def test_price_edits_only(self):
+        order = Order.objects.create(user=self.user, created_at=self.day)
+        order.products.add(self.phone)
+        self.phone.description = "New description"
+        with CaptureQueriesContext(connection) as queries:
+            self.phone.save()
+        self.assertFalse(any("orderrollup" in query["sql"] for query in queries.captured_queries))
+        self.phone.price += 1
+        self.phone.save()
+        self.assertEqual(self.rollups(), self.live_totals())
+
+    def test_scattered_days(self):
+        for offset in range(0, 80, 2):
+            order = Order.objects.create(user=self.user, created_at=self.day + timedelta(days=offset))
+            order.products.add(self.phone)
+        untouched = Order.objects.create(user=self.user, created_at=self.day + timedelta(days=1))
+        untouched.products.add(self.case)
+        OrderRollup.objects.filter(day=untouched.created_at.date()).update(orders=100)
+        self.phone.price += 1
+        self.phone.save()
+        rollups = self.rollups()
+        self.assertEqual(rollups.pop((untouched.created_at.date(), self.user.pk, untouched.promocode))[0], 100)
+        live = self.live_totals()
+        del live[(untouched.created_at.date(), self.user.pk, untouched.promocode)]
+        self.assertEqual(rollups, live)
+
+    def test_revenue_api(self):
+        url = reverse("shopapp:revenue")
+        for offset, promocode in ((0, "A"), (0, ""), (40, "A")):
+            order = Order.objects.create(user=self.user, promocode=promocode, created_at=self.day + timedelta(days=offset))
+            order.products.add(self.phone, self.case)
+        total = self.phone.price + self.case.price
+
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {"group_by": "month,promocode", "user": self.user.pk})
+        rows = response.json()["results"]
+        self.assertEqual([(row["month"], row["promocode"], row["orders"]) for row in rows], [
+            ("2026-03-01", "", 1),
+            ("2026-03-01", "A", 1),
+            ("2026-04-01", "A", 1),
+        ])
+        self.assertNotIn("day", rows[0])
+
+        rows = self.client.get(url, {"until": "2026-03-01", "user": self.user.pk}).json()["results"]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["orders"], 2)
+        self.assertEqual(rows[0]["products"], 4)
+        self.assertEqual(rows[0]["revenue"], f"{total * 2:.2f}")
+        self.assertEqual(rows[0]["average_basket"], f"{total:.2f}")
+
+        self.assertEqual(self.client.get(url, {"group_by": "price"}).status_code, 400)
+        self.client.force_login(User.objects.create_user(username='plain', password='12345'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class IndexAdvisorTestCase(TestCase):
+    log = (
+        '2026-10-18 DEBUG [django.db.backends] (0.020) SELECT "shopapp_importjob"."id" FROM "shopapp_importjob" '
+        'WHERE "shopapp_importjob"."kind" = \'products\' ORDER BY "shopapp_importjob"."created_at" DESC; args=(); alias=default\n'
+        '(0.010) SELECT "shopapp_importjob"."id" FROM "shopapp_importjob" WHERE "shopapp_importjob"."kind" = \'ord\n'
+        'ers\' ORDER BY "shopapp_importjob"."created_at" DESC; args=(); alias=default\n'
+        '(0.001) SELECT "shopapp_order"."id" FROM "shopapp_order" WHERE "shopapp_order"."user_id" = 1 '
+        'ORDER BY "shopapp_order"."created_at" ASC, "shopapp_order"."user_id" ASC; args=(1,); alias=default\n'
+    )
+
+    def test_groups_and_advice(self):
+        groups = group_queries(iter_log_entries(io.StringIO(self.log)))
+        self.assertEqual([group.count for group in groups], [2, 1])
+        self.assertAlmostEqual(groups[0].total, 0.03)
+        self.assertIn("\"kind\" = ? ORDER BY", groups[0].statement)
+
+        advice = advise(groups[0])
+        self.assertIn("USE TEMP B-TREE FOR ORDER BY", advice.plan)
+        self.assertEqual(advice.index.fields, ["kind", "-created_at"])
+        self.assertLess(advice.new_cost, advice.cost)
+        # the proposal was only tried
+        self.assertNotIn(advice.index.name, index_columns("shopapp_importjob"))
+
+        advice = advise(groups[1])
+        self.assertEqual(advice.cost, 0)
+        self.assertIsNone(advice.index)
+
+    def test_partial_index_for_boolean_filter(self):
+        sql = (
+            'SELECT "shopapp_importjob"."id" FROM "shopapp_importjob" WHERE NOT "shopapp_importjob"."rows_done" = 0 '
+            'AND "shopapp_importjob"."started_at" IS NULL ORDER BY "shopapp_importjob"."created_at" ASC'
+        )
+        predicates = query_predicates(sql)
+        self.assertEqual(predicates.condition, {"started_at": None})
+        self.assertEqual(predicates.ordering, [("created_at", False)])
+        index = candidate_index(ImportJob, predicates)
+        self.assertEqual(index.fields, ["created_at"])
+        self.assertEqual(index.condition, Q(started_at__isnull=True))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as file:
+            file.write(self.log)
+        self.addCleanup(os.remove, file.name)
+        out = io.StringIO()
+        call_command("advise_indexes", file.name, stdout=out)
+        self.assertIn("3 statements, 2 distinct", out.getvalue())
+        self.assertIn("add to ImportJob.Meta.indexes", out.getvalue())
+
+
+def set_in_worker(location, key, value):
+    TieredCache(location, {}).set(key, value)
+
+
+class TieredCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.location = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+        self.cache = TieredCache(self.location, {"OPTIONS": {"LOCAL_MAX_ENTRIES": 3}})
+
+    def test_local_tier(self):
+        self.cache.set("a", {"value": 1}, 300)
+        self.cache.set("gone", 1, 0)
+        self.assertEqual(self.cache.get("a"), {"value": 1})
+        self.cache.get("a")["value"] = 2
+        self.assertEqual(self.cache.get("a"), {"value": 1})
+        self.assertIsNone(self.cache.get("gone"))
+        self.assertEqual(self.cache.stats()["local_hits"], 2)
+        for key in "bcd":
+            self.cache.set(key, key, None)
+            self.cache.get(key)
+        stats = self.cache.stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertEqual(self.cache.get("a"), {"value": 1})
+
+        with mock.patch("time.time", return_value=timezone.now().timestamp() + 301):
+            self.assertIsNone(self.cache.get("a"))
+            self.assertEqual(self.cache.get("b"), "b")
+
+    def test_writes_in_other_workers(self):
+        self.cache.set("key", "old")
+        self.cache.set("other", "value")
+        self.assertEqual(self.cache.get("key"), "old")
+        self.assertIsNone(self.cache.get("new"))
+        worker = multiprocessing.get_context("fork").Process(target=set_in_worker, args=(self.location, "key", "new"))
+        worker.start()
+        worker.join()
+        self.assertEqual(self.cache.get("key"), "new")
+        self.assertEqual(self.cache.get("other"), "value")
+
+        self.cache.delete("key")
+        self.assertIsNone(TieredCache(self.location, {}).get("key"))
+        self.assertTrue(self.cache.add("key", 1))
+        self.assertEqual(self.cache.incr("key", 2), 3)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("other"))
+
+
+class GetOrComputeTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.delete_many(["value", "value:lock"])
+        self.compute = mock.Mock(return_value="new")
+
+    def test_single_flight(self):
+        def slow():
+            time.sleep(0.2)
+            return "new"
+
+        compute = mock.Mock(side_effect=slow)
+        with ThreadPoolExecutor(5) as executor:
+            results = list(executor.map(lambda _: get_or_compute("value", compute, 300), range(5)))
+        self.assertEqual(results, ["new"] * 5)
+        compute.assert_called_once()
+        self.assertEqual(get_or_compute("value", compute, 300), "new")
+        compute.assert_called_once()
+
+    def test_stale_while_revalidate(self):
+        cache.set("value", Computed("old", 0.1, time.time() - 1))
+        cache.add("value:lock", "other worker")
+        self.assertEqual(get_or_compute("value", self.compute, 300), "old")
+        self.compute.assert_not_called()
+
+        cache.delete("value:lock")
+        self.assertEqual(get_or_compute("value", self.compute, 300), "new")
+        self.compute.assert_called_once()
+        self.assertIsNone(cache.get("value:lock"))
+
+    def test_early_refresh(self):
+        cache.set("value", Computed("old", 10, time.time() + 5))
+        with mock.patch("random.random", return_value=0.1):
+            self.assertEqual(get_or_compute("value", self.compute, 300), "old")
+        with mock.patch("random.random", return_value=0.9):
+            self.assertEqual(get_or_compute("value", self.compute, 300), "new")
+
+    def test_tags(self):
+        self.assertEqual(get_or_compute("value", self.compute, 300, tags=["a", "b"]), "new")
+        self.assertEqual(get_or_compute("value", self.compute, 300, tags=["a", "b"]), "new")
+        self.compute.assert_called_once()
+        cache.delete("tag:b")
+        get_or_compute("value", self.compute, 300, tags=["a", "b"])
+        self.assertEqual(self.compute.call_count, 2)
+
+
+class TagInvalidationTestCase(TestCase):
+    fixtures = [
+        'products-fixture.json',
+        'auth-fixture.json',
+        'orders-fixture.json',
+    ]
+
+    def setUp(self) -> None:
+        self.client.force_login(User.objects.get(pk=1))
+
+    def export(self, user_id):
+        response = self.client.get(reverse("shopapp:user_orders_export", kwargs={"user_id": user_id}))
+        return [order["pk"] for order in response.json()["orders"]]
+
+    def test_user_orders_export(self):
+        other = User.objects.create_user(username="other")
+        self.export(1)
+        other_versions = tag_versions([user_orders_tag(other.pk)])
+
+        order = Order.objects.create(delivery_address="Address", user_id=1)
+        self.assertIn(order.pk, self.export(1))
+        order.products.set([1])
+        versions = tag_versions([user_orders_tag(1)])
+        Product.objects.get(pk=1).orders.clear()
+        self.assertNotEqual(tag_versions([user_orders_tag(1)]), versions)
+
+        order.user = other
+        order.save()
+        self.assertNotIn(order.pk, self.export(1))
+        self.assertEqual(self.export(other.pk), [order.pk])
+        order.delete()
+        self.assertEqual(self.export(other.pk), [])
+        self.assertNotEqual(tag_versions([user_orders_tag(other.pk)]), other_versions)
+
+    def test_bulk_paths(self):
+        versions = tag_versions([model_tag(Product), user_orders_tag(1)])
+        mark_archived(None, None, Product.objects.filter(pk=1))
+        product_version, orders_version = tag_versions([model_tag(Product), user_orders_tag(1)])
+        self.assertNotEqual(product_version, versions[0])
+        self.assertEqual(orders_version, versions[1])
+
+
+class FragmentCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username="buyer")
+        self.client.force_login(self.user)
+        self.product = Product.objects.create(name="Lamp", price="10.00")
+        self.other = Product.objects.create(name="Chair", price="20.00")
+        self.order = Order.objects.create(delivery_address="Address", user=self.user)
+        self.order.products.set([self.product, self.other])
+
+    def test_products_list(self):
+        url = reverse("shopapp:products_list")
+        self.assertContains(self.client.get(url), "Lamp")
+        # a change that does not move the version is not seen, the fragments are cached
+        Product.objects.filter(pk=self.product.pk).update(name="Desk lamp")
+        self.assertNotContains(self.client.get(url), "Desk lamp")
+        self.product.refresh_from_db()
+        self.product.save()
+        response = self.client.get(url)
+        self.assertContains(response, "Desk lamp")
+        self.assertContains(response, "Chair")
+
+    def test_orders_list(self):
+        url = reverse("shopapp:orders_list")
+        self.assertContains(self.client.get(url), "Lamp for $10.00")
+        Product.objects.filter(pk=self.product.pk).update(name="Desk lamp")
+        self.assertNotContains(self.client.get(url), "Desk lamp")
+        self.product.refresh_from_db()
+        self.product.save()
+        self.assertContains(self.client.get(url), "Desk lamp for $10.00")
+        self.user.first_name = "Ann"
+        self.user.save()
+        self.assertContains(self.client.get(url), "Order by Ann")
+
+    def test_orders_list_per_language(self):
+        cache.clear()
+        with translation.override("ru"):
+            self.assertContains(self.client.get(reverse("shopapp:orders_list")), "Lamp for $10,00")
+        with translation.override("en"):
+            self.assertContains(self.client.get(reverse("shopapp:orders_list")), "Lamp for $10.00")
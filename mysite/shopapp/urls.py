@@ -1,7 +1,9 @@
 from django.urls import path, include
 from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
 from rest_framework.routers import DefaultRouter
 
+from .conditional import products_etag
 from .views import (
     OrderCreateView,
     ShopIndexView,
@@ -19,6 +21,7 @@ from .views import (
     OrdersExportView,
     ProductViewSet,
     OrderViewSet,
+    RevenueView,
     LatestProductsFeed,
     UserOrdersListView, UserOrdersExportView,
 )
@@ -32,6 +35,7 @@ routers.register("orders", OrderViewSet)
 urlpatterns = [
     # path("", cache_page(60 * 3)(ShopIndexView.as_view()), name="shop_index"),
     path("", ShopIndexView.as_view(), name="shop_index"),
+    path("api/revenue/", RevenueView.as_view(), name="revenue"),
     path("api/", include(routers.urls)),
     path("products/", ProductsListView.as_view(), name="products_list"),
     path("products/export/", ProductsDataExportView.as_view(), name="products-export"),
@@ -39,7 +43,11 @@ urlpatterns = [
     path("products/<int:pk>/", ProductDetailsView.as_view(), name="product_details"),
     path("products/<int:pk>/update/", ProductUpdateView.as_view(), name="product_update"),
     path("products/<int:pk>/archive/", ProductDeleteView.as_view(), name="product_delete"),
-    path("products/latest/feed/", LatestProductsFeed(), name="products-feed"),
+    path(
+        "products/latest/feed/",
+        condition(etag_func=products_etag)(LatestProductsFeed()),
+        name="products-feed",
+    ),
     path("orders/", OrdersListView.as_view(), name="orders_list"),
     path("orders/export/", OrdersExportView.as_view(), name="orders-export"),
     path("orders/create/", OrderCreateView.as_view(), name="order_create"),
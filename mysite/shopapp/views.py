@@ -4,19 +4,28 @@
 Разные view интернет-магазина: по товарам, заказам и т.д.
 """
 import logging
-from csv import DictWriter
-
 from django.contrib.syndication.views import Feed
-from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, JsonResponse
+from django.http import (
+    HttpResponse,
+    HttpRequest,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+)
 from django.utils.decorators import method_decorator
 from django.shortcuts import render, redirect, get_object_or_404
-from django.core.cache import cache
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.utils.dateparse import parse_date
 from django.urls import reverse, reverse_lazy
 from django.views import View
 from django.contrib.auth.models import Group, User
-from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView, ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin, UserPassesTestMixin
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import GenericAPIView
+from rest_framework.permissions import IsAdminUser
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.parsers import MultiPartParser
 from rest_framework.request import Request
@@ -24,30 +33,79 @@ from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from drf_spectacular.utils import extend_schema, OpenApiResponse
-
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+
+from .api_mixins import (
+    BulkWriteMixin,
+    FastReadMixin,
+    QueryBudgetMixin,
+    ResponseCacheMixin,
+    SerializerQuerysetMixin,
+    SparseFieldsetMixin,
+)
+from .caching import get_or_compute, model_tag, user_orders_tag
 from .common import save_csv_products
+from .conditional import product_etag, product_last_modified
+from .exports import (
+    ORDER_EXPORT_COLUMNS,
+    ORDER_EXPORT_FIELDS,
+    PRODUCT_EXPORT_COLUMNS,
+    EncodedBody,
+    changed_since,
+    encode_body,
+    encoded_response,
+    export_chunks,
+    export_response,
+    initial_watermark,
+    iter_orders_rows,
+    negotiate_format,
+    orders_rows,
+    parse_page_params,
+    products_data,
+    stream_queryset_export,
+)
 from .forms import ProductForm, OrderForm, GroupForm
-from .models import Product, Order, ProductImage
+from .models import Product, Order, OrderRollup, ProductImage
+from .pagination import AggregatePagination, KeysetPagination
+from .rollups import refresh_product_rollups
+from .search import FullTextSearchFilter, index_products
 from timeit import default_timer
-from .serializers import ProductSerializer, OrderSerializer
+from .renderers import EXPORT_RENDERERS
+from .serializers import ProductSerializer, OrderSerializer, RevenueSerializer
 
 
 log = logging.getLogger(__name__)
 
+# exports are dropped by tag on every write, the timeout only bounds the cache size
+EXPORT_CACHE_TIMEOUT = 60 * 60 * 24
+
 @extend_schema(description="Product views CRUD")
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(
+    BulkWriteMixin,
+    QueryBudgetMixin,
+    ResponseCacheMixin,
+    FastReadMixin,
+    SparseFieldsetMixin,
+    SerializerQuerysetMixin,
+    ModelViewSet,
+):
     """
     Набор представлений для действий над Product
-    Полный CRUD для сущностей товара
+    Полный CRUD для сущностей товара и пакетная запись через bulk/
     """
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = KeysetPagination
+    fast_read = True
+    # ?page= adds the COUNT query, retrieve reads updated_at for the ETag first
+    query_budget = {"list": 2, "retrieve": 2}
     filter_backends = [
-        SearchFilter,
+        FullTextSearchFilter,
         DjangoFilterBackend,
         OrderingFilter,
     ]
+    # used by the LIKE fallback when the FTS5 index is not available
     search_fields = ["name", "description"]
     filterset_fields = [
         "name",
@@ -62,17 +120,21 @@ class ProductViewSet(ModelViewSet):
         "discount",
     ]
 
-    @method_decorator(cache_page(60 * 2))
     def list(self, *args, **kwargs):
         # print("hello products list")
         return super().list(*args, **kwargs)
 
-    @action(methods=["get"], detail=False)
-    def download_csv(self, request: Request):
+    def after_bulk_save(self, serializer):
+        written = serializer.validated_data
+        pks = [product.pk for product in serializer.instance]
+        # repricing does not touch the indexed columns
+        if self.request.method == "POST" or any("name" in attrs or "description" in attrs for attrs in written):
+            index_products(pks)
+        if self.request.method != "POST" and any("price" in attrs for attrs in written):
+            refresh_product_rollups(pks)
 
-        response = HttpResponse(content_type="text/csv")
-        filename = "products-export.csv"
-        response["Content-Disposition"] = f"attachment; filename={filename}"
+    @action(methods=["get"], detail=False, renderer_classes=EXPORT_RENDERERS)
+    def download_csv(self, request: Request):
         queryset = self.filter_queryset(self.get_queryset())
         fields = [
             "name",
@@ -80,17 +142,14 @@ class ProductViewSet(ModelViewSet):
             "price",
             "discount"
         ]
-        queryset = queryset.only(*fields)
-        writer = DictWriter(response, fieldnames=fields)
-        writer.writeheader()
-
-        for product in queryset:
-            writer.writerow({
-                field: getattr(product, field)
-                for field in fields
-            })
-
-        return response
+        return stream_queryset_export(
+            request,
+            queryset,
+            fields,
+            fmt=request.accepted_renderer.format,
+            key="products",
+            filename="products-export",
+        )
 
     @action(
         detail=False,
@@ -98,12 +157,15 @@ class ProductViewSet(ModelViewSet):
         parser_classes=[MultiPartParser],
     )
     def upload_csv(self, request: Request):
-        products = save_csv_products(
-            request.FILES["file"],
-            encoding=request.encoding,
-        )
-        serializer = self.get_serializer(products, many=True)
-        return Response(serializer.data)
+        try:
+            result = save_csv_products(
+                request.FILES["file"],
+                encoding=request.encoding,
+                key=request.query_params.get("key", "name") or None,
+            )
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result.as_dict())
 
     @extend_schema(
         summary="Get one product by ID",
@@ -113,19 +175,30 @@ class ProductViewSet(ModelViewSet):
             404: OpenApiResponse(description="Empty response, product by ID not found"),
         }
     )
+    @method_decorator(condition(etag_func=product_etag, last_modified_func=product_last_modified))
     def retrieve(self, *args, **kwargs):
         return super().retrieve(*args, **kwargs)
 
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(
+    QueryBudgetMixin,
+    FastReadMixin,
+    SparseFieldsetMixin,
+    SerializerQuerysetMixin,
+    ModelViewSet,
+):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
+    fast_read = True
+    # orders, their products in one prefetch, and the COUNT for ?page=
+    query_budget = {"list": 3, "retrieve": 2}
     filter_backends = [
         SearchFilter,
         DjangoFilterBackend,
         OrderingFilter,
     ]
-    search_fields = ["user", "delivery_address"]
+    search_fields = ["user__username", "delivery_address"]
     filterset_fields = [
         "delivery_address",
         "promocode",
@@ -140,6 +213,86 @@ class OrderViewSet(ModelViewSet):
     ]
 
 
+class RevenueView(GenericAPIView):
+    """
+    Выручка, число заказов и средний чек по сводкам OrderRollup,
+    без соединения заказов с товарами. ?group_by=month,promocode
+    (из day, month, user, promocode), ?since= и ?until= - даты
+    включительно, ?user= и ?promocode= - фильтры
+    """
+    queryset = OrderRollup.objects.all()
+    serializer_class = RevenueSerializer
+    pagination_class = AggregatePagination
+    permission_classes = [IsAdminUser]
+    group_fields = ("day", "month", "user", "promocode")
+
+    def get_group_by(self) -> list:
+        value = self.request.query_params.get("group_by") or "day"
+        names = list(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+        unknown = [name for name in names if name not in self.group_fields]
+        if unknown:
+            raise ValidationError({"group_by": f"Unknown fields: {', '.join(unknown)}"})
+        return names
+
+    def get_date_param(self, name: str):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise ValidationError({name: "Expected a date in YYYY-MM-DD format"})
+        return day
+
+    def get_queryset(self):
+        params = self.request.query_params
+        queryset = super().get_queryset()
+        since = self.get_date_param("since")
+        if since is not None:
+            queryset = queryset.filter(day__gte=since)
+        until = self.get_date_param("until")
+        if until is not None:
+            queryset = queryset.filter(day__lte=until)
+        if params.get("user"):
+            if not params["user"].isdigit():
+                raise ValidationError({"user": "Expected a user id"})
+            queryset = queryset.filter(user_id=params["user"])
+        if "promocode" in params:
+            queryset = queryset.filter(promocode=params["promocode"])
+        group_by = self.get_group_by()
+        if "month" in group_by:
+            queryset = queryset.annotate(month=TruncMonth("day"))
+        return (
+            queryset
+            .values(*group_by)
+            .annotate(
+                orders_count=Sum("orders"),
+                products_count=Sum("products"),
+                revenue_total=Sum("revenue"),
+            )
+            .order_by(*group_by)
+        )
+
+    @extend_schema(
+        summary="Revenue rollups",
+        parameters=[
+            OpenApiParameter("group_by", str, description="Comma separated: day, month, user, promocode"),
+            OpenApiParameter("since", OpenApiTypes.DATE),
+            OpenApiParameter("until", OpenApiTypes.DATE),
+            OpenApiParameter("user", int),
+            OpenApiParameter("promocode", str),
+        ],
+    )
+    def get(self, request: Request) -> Response:
+        page = self.paginate_queryset(self.get_queryset())
+        for row in page:
+            row["revenue"] = row.pop("revenue_total") or 0
+            row["average_basket"] = row["revenue"] / row["orders_count"] if row["orders_count"] else 0
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
 class ShopIndexView(View):
     def get(self, request: HttpRequest) -> HttpResponse:
         products = Product.objects.all()
@@ -169,6 +322,7 @@ class GroupsListView(View):
         return redirect(request.path)
 
 
+@method_decorator(condition(etag_func=product_etag, last_modified_func=product_last_modified), name="get")
 class ProductDetailsView(DetailView):
     template_name = "shopapp/products-details.html"
     # model = Product
@@ -270,22 +424,42 @@ def create_product(request: HttpRequest) -> HttpResponse:
 
 
 class ProductsDataExportView(View):
-    def get(self, request: HttpRequest) -> JsonResponse:
-        cache_key = "products_data_export"
-        products_data = cache.get(cache_key)
-        if not products_data:
-            products = Product.objects.order_by("pk").all()
-            products_data = [
-                {
-                    "pk": product.pk,
-                    "name": product.name,
-                    "price": product.price,
-                    "archived": product.archived,
-                }
-                for product in products
-            ]
-            cache.set(cache_key, products_data, 300)
-        return JsonResponse({"products": products_data})
+    def get(self, request: HttpRequest) -> HttpResponse:
+        try:
+            fmt = negotiate_format(request)
+            if "since" in request.GET:
+                rows, since, more = changed_since(
+                    Product.objects.all(),
+                    request.GET["since"],
+                    PRODUCT_EXPORT_COLUMNS,
+                )
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        if "since" in request.GET:
+            extra = {"since": since, "more": more}
+            chunks = export_chunks(fmt, "products", PRODUCT_EXPORT_COLUMNS, rows, extra=extra)
+            return export_response(request, chunks, fmt, extra=extra, streaming=False)
+        if fmt != "json":
+            return stream_queryset_export(
+                request,
+                Product.objects.order_by("pk"),
+                PRODUCT_EXPORT_COLUMNS,
+                fmt,
+                extra={"since": initial_watermark()},
+            )
+
+        def build() -> EncodedBody:
+            since = initial_watermark()
+            products = Product.objects.order_by("pk").values_list(*PRODUCT_EXPORT_COLUMNS)
+            return encode_body({
+                "products": products_data(products),
+                "since": since,
+            })
+
+        products_data_export = get_or_compute(
+            "products_data_export", build, EXPORT_CACHE_TIMEOUT, tags=[model_tag(Product)],
+        )
+        return encoded_response(request, products_data_export)
 
 
 class LatestProductsFeed(Feed):
@@ -354,19 +528,37 @@ class OrdersExportView(UserPassesTestMixin, View):
     def test_func(self):
         return self.request.user.is_staff
 
-    def get(self, request: HttpRequest) -> JsonResponse:
-        orders = Order.objects.order_by("pk").all()
-        orders_data = [
-            {
-                "pk": order.pk,
-                "delivery_address": order.delivery_address,
-                "promocode": order.promocode,
-                "user": order.user.pk,
-                "products": [product.pk for product in order.products.all()],
-            }
-            for order in orders
-        ]
-        return JsonResponse({"orders": orders_data})
+    def get(self, request: HttpRequest) -> HttpResponse:
+        try:
+            fmt = negotiate_format(request)
+            if "since" in request.GET:
+                rows, since, more = changed_since(
+                    Order.objects.all(),
+                    request.GET["since"],
+                    ORDER_EXPORT_COLUMNS,
+                )
+            else:
+                page_size, after_pk = parse_page_params(request)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        if "since" in request.GET:
+            extra = {"since": since, "more": more}
+            chunks = export_chunks(fmt, "orders", ORDER_EXPORT_FIELDS, orders_rows(rows), extra=extra)
+            return export_response(request, chunks, fmt, extra=extra, streaming=False)
+
+        orders = Order.objects.all()
+        if after_pk is not None:
+            orders = orders.filter(pk__gt=after_pk)
+        extra = {"since": initial_watermark()}
+        chunks = export_chunks(
+            fmt,
+            "orders",
+            ORDER_EXPORT_FIELDS,
+            iter_orders_rows(orders, limit=page_size),
+            page_size,
+            extra=extra,
+        )
+        return export_response(request, chunks, fmt, extra=extra)
 
 
 class UserOrdersListView(OrdersListView):
@@ -386,25 +578,25 @@ class UserOrdersExportView(UserPassesTestMixin, View):
     def test_func(self):
         return self.request.user.is_staff
 
-    def get(self, request: HttpRequest, user_id) -> JsonResponse:
+    def get(self, request: HttpRequest, user_id) -> HttpResponse:
         self.owner = get_object_or_404(User, pk=self.kwargs['user_id'])
-        cache_key = "user_orders_data_export_" + str(user_id)
-        orders_data = cache.get(cache_key)
-        if not orders_data:
-            orders = Order.objects.filter(user=self.owner).order_by("pk").all()
-            orders_data = [
-                {
-                    "pk": order.pk,
-                    "delivery_address": order.delivery_address,
-                    "promocode": order.promocode,
-                    "user": order.user.pk,
-                    "products": [product.pk for product in order.products.all()],
-                }
-                for order in orders
-            ]
-            cache.set(cache_key, orders_data, 300)
-        return JsonResponse({"orders": orders_data})
-
-
-
-
+        try:
+            fmt = negotiate_format(request)
+            page_size, after_pk = parse_page_params(request)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        orders = Order.objects.filter(user=self.owner)
+        if after_pk is not None:
+            orders = orders.filter(pk__gt=after_pk)
+        rows = iter_orders_rows(orders, limit=page_size)
+        if page_size is not None:
+            return export_response(request, export_chunks(fmt, "orders", ORDER_EXPORT_FIELDS, rows, page_size), fmt)
+
+        # only full exports are cached, one body per format
+        orders_data = get_or_compute(
+            f"user_orders_data_export_{self.owner.pk}_{fmt}",
+            lambda: "".join(export_chunks(fmt, "orders", ORDER_EXPORT_FIELDS, rows)),
+            EXPORT_CACHE_TIMEOUT,
+            tags=[user_orders_tag(self.owner.pk), model_tag(Product)],
+        )
+        return export_response(request, [orders_data], fmt, streaming=False)